@@ -0,0 +1,493 @@
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlparse
+from uuid import uuid4
+from flask import Response, current_app, request
+
+# Response cache for the read endpoints, with strong ETags from version counters
+# Every student and review has a version counter, bumped by the controllers after each commit that
+# changes what its endpoints return, e.g. a vote bumps the review and its student. A response is
+# cached under an ETag made from the route, its arguments and the versions of what it shows, so a
+# bump makes new ETags and old entries are never served again, they just expire.
+# Clients that send the ETag back in If-None-Match get a 304 while the versions are unchanged.
+# The counters and entries live in the backend, RESPONSE_CACHE_BACKEND:
+#   filesystem  files under RESPONSE_CACHE_DIR, shared by the workers and CLI commands of one
+#               machine, the default, by default a directory of its own for every database URI,
+#               or RESPONSE_CACHE_NAMESPACE
+#   memory      this process only, right for one gunicorn worker, with more each worker would keep
+#               serving its own copy, and 304s, after another worker's change
+#   resp        a Redis protocol server at RESPONSE_CACHE_URL, e.g. redis://localhost:6379/0,
+#               Redis itself or the stand-in started with flask cache serve
+#   none        no caching
+
+DEFAULT_RESPONSE_CACHE_TTL = 300
+DEFAULT_RESPONSE_CACHE_SIZE = 1024
+# The filesystem backend keeps more entries, and sweeps them at most this often, in seconds
+DEFAULT_FILESYSTEM_CACHE_SIZE = 10000
+DEFAULT_SWEEP_INTERVAL = 60
+# Bumped by bulk changes, e.g. an import or a recount, it is part of every ETag
+ALL = "all"
+
+
+class MemoryBackend:
+
+    def __init__(self, size=DEFAULT_RESPONSE_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.entries = OrderedDict()
+
+    def get_counters(self, keys):
+        with self.lock:
+            return [self.counters.get(key) for key in keys]
+
+    def add_counter(self, key, value):
+        with self.lock:
+            self.counters.setdefault(key, value)
+
+    def incr(self, keys):
+        with self.lock:
+            for key in keys:
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.entries.pop(key, None)
+            return None
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.entries.clear()
+
+
+# Counters are files updated under an exclusive lock, entries are files replaced atomically
+# An entry's modification time is set to when it expires. Expired entries are deleted when read, and
+# at most every sweep_interval seconds set sweeps the directory, deleting the expired entries and then
+# the ones expiring first until at most size are left, since an entry replaced by a newer version
+# is never read again
+class FileSystemBackend:
+
+    def __init__(self, directory, size=DEFAULT_FILESYSTEM_CACHE_SIZE, sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        self.counters = os.path.join(directory, "counters")
+        self.entries = os.path.join(directory, "entries")
+        self.size = size
+        self.sweep_interval = sweep_interval
+        self.swept = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(self.counters, exist_ok=True)
+        os.makedirs(self.entries, exist_ok=True)
+
+    def _path(self, directory, key):
+        return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def get_counters(self, keys):
+        values = []
+        for key in keys:
+            value = self._read(self._path(self.counters, key))
+            values.append(value.decode() if value else None)
+        return values
+
+    def add_counter(self, key, value):
+        try:
+            descriptor = os.open(self._path(self.counters, key), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+        with os.fdopen(descriptor, "w") as file:
+            file.write(str(value))
+
+    def incr(self, keys):
+        for key in keys:
+            with open(os.open(self._path(self.counters, key), os.O_RDWR | os.O_CREAT), "r+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                value = int(file.read() or 0) + 1
+                file.seek(0)
+                file.truncate()
+                file.write(str(value))
+
+    def get(self, key):
+        path = self._path(self.entries, key)
+        entry = self._read(path)
+        if entry is None:
+            return None
+        expires, value = entry.split(b"\n", 1)
+        if float(expires) <= time.time():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        path = self._path(self.entries, key)
+        expires = time.time() + ttl
+        descriptor, temporary = tempfile.mkstemp(dir=self.entries)
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(f"{expires}\n".encode() + value)
+        os.utime(temporary, (expires, expires))
+        os.replace(temporary, path)
+        with self.lock:
+            if time.monotonic() - self.swept < self.sweep_interval:
+                return
+            self.swept = time.monotonic()
+        self.sweep()
+
+    def sweep(self):
+        now = time.time()
+        entries = []
+        with os.scandir(self.entries) as scan:
+            for entry in scan:
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        live = [path for expires, path in entries if expires > now]
+        for expires, path in entries[:len(entries) - len(live) + max(0, len(live) - self.size)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for directory in (self.counters, self.entries):
+            for name in os.listdir(directory):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+# Encodes a command as a RESP array of bulk strings
+def encode_command(*args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        arg = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+    return b"".join(parts)
+
+
+class RespError(Exception):
+    pass
+
+
+# Reads one RESP reply from a buffered socket file
+def read_reply(file):
+    line = file.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return file.read(length + 2)[:-2]
+    if kind == b"*":
+        length = int(rest)
+        return None if length < 0 else [read_reply(file) for i in range(length)]
+    raise RespError(f"unknown reply {line!r}")
+
+
+# Client for a Redis protocol server, one connection per thread, reconnected once on failure
+class RespBackend:
+
+    def __init__(self, url, timeout=1.0):
+        url = urlparse(url)
+        self.address = (url.hostname or "localhost", url.port or 6379)
+        self.db = int(url.path.strip("/") or 0)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        connection = socket.create_connection(self.address, timeout=self.timeout)
+        self.local.connection = connection
+        self.local.file = connection.makefile("rb")
+        if self.db:
+            self._send([("SELECT", self.db)])
+
+    def _send(self, commands):
+        self.local.connection.sendall(b"".join(encode_command(*command) for command in commands))
+        return [read_reply(self.local.file) for command in commands]
+
+    # Sends the commands in one round trip and returns their replies
+    def pipeline(self, commands):
+        for attempt in (1, 2):
+            try:
+                if getattr(self.local, "connection", None) is None:
+                    self._connect()
+                return self._send(commands)
+            except RespError:
+                #the rest of the replies are unread, the connection can not be reused
+                self.local.connection = None
+                raise
+            except (OSError, ConnectionError):
+                self.local.connection = None
+                if attempt == 2:
+                    raise
+
+    def get_counters(self, keys):
+        values = self.pipeline([("MGET", *keys)])[0]
+        return [value.decode() if value is not None else None for value in values]
+
+    def add_counter(self, key, value):
+        self.pipeline([("SET", key, value, "NX")])
+
+    def incr(self, keys):
+        self.pipeline([("INCR", key) for key in keys])
+
+    def get(self, key):
+        return self.pipeline([("GET", key)])[0]
+
+    def set(self, key, value, ttl):
+        self.pipeline([("SET", key, value, "EX", int(ttl))])
+
+    def clear(self):
+        self.pipeline([("FLUSHDB",)])
+
+
+class ResponseCache:
+
+    def __init__(self, backend=None, ttl=DEFAULT_RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def _count(self, stat):
+        with self.lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    # Returns the versions of the given keys, prefixed with the epoch of the backend
+    # The epoch changes when the counters are lost, so ETags from before can not match again
+    def versions(self, keys):
+        values = self.backend.get_counters(["epoch", *keys])
+        if values[0] is None:
+            self.backend.add_counter("epoch", uuid4().hex)
+            values = self.backend.get_counters(["epoch", *keys])
+        return [value or "0" for value in values]
+
+    def bump(self, *keys):
+        if self.backend is None:
+            return
+        try:
+            self.backend.incr(keys)
+        except Exception as e:
+            print("Error bumping response cache versions", e)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified}
+
+
+# The response cache of this worker process, configured by setup_cache
+response_cache = ResponseCache()
+
+
+# The app's own namespace in a shared cache, RESPONSE_CACHE_NAMESPACE or else the database URI, so
+# apps on one machine with different databases never share counters or entries
+def cache_namespace(config):
+    return config.get("RESPONSE_CACHE_NAMESPACE") or config.get("SQLALCHEMY_DATABASE_URI") or ""
+
+
+# The filesystem backend's directory, RESPONSE_CACHE_DIR or else one per namespace in the temp directory
+def cache_dir(config):
+    if config.get("RESPONSE_CACHE_DIR"):
+        return config["RESPONSE_CACHE_DIR"]
+    name = hashlib.sha1(cache_namespace(config).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), "response-cache", name)
+
+
+def setup_cache(app):
+    kind = app.config.get("RESPONSE_CACHE_BACKEND", "filesystem")
+    if kind == "memory":
+        backend = MemoryBackend(app.config.get("RESPONSE_CACHE_SIZE", DEFAULT_RESPONSE_CACHE_SIZE))
+    elif kind == "filesystem":
+        backend = FileSystemBackend(
+            cache_dir(app.config), app.config.get("RESPONSE_CACHE_SIZE", DEFAULT_FILESYSTEM_CACHE_SIZE)
+        )
+    elif kind == "resp":
+        backend = RespBackend(app.config.get("RESPONSE_CACHE_URL", "redis://localhost:6379/0"))
+    else:
+        backend = None
+    response_cache.backend = backend
+    response_cache.ttl = app.config.get("RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL)
+
+
+# Drops every counter and entry, called when a new database is created so that nothing cached for
+# an earlier database with the same ids is served
+def clear_response_cache():
+    if response_cache.backend is None:
+        return
+    try:
+        response_cache.backend.clear()
+    except Exception as e:
+        print("Error clearing the response cache", e)
+
+
+# Called by the controllers after committing a change to a review, or to its votes
+def bump_review_version(review_id, student_id):
+    response_cache.bump(f"review:{review_id}", f"student:{student_id}", "reviews")
+
+
+# Called by the controllers after committing a change to a student
+def bump_student_version(student_id):
+    response_cache.bump(f"student:{student_id}")
+
+
+# Called after bulk changes, e.g. an import or a recount, so every cached response is recomputed
+def bump_all_versions():
+    response_cache.bump(ALL)
+
+
+# Caches the 200 responses of a GET view, keys gives the version keys of what the view shows
+# from its arguments, e.g. lambda student_id: [f"student:{student_id}"]
+# The response gets an ETag, and a request whose If-None-Match has it gets a 304 without the view running
+# When the backend fails the view runs as if there were no cache
+def cached_response(keys):
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            if response_cache.backend is None:
+                return view(*args, **kwargs)
+            try:
+                versions = response_cache.versions([ALL, *keys(*args, **kwargs)])
+                key = json.dumps([request.endpoint, sorted(kwargs.items()), sorted(request.args.items(multi=True)), versions])
+                etag = hashlib.sha1(key.encode()).hexdigest()
+                if request.if_none_match.contains(etag):
+                    response_cache._count("not_modified")
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+                entry = response_cache.backend.get(f"response:{etag}")
+            except Exception as e:
+                print("Error reading the response cache", e)
+                return view(*args, **kwargs)
+            if entry is not None:
+                response_cache._count("hits")
+                entry = json.loads(entry)
+                response = Response(entry["body"], status=entry["status"], headers=entry["headers"], mimetype="application/json")
+                response.set_etag(etag)
+                return response
+            response_cache._count("misses")
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                headers = {name: value for name, value in response.headers.items() if name == "Link"}
+                entry = {"status": 200, "headers": headers, "body": response.get_data(as_text=True)}
+                try:
+                    response_cache.backend.set(f"response:{etag}", json.dumps(entry).encode(), response_cache.ttl)
+                except Exception as e:
+                    print("Error writing the response cache", e)
+                response.set_etag(etag)
+            return response
+        return decorated
+    return decorator
+
+
+# A small Redis protocol server keeping everything in memory, for development and tests
+# Understands the commands RespBackend sends: PING, SELECT, GET, MGET, SET with EX and NX, INCR, DEL, FLUSHDB
+class RespStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 6379)):
+        self.values = {}
+        self.lock = threading.Lock()
+        super().__init__(address, RespStandInHandler)
+
+    def execute(self, command, args):
+        with self.lock:
+            now = time.time()
+            if command in ("PING", "SELECT"):
+                return "PONG" if command == "PING" else "OK"
+            if command == "GET":
+                return self._get(args[0], now)
+            if command == "MGET":
+                return [self._get(key, now) for key in args]
+            if command == "SET":
+                options = [arg.upper() for arg in args[2:]]
+                if b"NX" in options and self._get(args[0], now) is not None:
+                    return None
+                expires = now + int(args[3 + options.index(b"EX")]) if b"EX" in options else None
+                self.values[args[0]] = (args[1], expires)
+                return "OK"
+            if command == "INCR":
+                value = int(self._get(args[0], now) or 0) + 1
+                self.values[args[0]] = (str(value).encode(), None)
+                return value
+            if command == "DEL":
+                return sum(1 for key in args if self.values.pop(key, None) is not None)
+            if command == "FLUSHDB":
+                self.values.clear()
+                return "OK"
+            raise RespError(f"ERR unknown command '{command}'")
+
+    def _get(self, key, now):
+        entry = self.values.get(key)
+        if entry and (entry[1] is None or entry[1] > now):
+            return entry[0]
+        self.values.pop(key, None)
+        return None
+
+
+class RespStandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except (ConnectionError, OSError):
+                return
+            try:
+                reply = self.server.execute(args[0].decode().upper(), args[1:])
+            except RespError as e:
+                self.wfile.write(f"-{e}\r\n".encode())
+                continue
+            self.wfile.write(encode_reply(reply))
+
+
+def encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, list):
+        return f"*{len(reply)}\r\n".encode() + b"".join(encode_reply(item) for item in reply)
+    return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
@@ -1,6 +1,13 @@
 from .user import *
 from .auth import *
+from .karma import *
+from .pagination import *
+from .export import *
+from .loading import *
+from .autocomplete import *
+from .voteQueue import *
 from .review import *
 from .student import *
 from .vote import *
 from .voteCommand import *
+from .seed import *
@@ -1,23 +1,218 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
 import flask_login
-from flask_jwt import JWT
+import jwt
+from flask import current_app, jsonify, _request_ctx_stack
+from flask_jwt import JWT, JWTError
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from App.database import db
 from App.models import User, Staff, Admin
 
+DEFAULT_IDENTITY_CACHE_SIZE = 1024
+DEFAULT_IDENTITY_CACHE_TTL = 60
 
+
+# Per-worker LRU cache of the users loaded by identity and load_user, keyed by user id
+# Entries expire after ttl seconds and are dropped when a user is updated or deleted.
+# The cached users are detached from any session and every request gets its own copy,
+# so the cache is safe to share between threads.
+class IdentityCache:
+
+    def __init__(self, size=DEFAULT_IDENTITY_CACHE_SIZE, ttl=DEFAULT_IDENTITY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(id)
+                self.hits += 1
+                return entry[1]
+            self.entries.pop(id, None)
+            self.misses += 1
+            return None
+
+    def set(self, id, user):
+        with self.lock:
+            self.entries[id] = (time.monotonic() + self.ttl, user)
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+identity_cache = IdentityCache()
+# Token versions by (access, id), checked on every request authorized from the JWT claims
+token_version_cache = IdentityCache()
+
+USER_MODELS = {"staff": Staff, "admin": Admin}
+
+
+# Staff and admins share the user table, so one indexed lookup by username finds either
+# A password hashed with older settings is rehashed with the current ones once it is checked
 def authenticate(username, password):
-    staff = Staff.query.filter_by(username=username).first()
-    if staff and staff.check_password(password):
-        return staff
-    admin= Admin.query.filter_by(username=username).first()
-    if admin and admin.check_password(password):
-        return admin
+    user = User.query.filter_by(username=username).first()
+    if user and user.check_password(password):
+        if user.password_needs_rehash():
+            rehash_password(user, password)
+        return user
     return None
 
+
+def rehash_password(user, password):
+    try:
+        user.set_password(password)
+        db.session.commit()
+        invalidate_identity(user.id)
+    except Exception as e:
+        #the old hash still works, the next login tries again
+        print("Error rehashing password", e)
+        db.session.rollback()
+
+# Returns a copy of a user that is detached from every session, with its columns loaded
+def _detached_copy(user):
+    mapper = inspect(user).mapper
+    copy = mapper.class_manager.new_instance()
+    for column in mapper.column_attrs:
+        setattr(copy, column.key, getattr(user, column.key))
+    make_transient_to_detached(copy)
+    return copy
+
+
+# Gets the staff or admin with the given id for an authenticated request, through the identity cache
+# The user returned belongs to the current session, without a query when it was cached
+def get_identity(id):
+    id = int(id)
+    user = identity_cache.get(id)
+    if user:
+        return db.session.merge(user, load=False)
+    user = User.query.get(id)
+    if user:
+        identity_cache.set(id, _detached_copy(user))
+    return user
+
+
+# Drops a user from the identity caches, called when they are updated or deleted
+def invalidate_identity(id):
+    identity_cache.invalidate(int(id))
+    for access in USER_MODELS:
+        token_version_cache.invalidate((access, int(id)))
+
+
+# Returns the hits, misses and size of the identity cache of this worker
+def get_identity_cache_stats():
+    return identity_cache.stats()
+
+
 # Payload is a dictionary which is passed to the function by Flask JWT
+# A token whose access or token version no longer matches the user is rejected, tokens issued
+# before the claims existed count as version 0
 def identity(payload):
-    user = Staff.query.get(payload["identity"])
-    if user:
+    user = get_identity(payload["identity"])
+    if user and user.access == payload.get("access", user.access) and (user.token_version or 0) == payload.get("token_version", 0):
         return user
-    return Admin.query.get(payload["identity"])
+    return None
+
+
+# Signs the user's id, access level and token version into every token, see jwt_claims_required
+def payload_handler(user):
+    iat = datetime.utcnow()
+    return {
+        "exp": iat + current_app.config.get("JWT_EXPIRATION_DELTA"),
+        "iat": iat,
+        "nbf": iat + current_app.config.get("JWT_NOT_BEFORE_DELTA"),
+        "identity": user.id,
+        "access": user.access,
+        "token_version": user.token_version or 0,
+    }
+
+
+# The user of a request authorized from the JWT claims, without loading them from the database
+class TokenIdentity:
+
+    def __init__(self, payload):
+        self.id = payload["identity"]
+        self.access = payload["access"]
+        self.token_version = payload["token_version"]
+
+
+# Gets the current token version of a user, None if they no longer exist
+# Cached for IDENTITY_CACHE_TTL seconds, so a revoked token can be accepted by other workers until then
+def get_token_version(access, id):
+    version = token_version_cache.get((access, id))
+    if version is None:
+        model = USER_MODELS.get(access)
+        version = model and db.session.query(model.token_version).filter(model.id == id).scalar()
+        if version is None:
+            return None
+        token_version_cache.set((access, id), version)
+    return version
+
+
+# Revokes every token of a user by bumping their token version, e.g. when they change role
+def revoke_tokens(access, id):
+    model = USER_MODELS[access]
+    revoked = model.query.filter_by(id=id).update(
+        {model.token_version: model.token_version + 1}, synchronize_session=False
+    )
+    db.session.commit()
+    invalidate_identity(id)
+    return revoked > 0
+
+
+# Requires a valid JWT whose access claim is one of access, any access if none are given
+# Authorizes from the signed claims and sets current_identity to a TokenIdentity, so the user is not
+# loaded from the database, only their token version is checked, through token_version_cache
+# Tokens issued before the claims existed are rejected and the user has to log in again
+def jwt_claims_required(*access):
+    def decorator(view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            extension = current_app.extensions["jwt"]
+            token = extension.request_callback()
+            if token is None:
+                raise JWTError("Authorization Required", "Request does not contain an access token",
+                               headers={"WWW-Authenticate": 'JWT realm="%s"' % current_app.config["JWT_DEFAULT_REALM"]})
+            try:
+                payload = extension.jwt_decode_callback(token)
+            except jwt.InvalidTokenError as e:
+                raise JWTError("Invalid token", str(e))
+            if "access" not in payload or "token_version" not in payload:
+                raise JWTError("Invalid token", "Token was issued without claims, log in again")
+            if get_token_version(payload["access"], payload["identity"]) != payload["token_version"]:
+                raise JWTError("Invalid JWT", "Token has been revoked")
+            if access and payload["access"] not in access:
+                return jsonify({"error": "Access denied"}), 403
+            _request_ctx_stack.top.current_identity = TokenIdentity(payload)
+            return view(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+# Issues a JWT for the user, the same token /auth returns, for the Postman login routes
+def create_access_token(user):
+    token = current_app.extensions["jwt"].jwt_encode_callback(user)
+    return token.decode("utf-8") if isinstance(token, bytes) else token
 
 
 def login_user(user):
@@ -29,4 +224,12 @@ def logout_user():
 
 
 def setup_jwt(app):
-    return JWT(app, authenticate, identity)
\ No newline at end of file
+    identity_cache.size = app.config.get("IDENTITY_CACHE_SIZE", DEFAULT_IDENTITY_CACHE_SIZE)
+    identity_cache.ttl = app.config.get("IDENTITY_CACHE_TTL", DEFAULT_IDENTITY_CACHE_TTL)
+    identity_cache.clear()
+    token_version_cache.size = identity_cache.size
+    token_version_cache.ttl = identity_cache.ttl
+    token_version_cache.clear()
+    extension = JWT(app, authenticate, identity)
+    extension.jwt_payload_handler(payload_handler)
+    return extension
\ No newline at end of file
@@ -0,0 +1,223 @@
+import heapq
+import threading
+from bisect import bisect_left, insort
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from App.database import db
+from App.models import Student
+
+# Prefix index for student autocomplete
+# The index is a flattened trie: every key (the full name, each word of the name and the school id)
+# is kept in one sorted list, so all the keys under a prefix are a contiguous slice found by bisect.
+# Prefixes with many keys keep a cached list of their best students so short queries stay fast.
+# Students are ranked by karma as of when they were last indexed. The karma changes of reviews and
+# votes are applied to the index, in memory, when their session commits, and every gunicorn worker
+# syncs its index with the database every AUTOCOMPLETE_SYNC_SECONDS on a background thread, to pick
+# up the changes made by the other workers, see gunicorn.conf.py.
+
+DEFAULT_AUTOCOMPLETE_LIMIT = 10
+DEFAULT_AUTOCOMPLETE_SYNC_SECONDS = 5
+
+
+class PrefixIndex:
+
+    def __init__(self, top_size=20, crowded=256):
+        self.top_size = top_size        # the most matches a query can return
+        self.capacity = top_size * 2    # the most students a cached top list keeps, the rest is slack
+        self.crowded = crowded          # prefixes with more keys than this cache their top matches
+        self.lock = threading.RLock()
+        self.keys = []                  # sorted (key, student id) pairs
+        self.students = {}              # student id -> (json, keys)
+        self.tops = {}                  # crowded prefix -> best student ids, best first
+
+    def _keys_for(self, name, school_id):
+        name = name.lower()
+        return {name, str(school_id), *name.split()}
+
+    def _rank(self, id):
+        return (-self.students[id][0]["karma"], id)
+
+    def _match(self, prefix):
+        low = bisect_left(self.keys, (prefix,))
+        high = bisect_left(self.keys, (prefix + "\U0010ffff",))
+        return low, high
+
+    def _top(self, low, high):
+        ids = {id for key, id in self.keys[low:high]}
+        return heapq.nsmallest(self.capacity, ids, key=self._rank)
+
+    # Replaces the whole index with the given students, each a (id, name, school_id, karma) tuple
+    def build(self, students):
+        keys = []
+        entries = {}
+        for id, name, school_id, karma in students:
+            student_keys = self._keys_for(name, school_id)
+            entries[id] = ({"id": id, "name": name, "school_id": school_id, "karma": karma or 0}, student_keys)
+            keys.extend((key, id) for key in student_keys)
+        keys.sort()
+        with self.lock:
+            self.keys = keys
+            self.students = entries
+            self.tops = {}
+            #warm the one and two character prefixes, the ones typed first and shared by the most keys
+            for prefix in {key[:length] for key, id in keys for length in (1, 2)}:
+                low, high = self._match(prefix)
+                if high - low > self.crowded:
+                    self.tops[prefix] = self._top(low, high)
+
+    # The prefixes of a student's keys that have a cached top list
+    def _cached_prefixes(self, keys):
+        return {key[:length] for key in keys for length in range(1, len(key) + 1)} & self.tops.keys()
+
+    # Moves a student whose rank changed, or who is new, to their place in a cached top list
+    # A top list always holds the best len(top) students of its prefix. A student who falls below the
+    # last of the list leaves it, since a student outside it may now rank above them, the slack up to
+    # capacity keeps the list long enough for queries until many have
+    def _place(self, prefix, id):
+        top = self.tops[prefix]
+        if id in top:
+            top.remove(id)
+        rank = self._rank(id)
+        if top and rank < self._rank(top[-1]):
+            top.insert(bisect_left([self._rank(other) for other in top], rank), id)
+            del top[self.capacity:]
+        if not top:
+            del self.tops[prefix]
+
+    # Adds a student to the index, or re-indexes them if their name, school id or karma changed
+    # The cached top lists are updated in place
+    def add(self, id, name, school_id, karma):
+        with self.lock:
+            student_keys = self._keys_for(name, school_id)
+            entry = self.students.get(id)
+            if entry is None or entry[1] != student_keys:
+                self.remove(id)
+                for key in student_keys:
+                    insort(self.keys, (key, id))
+            self.students[id] = ({"id": id, "name": name, "school_id": school_id, "karma": karma or 0}, student_keys)
+            for prefix in self._cached_prefixes(student_keys):
+                self._place(prefix, id)
+
+    # Adds delta to the karma of an indexed student, students not in the index are left to the next sync
+    def add_karma(self, id, delta):
+        with self.lock:
+            entry = self.students.get(id)
+            if entry is None or not delta:
+                return
+            self.students[id] = (dict(entry[0], karma=entry[0]["karma"] + delta), entry[1])
+            for prefix in self._cached_prefixes(entry[1]):
+                self._place(prefix, id)
+
+    def remove(self, id):
+        with self.lock:
+            entry = self.students.get(id)
+            if not entry:
+                return
+            for key in entry[1]:
+                index = bisect_left(self.keys, (key, id))
+                del self.keys[index]
+            for prefix in self._cached_prefixes(entry[1]):
+                top = self.tops[prefix]
+                if id in top:
+                    top.remove(id)
+                    if not top:
+                        del self.tops[prefix]
+            del self.students[id]
+
+    # Brings the index in line with the given students, each a (id, name, school_id, karma) tuple,
+    # adding or re-indexing the ones that changed and removing the ones not given
+    def sync(self, students):
+        seen = set()
+        for id, name, school_id, karma in students:
+            seen.add(id)
+            entry = self.students.get(id)
+            if entry is None or (entry[0]["name"], entry[0]["school_id"], entry[0]["karma"]) != (name, school_id, karma or 0):
+                self.add(id, name, school_id, karma)
+        with self.lock:
+            for id in set(self.students) - seen:
+                self.remove(id)
+
+    # Returns up to limit students with a key starting with prefix, highest karma first
+    def search(self, prefix, limit=DEFAULT_AUTOCOMPLETE_LIMIT):
+        prefix = " ".join(prefix.lower().split())
+        if not prefix:
+            return []
+        with self.lock:
+            limit = min(limit, self.top_size)
+            top = self.tops.get(prefix)
+            #a cached list shortened by students falling out of it is recomputed once it is too short
+            if top is None or len(top) < limit:
+                low, high = self._match(prefix)
+                top = self._top(low, high)
+                if high - low > self.crowded:
+                    self.tops[prefix] = top
+            return [self.students[id][0] for id in top[:limit]]
+
+
+# The index of this worker process
+student_index = PrefixIndex()
+student_index_built = threading.Event()
+
+
+def _student_rows():
+    return db.session.query(Student.id, Student.name, Student.school_id, Student.karma)
+
+
+# Builds the student autocomplete index from the database, called at startup
+def build_student_index():
+    student_index.build(_student_rows().yield_per(1000))
+    student_index_built.set()
+
+
+# Syncs the student autocomplete index with the database, picking up the students created, updated
+# or deleted and the karma changed by the other workers
+def sync_student_index():
+    student_index.sync(_student_rows().yield_per(1000))
+
+
+# Syncs the index with the database every interval seconds on a daemon thread, until the returned
+# event is set, started in each gunicorn worker by gunicorn.conf.py
+def start_student_index_sync(app, interval=None):
+    interval = interval or app.config.get("AUTOCOMPLETE_SYNC_SECONDS", DEFAULT_AUTOCOMPLETE_SYNC_SECONDS)
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            with app.app_context():
+                try:
+                    sync_student_index()
+                except Exception as e:
+                    print("Error syncing the student index", e)
+                finally:
+                    db.session.remove()
+    threading.Thread(target=run, name="student-index-sync", daemon=True).start()
+    return stop
+
+
+# Review.add_student_karma keeps the karma changes of a transaction in the session's info, they are
+# applied to the index once it commits, and dropped if it rolls back
+@event.listens_for(Session, "after_commit")
+def _index_karma_changes(session):
+    for id, delta in session.info.pop("karma_changes", {}).items():
+        student_index.add_karma(id, delta)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_karma_changes(session):
+    session.info.pop("karma_changes", None)
+
+
+# Adds or updates a student in the autocomplete index, called when a student is created or updated
+def index_student(student):
+    student_index.add(student.id, student.name, student.school_id, student.karma)
+
+
+# Removes a student from the autocomplete index, called when a student is deleted
+def unindex_student(student_id):
+    student_index.remove(student_id)
+
+
+# Returns up to limit students whose name, a word of their name or school id starts with query
+def autocomplete_students(query, limit=DEFAULT_AUTOCOMPLETE_LIMIT):
+    if not student_index_built.is_set():
+        build_student_index()
+    return student_index.search(query, limit)
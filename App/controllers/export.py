@@ -0,0 +1,46 @@
+import json
+from itertools import islice
+from flask import Response, current_app, stream_with_context
+
+# Streaming exports
+# The rows are serialized while they are read, so memory use stays the same whatever the table size.
+
+DEFAULT_STREAM_CHUNK_SIZE = 1000
+
+
+# The number of rows read from the database and written to the response at a time
+def get_stream_chunk_size():
+    return current_app.config.get("STREAM_CHUNK_SIZE", DEFAULT_STREAM_CHUNK_SIZE)
+
+
+# Yields the items as NDJSON, one object per line, joined into one string per chunk
+def _ndjson_chunks(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            return
+        yield "".join(json.dumps(item) + "\n" for item in chunk)
+
+
+# Yields the items as a single JSON array, one string per chunk
+def _array_chunks(items, chunk_size):
+    yield "["
+    separator = ""
+    for chunk in _ndjson_chunks(items, chunk_size):
+        yield separator + ",".join(chunk.splitlines())
+        separator = ","
+    yield "]"
+
+
+# Returns a streaming response for an iterable of json objects
+# The format is NDJSON (application/x-ndjson) unless array is True, then it is a chunked JSON array
+def stream_json_response(items, array=False):
+    chunk_size = get_stream_chunk_size()
+    if array:
+        body = _array_chunks(items, chunk_size)
+        mimetype = "application/json"
+    else:
+        body = _ndjson_chunks(items, chunk_size)
+        mimetype = "application/x-ndjson"
+    return Response(stream_with_context(body), mimetype=mimetype)
@@ -0,0 +1,140 @@
+from sqlalchemy import case, func
+from App.database import db
+from App.models import Review, Student, Vote
+from App.models.vote import Value
+
+# Karma engine for bulk listings
+# Computes the same karma as Review.get_karma and Student.get_karma, but for many rows at once
+# in a single aggregate query over the vote table instead of loading every review and vote.
+# The model methods stay the reference implementation, see KarmaEngineIntegrationTests.
+# Listings and pages read the stored counters instead, with the listing queries, and the aggregate
+# queries are what the stored counters are checked and rebuilt against.
+
+
+# Counts the upvotes and downvotes of every review that has votes
+def _vote_counts():
+    return (
+        db.session.query(
+            Vote.review_id.label("review_id"),
+            func.sum(case((Vote.value == Value.UPVOTE, 1), else_=0)).label("num_upvotes"),
+            func.sum(case((Vote.value == Value.DOWNVOTE, 1), else_=0)).label("num_downvotes"),
+        )
+        .group_by(Vote.review_id)
+        .subquery()
+    )
+
+
+# SQL version of Review.get_karma for the given rating, upvote and downvote columns
+def karma_expression(rating, num_upvotes, num_downvotes):
+    return case(
+        (rating > 5, rating + (rating - 5) * num_upvotes - (rating - 5) * num_downvotes),
+        (rating < 5, (rating - 10) - (5 - rating) * num_upvotes + (5 - rating) * num_downvotes),
+        else_=rating + num_upvotes - num_downvotes,
+    )
+
+
+# Query for every review with its karma and vote counts, ordered by id
+# Filters can be added to the returned query as usual, e.g. .filter(Review.student_id == id)
+def review_karma_query():
+    counts = _vote_counts()
+    num_upvotes = func.coalesce(counts.c.num_upvotes, 0)
+    num_downvotes = func.coalesce(counts.c.num_downvotes, 0)
+    return (
+        db.session.query(
+            Review.id,
+            Review.staff_id,
+            Review.student_id,
+            Review.text,
+            Review.rating,
+            karma_expression(Review.rating, num_upvotes, num_downvotes).label("karma"),
+            num_upvotes.label("num_upvotes"),
+            num_downvotes.label("num_downvotes"),
+        )
+        .outerjoin(counts, counts.c.review_id == Review.id)
+        .order_by(Review.id)
+    )
+
+
+# Query for every student with their karma, ordered by id
+# A student's karma is the sum of the karma of their reviews, grouped by student in SQL
+def student_karma_query():
+    counts = _vote_counts()
+    review_karma = karma_expression(
+        Review.rating,
+        func.coalesce(counts.c.num_upvotes, 0),
+        func.coalesce(counts.c.num_downvotes, 0),
+    )
+    karma_by_student = (
+        db.session.query(
+            Review.student_id.label("student_id"),
+            func.sum(review_karma).label("karma"),
+        )
+        .outerjoin(counts, counts.c.review_id == Review.id)
+        .group_by(Review.student_id)
+        .subquery()
+    )
+    return (
+        db.session.query(
+            Student.id,
+            Student.school_id,
+            Student.name,
+            Student.faculty,
+            Student.programme,
+            func.coalesce(karma_by_student.c.karma, 0).label("karma"),
+        )
+        .outerjoin(karma_by_student, karma_by_student.c.student_id == Student.id)
+        .order_by(Student.id)
+    )
+
+
+# Query for every review with its stored vote counts and the karma they give, ordered by id
+# Reads the review table alone, so a page is read through the primary key without any aggregate
+def review_listing_query():
+    return db.session.query(
+        Review.id,
+        Review.staff_id,
+        Review.student_id,
+        Review.text,
+        Review.rating,
+        karma_expression(Review.rating, Review.num_upvotes, Review.num_downvotes).label("karma"),
+        Review.num_upvotes,
+        Review.num_downvotes,
+    ).order_by(Review.id)
+
+
+# Query for every student with their stored karma, ordered by id
+def student_listing_query():
+    return db.session.query(
+        Student.id,
+        Student.school_id,
+        Student.name,
+        Student.faculty,
+        Student.programme,
+        Student.karma,
+    ).order_by(Student.id)
+
+
+# Converts a row of review_karma_query or review_listing_query to the same json as Review.to_json
+def review_row_to_json(row):
+    return {
+        "id": row.id,
+        "staff_id": row.staff_id,
+        "student_id": row.student_id,
+        "text": row.text,
+        "rating": row.rating,
+        "karma": row.karma,
+        "num_upvotes": row.num_upvotes,
+        "num_downvotes": row.num_downvotes,
+    }
+
+
+# Converts a row of student_karma_query or student_listing_query to the same json as Student.to_json
+def student_row_to_json(row):
+    return {
+        "id": row.id,
+        "school_id": row.school_id,
+        "name": row.name,
+        "faculty": row.faculty,
+        "programme": row.programme,
+        "karma": row.karma,
+    }
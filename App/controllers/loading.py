@@ -0,0 +1,37 @@
+from sqlalchemy.orm import joinedload, lazyload, selectinload
+from App.models import Review, Student
+
+# Named loading profiles
+# Controllers pass a profile name so a query loads the relationships its caller will use up front,
+# instead of one lazy load per row while serializing or rendering.
+#   list: only the rows themselves, e.g. listing pages that show the stored counts and karma
+#   detail: the rows with the objects they point to, e.g. a review with its staff and student
+#   with_votes: the rows with their votes, e.g. checking the stored counts against the vote rows
+
+# Each profile is a function returning its loader options, so the backrefs such as Review.staff
+# exist by the time the options are built
+LOADING_PROFILES = {
+    Review: {
+        "list": lambda: [lazyload(Review.staff)],
+        "detail": lambda: [joinedload(Review.staff), joinedload(Review.student)],
+        "with_votes": lambda: [lazyload(Review.staff), selectinload(Review.votes)],
+    },
+    Student: {
+        "list": lambda: [lazyload(Student.reviews)],
+        "detail": lambda: [selectinload(Student.reviews).lazyload(Review.staff)],
+        "with_votes": lambda: [
+            selectinload(Student.reviews).lazyload(Review.staff),
+            selectinload(Student.reviews).selectinload(Review.votes),
+        ],
+    },
+}
+
+
+# Adds the loader options of a profile to a query of the given model
+# A profile of None leaves the query with the relationship defaults from the models
+def apply_profile(query, model, profile):
+    if profile is None:
+        return query
+    if profile not in LOADING_PROFILES[model]:
+        raise ValueError(f"unknown loading profile {profile}")
+    return query.options(*LOADING_PROFILES[model][profile]())
@@ -0,0 +1,48 @@
+from flask import current_app, request, url_for
+
+# Keyset pagination helpers
+# Pages are requested with ?after=<id>&limit=<n> and read with WHERE id > after ORDER BY id LIMIT n,
+# which uses the primary key index instead of scanning past an OFFSET.
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+# The hard server-side limit on page size, MAX_PAGE_SIZE unless set in the app config
+def get_max_page_size():
+    return current_app.config.get("MAX_PAGE_SIZE", MAX_PAGE_SIZE)
+
+
+# Reads the after and limit arguments of a request
+# Missing or invalid values fall back to the defaults, and limit is never more than the maximum page size
+def get_page_args(args):
+    try:
+        after = int(args.get("after"))
+    except (TypeError, ValueError):
+        after = None
+    try:
+        limit = int(args.get("limit"))
+    except (TypeError, ValueError):
+        limit = current_app.config.get("PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    return after, max(1, min(limit, get_max_page_size()))
+
+
+# Returns one page of a query and the cursor for the next page, or None if this is the last page
+# column is the primary key column the query is ordered by, e.g. Review.id
+def get_page(query, column, after=None, limit=DEFAULT_PAGE_SIZE):
+    limit = max(1, min(limit, get_max_page_size()))
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(None).order_by(column).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+
+# Returns the Link header value pointing at the next page of the current endpoint
+def next_page_link(next_cursor, limit):
+    url = url_for(
+        request.endpoint, **(request.view_args or {}), after=next_cursor, limit=limit, _external=True
+    )
+    return f'<{url}>; rel="next"'
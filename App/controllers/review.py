@@ -1,25 +1,38 @@
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError
 from App.models import Review, Student, User, Staff, VoteCommand, Vote
 from App.database import db
 from App.models.vote import Value
 from App.models.voteCommand import Action
-from App.controllers.vote import get_votes
+from App.controllers.vote import get_votes, delete_review_votes
+from App.controllers.karma import review_listing_query, review_row_to_json
+from App.controllers.pagination import get_page, DEFAULT_PAGE_SIZE
+from App.controllers.loading import apply_profile
+from App.controllers.voteQueue import VoteQueue
+from App.cache import bump_review_version, bump_all_versions
+from App.metrics import count_vote_commands
 
 # Creates a review given a student's school id, user id, review text, and rating
 # Returns the review object if successful, None otherwise
-
+# A second review of the same student by the same staff is rejected by the unique index on review
 def create_review_by_student_id(student_id, staff_id, text, rating):
     staff = Staff.query.get(staff_id)
     student = Student.query.get(student_id)
     if staff and student:
-        review = Review.query.filter_by(staff_id=staff_id, student_id=student_id).first()
-        if review:
-            return "Review exists"
         try:
             review = Review(staff_id, student_id, text, rating)
             db.session.add(review)
+            review.add_student_karma(review.get_karma())
             db.session.commit()
+            bump_review_version(review.id, student_id)
             return review
+        except IntegrityError:
+            db.session.rollback()
+            return "Review exists"
         except:
+            db.session.rollback()
             return None
 
 
@@ -28,15 +41,15 @@ def create_review(school_id, staff_id, text, rating):
     staff = Staff.query.get(staff_id)
     student = Student.query.filter_by(school_id=school_id).first()
     if staff and student:
-        review = Review.query.filter_by(staff_id=staff_id, student_id=student.id).first()
-        if review:
-            return None
         try:
             review = Review(staff_id=staff_id, student_id=student.id, text=text, rating=rating)
             db.session.add(review)
+            review.add_student_karma(review.get_karma())
             db.session.commit()
+            bump_review_version(review.id, student.id)
             return review
         except:
+            db.session.rollback()
             return None
 
 # Creates a review given a student id, user id and review text
@@ -47,9 +60,12 @@ def create_review_postman(student_id, staff_id, text, rating):
     try:
         review = Review(staff_id, student_id, text, rating)
         db.session.add(review)
+        review.add_student_karma(review.get_karma())
         db.session.commit()
+        bump_review_version(review.id, student_id)
         return review
     except:
+        db.session.rollback()
         return ("Review not created")
 
 
@@ -59,10 +75,14 @@ def create_review_postman(student_id, staff_id, text, rating):
 def update_review(id, text, rating):
     review = Review.query.get(id)
     if review:
+        old_karma = review.get_karma()
         review.text = text
-        review.rating= rating
+        review.rating= int(rating)
+        review.add_student_karma(review.get_karma() - old_karma)
         db.session.add(review)
+        student_id = review.student_id
         db.session.commit()
+        bump_review_version(id, student_id)
         return review
     return None
 
@@ -72,8 +92,12 @@ def update_review(id, text, rating):
 def delete_review(id):
     review = Review.query.get(id)
     if review:
+        review.add_student_karma(-review.get_karma())
+        delete_review_votes([review])
         db.session.delete(review)
+        student_id = review.student_id
         db.session.commit()
+        bump_review_version(id, student_id)
         return True
     return False
 
@@ -95,32 +119,74 @@ def get_review_json(id):
 
 
 # Returns all reviews in the database
-def get_all_reviews():
-    return Review.query.all()
+# profile is the loading profile for the reviews' relationships, see App/controllers/loading.py
+def get_all_reviews(profile="list"):
+    return apply_profile(Review.query, Review, profile).all()
 
 
-# Returns all reviews as a json object
+# Returns all reviews as a json object, with karma from the stored vote counts
 # Returns None if no reviews exist
 def get_all_reviews_json():
-    reviews = Review.query.all()
+    reviews = [review_row_to_json(row) for row in review_listing_query()]
     if reviews:
-        return [review.to_json() for review in reviews]
+        return reviews
     return None
 
 
+# Returns one page of reviews ordered by id, starting after the review id after
+# Returns the reviews and the cursor for the next page, None if it is the last page
+def get_reviews_page(after=None, limit=DEFAULT_PAGE_SIZE, profile="list"):
+    return get_page(apply_profile(Review.query, Review, profile), Review.id, after, limit)
+
+
+# Returns one page of reviews as json, with karma from the stored vote counts
+def get_reviews_page_json(after=None, limit=DEFAULT_PAGE_SIZE):
+    rows, next_cursor = get_page(review_listing_query(), Review.id, after, limit)
+    return [review_row_to_json(row) for row in rows], next_cursor
+
+
+# Yields every review as json, reading chunk_size rows from the database at a time
+def stream_reviews_json(chunk_size=1000):
+    for row in review_listing_query().yield_per(chunk_size):
+        yield review_row_to_json(row)
+
+
 # Gets the reviews for a student given the student id
-def get_reviews_by_student(student_id):
-    reviews = Review.query.filter_by(student_id=student_id).all()
+def get_reviews_by_student(student_id, profile="list"):
+    reviews = apply_profile(Review.query, Review, profile).filter_by(student_id=student_id).all()
     return reviews
 
 # Returns the reviews posted by a staff given the staff id
-def get_reviews_by_staff(staff_id):
-    reviews = Review.query.filter_by(staff_id=staff_id).all()
+def get_reviews_by_staff(staff_id, profile="list"):
+    reviews = apply_profile(Review.query, Review, profile).filter_by(staff_id=staff_id).all()
     return reviews
 
+#Queues a vote for the vote queue, used by vote_on_review while VOTE_QUEUE_ENABLED is set
+#The staff and review are checked before the vote is queued, and again when it is applied in case
+#either was deleted meanwhile
+#Returns the ticket to check the status of the vote with
+def queue_vote_on_review(review_id, staff_id, action):
+    actions= {"upvote": Action.UPVOTE, "downvote": Action.DOWNVOTE}
+    if action not in actions:
+        return("Invalid action")
+    staff= db.session.query(Staff.id).filter_by(id=staff_id).first()
+    review= db.session.query(Review.id).filter_by(id=review_id).first()
+    if not (staff and review):
+        return ('Must have a Staff account to vote')
+    ticket= vote_queue.submit((staff_id, review_id, actions[action]))
+    return {"ticket": ticket, "status": "queued", "staff_id": staff_id, "review_id": review_id, "action": action}
+
+
 #Handles voting on a review, updating a vote and removing a vote
+#With VOTE_QUEUE_ENABLED set the vote is queued instead, see queue_vote_on_review
+#The command and all of its effects are applied in one transaction:
+#the review row is locked (SELECT ... FOR UPDATE, where the database supports it) and the command is
+#inserted before the current vote is read, so on SQLite the write lock is held from that point too.
+#Two clicks at the same time are applied one after the other and neither is lost or doubled.
 def vote_on_review(review_id, staff_id, action):
-    review = Review.query.get(review_id)
+    if current_app.config.get("VOTE_QUEUE_ENABLED"):
+        return queue_vote_on_review(review_id, staff_id, action)
+    review = apply_profile(Review.query, Review, "list").filter_by(id=review_id).with_for_update().first()
     staff= Staff.query.get(staff_id)
 
     if staff and review:
@@ -131,28 +197,160 @@ def vote_on_review(review_id, staff_id, action):
         elif (action=="downvote"):
             actionEnum=Action.DOWNVOTE
         else:
+            db.session.rollback()
             return("Invalid action")
-    #if ((action!="upvote")and(action!="downvote")):
-    #    return ('invalid action')
-    
-    #actionEnum= Action[action]
-    
-        #checking for removing a vote. Will remove if an upvote is upvoted or a downvote is downvoted again
-        vote= Vote.query.filter_by(staff_id=staff_id, review_id=review_id).first()
-        if vote: 
-            print("vote found")
-            if (((vote.value==Value.UPVOTE) and (actionEnum==Action.UPVOTE)) or ((vote.value==Value.DOWNVOTE) and (actionEnum==Action.DOWNVOTE))):
-                actionEnum=Action.REMOVE
-                print("Action changed to remove")
-
-        new_voteCommand= VoteCommand(staff_id, review_id,actionEnum)
-
-        db.session.add(new_voteCommand)
-        db.session.commit()
-        new_voteCommand.execute()
-        return new_voteCommand.to_json()
+
+        #VoteCommand.execute changes the action to remove if an upvote is upvoted or a downvote is downvoted again
+        try:
+            new_voteCommand= VoteCommand(staff_id, review_id,actionEnum)
+            db.session.add(new_voteCommand)
+            db.session.flush()
+            new_voteCommand.execute()
+            student_id= review.student_id
+            db.session.commit()
+            bump_review_version(review_id, student_id)
+            command= new_voteCommand.to_json()
+            count_vote_commands([command])
+            return command
+        except Exception as e:
+            print('Error voting on review', e)
+            db.session.rollback()
+            return ('Vote not applied')
     else:
+        db.session.rollback()
+        return ('Must have a Staff account to vote')
+
+
+# The most votes accepted in one batch, MAX_VOTE_BATCH_SIZE in the app config overrides it
+MAX_VOTE_BATCH_SIZE = 1000
+
+
+# Applies a batch of votes by one staff in a single transaction
+# votes is a list of {"review_id": id, "action": "upvote" or "downvote"}, applied in order with the same
+# toggling as vote_on_review, so a review upvoted twice in one batch ends with no vote
+# The reviews and the staff's current votes on them are read with one IN query each, and each review's
+# vote counts and karma are updated once for the whole batch
+# Returns the commands as json, or an error message if any entry is invalid, then no vote is applied
+def vote_on_reviews(staff_id, votes, max_size=MAX_VOTE_BATCH_SIZE):
+    staff= Staff.query.get(staff_id)
+    if not staff:
         return ('Must have a Staff account to vote')
+    if not isinstance(votes, list) or not votes:
+        return ("No votes given")
+    if len(votes) > max_size:
+        return (f"At most {max_size} votes per batch")
+
+    actions= {"upvote": Action.UPVOTE, "downvote": Action.DOWNVOTE}
+    entries= []
+    for index, vote in enumerate(votes):
+        if not isinstance(vote, dict) or vote.get("action") not in actions:
+            return (f"Invalid action in vote {index}")
+        try:
+            entries.append((int(vote.get("review_id")), actions[vote["action"]]))
+        except (TypeError, ValueError):
+            return (f"Invalid review_id in vote {index}")
+
+    review_ids= {review_id for review_id, action in entries}
+    reviews= _lock_reviews(review_ids)
+    missing= review_ids - reviews.keys()
+    if missing:
+        db.session.rollback()
+        return (f"Review {min(missing)} not found")
+
+    try:
+        applied= _apply_votes([(staff_id, review_id, action) for review_id, action in entries], reviews)
+        voted= _voted_reviews(reviews.values())
+        db.session.commit()
+        _bump_reviews(voted)
+        count_vote_commands(applied)
+        return applied
+    except Exception as e:
+        print('Error voting on reviews', e)
+        db.session.rollback()
+        return ('Votes not applied')
+
+
+# Loads and locks the reviews with the given ids, returned by id
+def _lock_reviews(review_ids):
+    reviews= (
+        apply_profile(Review.query, Review, "list")
+        .filter(Review.id.in_(review_ids))
+        .with_for_update()
+    )
+    return {review.id: review for review in reviews}
+
+
+# Applies (staff_id, review_id, action) votes in order, the reviews already locked and given by id
+# The current votes are read with one IN query, and each review's vote counts and karma are
+# updated once, nothing is committed
+# Returns the commands as json, in the same order
+def _apply_votes(votes, reviews):
+    pairs= {(staff_id, review_id) for staff_id, review_id, action in votes}
+    current= {
+        (staff_id, review_id): value
+        for staff_id, review_id, value in db.session.query(Vote.staff_id, Vote.review_id, Vote.value)
+        .filter(tuple_(Vote.staff_id, Vote.review_id).in_(pairs))
+    }
+    commands= [VoteCommand(staff_id, review_id, action) for staff_id, review_id, action in votes]
+    db.session.add_all(commands)
+    db.session.flush()
+
+    #apply the commands in order, carrying each vote from one command to the next
+    counts= defaultdict(lambda: [0, 0])
+    for command in commands:
+        pair= (command.staff_id, command.review_id)
+        upvotes, downvotes= command.apply(current.get(pair))
+        current[pair]= command.get_value()
+        counts[command.review_id][0] += upvotes
+        counts[command.review_id][1] += downvotes
+    for review_id, (upvotes, downvotes) in counts.items():
+        if (upvotes or downvotes):
+            reviews[review_id].add_votes(upvotes, downvotes)
+    #serialized before the commit expires the commands
+    return [command.to_json() for command in commands]
+
+
+# Returns the (review id, student id) of the reviews voted on, read before the commit expires them
+def _voted_reviews(reviews):
+    return {(review.id, review.student_id) for review in reviews}
+
+
+# Bumps the cached response versions of the reviews voted on, with their students
+def _bump_reviews(voted):
+    for review_id, student_id in voted:
+        bump_review_version(review_id, student_id)
+
+
+# Applies queued (staff_id, review_id, action) votes from any staff in one transaction, see voteQueue.py
+# Votes by an unknown staff or on a missing review are skipped
+# Returns one result per vote, the command as json or an error message
+def apply_queued_votes(votes):
+    staff_ids= {id for (id,) in db.session.query(Staff.id).filter(Staff.id.in_({vote[0] for vote in votes}))}
+    reviews= _lock_reviews({vote[1] for vote in votes})
+    valid= [vote for vote in votes if vote[0] in staff_ids and vote[1] in reviews]
+    try:
+        commands= _apply_votes(valid, reviews) if valid else []
+        voted= _voted_reviews(reviews[vote[1]] for vote in valid)
+        db.session.commit()
+        _bump_reviews(voted)
+        count_vote_commands(commands)
+        applied= iter(commands)
+    except Exception as e:
+        print('Error applying queued votes', e)
+        db.session.rollback()
+        return ['Vote not applied'] * len(votes)
+    return [
+        next(applied) if vote[0] in staff_ids and vote[1] in reviews else 'Must have a Staff account to vote'
+        for vote in votes
+    ]
+
+
+vote_queue= VoteQueue(apply_queued_votes)
+
+
+# Gets the status of a vote queued while VOTE_QUEUE_ENABLED is set, given its ticket
+def get_queued_vote_status(ticket):
+    return vote_queue.status(ticket)
 
 
 # Gets all votes for a review given the review id
@@ -171,7 +369,34 @@ def get_review_karma(id):
     if review:
         return review.get_karma()
     return None
-        
-
 
 
+# Rebuilds the stored upvote and downvote counts of every review from the vote table
+# Reviews are processed in chunks of chunk_size ids, with one commit per chunk
+# Returns the number of reviews whose counts had drifted
+def recount_review_votes(chunk_size=500):
+    fixed = 0
+    last_id = 0
+    while True:
+        reviews = Review.query.filter(Review.id > last_id).order_by(Review.id).limit(chunk_size).all()
+        if not reviews:
+            if fixed:
+                bump_all_versions()
+            return fixed
+        counts = {}
+        rows = (
+            db.session.query(Vote.review_id, Vote.value, func.count(Vote.id))
+            .filter(Vote.review_id.in_([review.id for review in reviews]))
+            .group_by(Vote.review_id, Vote.value)
+        )
+        for review_id, value, count in rows:
+            counts[(review_id, value)] = count
+        for review in reviews:
+            num_upvotes = counts.get((review.id, Value.UPVOTE), 0)
+            num_downvotes = counts.get((review.id, Value.DOWNVOTE), 0)
+            if review.num_upvotes != num_upvotes or review.num_downvotes != num_downvotes:
+                review.num_upvotes = num_upvotes
+                review.num_downvotes = num_downvotes
+                fixed += 1
+        last_id = reviews[-1].id
+        db.session.commit()
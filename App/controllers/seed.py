@@ -0,0 +1,284 @@
+import random
+from bisect import bisect
+from itertools import accumulate
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, text
+from App.database import db, create_indexes
+from App.models import Student, Review, Staff, User, Vote, VoteCommand
+from App.models.vote import Value
+from App.models.voteCommand import Action
+from App.hashing import password_hasher
+from App.controllers.autocomplete import build_student_index
+from App.cache import bump_all_versions
+
+# Synthetic data generator for scale testing
+# Adds staff, students, their reviews and the vote commands and votes on those reviews, the same
+# data for the same seed. Rows are written with one bulk INSERT per table per batch of students,
+# with their ids given up front so no row has to be read back, and one commit per batch.
+# The stored review vote counts and student karma are worked out while generating, so the seeded
+# data agrees with recount_review_votes, recount_student_karma and verify_votes.
+# The indexes of the review, voteCommand and vote tables are dropped while seeding and built again
+# at the end, building an index once from all the rows is several times faster than updating it
+# for every row inserted in random key order.
+# Meant for an otherwise idle database, rows added by others while seeding may take the same ids.
+
+DEFAULT_SEED_BATCH_SIZE = 2000
+SEED_PASSWORD = "seedpass"
+# Days over which the seeded vote commands were cast, up to now
+SEED_VOTE_DAYS = 180
+
+FIRST_NAMES = [
+    "Aaliyah", "Aaron", "Adrian", "Aisha", "Alana", "Alicia", "Amir", "Anika", "Anthony", "Arjun",
+    "Brandon", "Brianna", "Carlos", "Chloe", "Daniel", "Darius", "Deepa", "Devon", "Elena", "Emmanuel",
+    "Fatima", "Gabriel", "Giselle", "Hannah", "Imran", "Isaiah", "Jada", "Jason", "Jovan", "Kavita",
+    "Keisha", "Kevin", "Krystal", "Leon", "Lisa", "Marcus", "Maya", "Michael", "Nadia", "Naomi",
+    "Nathan", "Nicole", "Omar", "Priya", "Rajesh", "Renee", "Ryan", "Samantha", "Sanjay", "Sarah",
+    "Shane", "Shivani", "Tariq", "Tiana", "Tristan", "Vanessa", "Vishal", "Wendell", "Yasmin", "Zara",
+]
+LAST_NAMES = [
+    "Ali", "Baptiste", "Boodram", "Charles", "Chen", "Clarke", "Daniel", "Edwards", "Francis", "Garcia",
+    "George", "Gopaul", "Hosein", "James", "John", "Joseph", "Khan", "Lewis", "Lopez", "Maharaj",
+    "Mohammed", "Noel", "Persad", "Phillip", "Ramdass", "Ramkissoon", "Rampersad", "Richards", "Roberts",
+    "Samuel", "Singh", "Smith", "Thomas", "Walcott", "Williams", "Wong",
+]
+# Faculties with their programmes, students are spread over them unevenly
+FACULTIES = {
+    "FST": ["Computer Science", "Information Technology", "Mathematics", "Physics", "Chemistry", "Biology"],
+    "FOE": ["Civil Engineering", "Electrical Engineering", "Mechanical Engineering", "Chemical Engineering"],
+    "FSS": ["Economics", "Management Studies", "Psychology", "Sociology", "Political Science"],
+    "FHE": ["History", "Literatures in English", "Modern Languages", "Philosophy"],
+    "FMS": ["Medicine", "Nursing", "Pharmacy", "Dentistry"],
+    "FOL": ["Law"],
+}
+FACULTY_WEIGHTS = [30, 20, 25, 10, 10, 5]
+# Share of the reviews given each rating from 1 to 10, most are positive with a smaller bump of bad ones
+RATING_WEIGHTS = [5, 3, 4, 6, 10, 12, 16, 20, 15, 9]
+REVIEW_TEXTS = {
+    "negative": ["Disruptive in class", "Rarely submits work on time", "Needs to show more respect to others",
+                 "Frequently absent from labs", "Copied an assignment"],
+    "neutral": ["Average performance this term", "Quiet, does what is asked", "Attendance could be better"],
+    "positive": ["Excellent participation", "Always helps classmates", "Top of the class this term",
+                 "Very hard working", "Great project work", "Asks thoughtful questions"],
+}
+# Vote popularity: the votes a review gets follow a Pareto distribution with this shape, so most
+# reviews get none and a few get votes from a large share of the staff
+VOTE_POPULARITY_SHAPE = 1.2
+# How the votes of a staff on a review came about: voted once, switched their vote, took it back,
+# or took it back and voted again, each with its share of the staff and review pairs
+VOTE_HISTORIES = [(0.70, "once"), (0.15, "switched"), (0.10, "removed"), (0.05, "revoted")]
+
+
+#picks an index given the running totals of the weights, random.choices builds them on every call
+def _weighted(rng, totals):
+    return bisect(totals, rng.random() * totals[-1])
+
+
+def _review_text(rng, rating):
+    if rating < 5:
+        return rng.choice(REVIEW_TEXTS["negative"])
+    if rating == 5:
+        return rng.choice(REVIEW_TEXTS["neutral"])
+    return rng.choice(REVIEW_TEXTS["positive"])
+
+
+#the same karma as Review.get_karma, from the review's rating and vote counts
+def _review_karma(rating, upvotes, downvotes):
+    base = rating if rating >= 5 else rating - 10
+    weight = 1 if rating == 5 else rating - 5
+    return base + weight * (upvotes - downvotes)
+
+
+def _vote_history(rng):
+    pick = rng.random()
+    for share, history in VOTE_HISTORIES:
+        if pick < share:
+            return history
+        pick -= share
+    return VOTE_HISTORIES[0][1]
+
+
+# The staff ids reviewing one student, some staff write far more reviews than others
+def _reviewers(rng, staff_ids, count):
+    if count * 2 > len(staff_ids):
+        return rng.sample(staff_ids, count)
+    chosen = set()
+    while len(chosen) < count:
+        chosen.add(staff_ids[int(len(staff_ids) * rng.random() ** 2)])
+    return list(chosen)
+
+
+# The tables that get the most rows, their indexes are built after seeding
+SEED_BULK_MODELS = (Review, VoteCommand, Vote)
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+#explicit ids leave the Postgres sequences behind, move them past the seeded rows
+def _reset_id_sequences():
+    if db.engine.dialect.name != "postgresql":
+        return
+    for model in (User, Student, Review, VoteCommand, Vote):
+        table = model.__table__.name
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), coalesce(max(id), 0) + 1, false) FROM \"{table}\""
+        ))
+    db.session.commit()
+
+
+class _Seeder:
+
+    def __init__(self, seed, staff_ids, vote_density):
+        self.rng = random.Random(seed)
+        self.staff_ids = staff_ids
+        #the mean of a Pareto variate is shape / (shape - 1), scaled so a review gets vote_density votes on average
+        self.vote_scale = vote_density * (VOTE_POPULARITY_SHAPE - 1) / VOTE_POPULARITY_SHAPE
+        self.now = datetime.utcnow()
+        self.next_review = _next_id(Review)
+        self.next_command = _next_id(VoteCommand)
+        self.next_vote = _next_id(Vote)
+        self.next_school_id = (db.session.query(func.max(Student.school_id)).scalar() or 816000000) + 1
+        self.programmes = [(faculty, programme) for faculty, programmes in FACULTIES.items() for programme in programmes]
+        self.programme_totals = list(accumulate(
+            weight / len(FACULTIES[faculty]) for faculty, weight in zip(FACULTIES, FACULTY_WEIGHTS)
+            for programme in FACULTIES[faculty]
+        ))
+        self.rating_totals = list(accumulate(RATING_WEIGHTS))
+
+    def student(self, id):
+        rng = self.rng
+        faculty, programme = self.programmes[_weighted(rng, self.programme_totals)]
+        student = {
+            "id": id,
+            "school_id": self.next_school_id,
+            "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            "faculty": faculty,
+            "programme": programme,
+            "karma": 0,
+        }
+        self.next_school_id += 1
+        return student
+
+    # Adds the commands of one staff on one review, and the vote they leave if any
+    # Returns the change in the review's upvotes and downvotes
+    def vote(self, staff_id, review_id, rating, commands, votes):
+        rng = self.rng
+        #better reviews get more upvotes
+        value = Action.UPVOTE if rng.random() < 0.35 + 0.05 * rating else Action.DOWNVOTE
+        other = Action.DOWNVOTE if value == Action.UPVOTE else Action.UPVOTE
+        actions = {
+            "once": [value],
+            "switched": [other, value],
+            "removed": [value, Action.REMOVE],
+            "revoted": [value, Action.REMOVE, value],
+        }[_vote_history(rng)]
+        created = self.now - timedelta(days=SEED_VOTE_DAYS * rng.random())
+        for action in actions:
+            commands.append({
+                "id": self.next_command,
+                "staff_id": staff_id,
+                "review_id": review_id,
+                "action": action,
+                "created": min(created, self.now),
+            })
+            self.next_command += 1
+            created += timedelta(hours=48 * rng.random())
+        if actions[-1] == Action.REMOVE:
+            return 0, 0
+        votes.append({
+            "id": self.next_vote,
+            "staff_id": staff_id,
+            "review_id": review_id,
+            "vote_command_id": self.next_command - 1,
+            "value": Value.UPVOTE if value == Action.UPVOTE else Value.DOWNVOTE,
+        })
+        self.next_vote += 1
+        return (1, 0) if value == Action.UPVOTE else (0, 1)
+
+    # Generates the reviews of a student with their vote commands and votes
+    def reviews(self, student, reviews_per_student, reviews, commands, votes):
+        rng = self.rng
+        count = min(rng.randint(0, 2 * reviews_per_student), len(self.staff_ids))
+        for staff_id in _reviewers(rng, self.staff_ids, count):
+            rating = _weighted(rng, self.rating_totals) + 1
+            review = {
+                "id": self.next_review,
+                "staff_id": staff_id,
+                "student_id": student["id"],
+                "text": _review_text(rng, rating),
+                "rating": rating,
+                "num_upvotes": 0,
+                "num_downvotes": 0,
+            }
+            self.next_review += 1
+            voters = min(int(rng.paretovariate(VOTE_POPULARITY_SHAPE) * self.vote_scale + rng.random()), len(self.staff_ids))
+            for voter in rng.sample(self.staff_ids, voters) if voters else ():
+                upvotes, downvotes = self.vote(voter, review["id"], rating, commands, votes)
+                review["num_upvotes"] += upvotes
+                review["num_downvotes"] += downvotes
+            student["karma"] += _review_karma(rating, review["num_upvotes"], review["num_downvotes"])
+            reviews.append(review)
+
+
+# Adds staff, students with about reviews_per_student reviews each, and votes on the reviews
+# vote_density is the average number of votes per review, most of them on a few popular reviews
+# Every seeded staff has the password SEED_PASSWORD and a username made from the seed, so
+# seeding again needs another seed. The rows are the same for the same seed and database.
+# Writes batch_size students with everything about them per transaction
+# Returns the number of rows added to each table, or None if the staff usernames are taken
+def seed_database(students, staff, reviews_per_student, vote_density, seed=0, batch_size=DEFAULT_SEED_BATCH_SIZE):
+    usernames = [f"seed{seed}-staff{number}" for number in range(1, staff + 1)]
+    if staff and User.query.filter(User.username.in_(usernames[:1] + usernames[-1:])).first():
+        print(f"Staff of seed {seed} already exist")
+        return None
+    report = {"staff": staff, "students": 0, "reviews": 0, "vote_commands": 0, "votes": 0}
+    try:
+        #one hash shared by every seeded staff, hashing each password would take longer than the rest
+        password = password_hasher.hash(SEED_PASSWORD)
+        first_staff = _next_id(User)
+        staff_ids = list(range(first_staff, first_staff + staff))
+        for start in range(0, staff, batch_size):
+            db.session.execute(User.__table__.insert(), [
+                {"id": id, "username": username, "password": password, "access": "staff", "token_version": 0}
+                for id, username in zip(staff_ids[start:start + batch_size], usernames[start:start + batch_size])
+            ])
+        db.session.commit()
+        staff_ids = staff_ids or [id for (id,) in db.session.query(Staff.id).order_by(Staff.id)]
+        if not staff_ids:
+            print("There is no staff to write the reviews")
+            reviews_per_student = 0
+
+        seeder = _Seeder(seed, staff_ids, vote_density)
+        next_student = _next_id(Student)
+        for model in SEED_BULK_MODELS:
+            for index in model.__table__.indexes:
+                index.drop(bind=db.session.connection(), checkfirst=True)
+        db.session.commit()
+        for start in range(0, students, batch_size):
+            batch, reviews, commands, votes = [], [], [], []
+            for id in range(next_student + start, next_student + min(start + batch_size, students)):
+                student = seeder.student(id)
+                if reviews_per_student:
+                    seeder.reviews(student, reviews_per_student, reviews, commands, votes)
+                batch.append(student)
+            for model, rows in ((Student, batch), (Review, reviews), (VoteCommand, commands), (Vote, votes)):
+                if rows:
+                    db.session.execute(model.__table__.insert(), rows)
+            db.session.commit()
+            report["students"] += len(batch)
+            report["reviews"] += len(reviews)
+            report["vote_commands"] += len(commands)
+            report["votes"] += len(votes)
+        _reset_id_sequences()
+    except Exception as e:
+        print("Error seeding the database", e)
+        db.session.rollback()
+        return None
+    finally:
+        create_indexes(current_app)
+
+    build_student_index()
+    bump_all_versions()
+    return report
@@ -1,6 +1,26 @@
+import csv, re
 from flask import jsonify
-from App.database import db
-from App.models import Student, Admin
+from sqlalchemy import or_, text
+from sqlalchemy.exc import OperationalError
+from App.database import db, STUDENT_SEARCH_DOCUMENT
+from App.models import Student, Admin, Review
+from App.controllers.karma import (
+    review_listing_query,
+    review_row_to_json,
+    student_listing_query,
+    student_row_to_json,
+)
+from App.controllers.pagination import get_page, DEFAULT_PAGE_SIZE
+from App.controllers.loading import apply_profile
+from App.controllers.vote import delete_review_votes
+from App.controllers.autocomplete import index_student, unindex_student, build_student_index
+from App.cache import bump_student_version, bump_review_version, bump_all_versions
+
+# The columns a student roster CSV must have
+STUDENT_IMPORT_FIELDS = ("school_id", "name", "programme", "faculty")
+DEFAULT_IMPORT_BATCH_SIZE = 1000
+# The most row errors kept in an import report, the rest are only counted
+MAX_IMPORT_ERRORS = 1000
 
 # Creates a new student given their name, programme and faculty
 # Commits the student to the database and returns the student
@@ -8,10 +28,105 @@ def create_student(admin_id, name,school_id, programme, faculty):
     admin= Admin.query.get(admin_id)
     if admin:
         try:
-            return admin.create_student(name=name,school_id=school_id,programme=programme,faculty=faculty)
+            student = admin.create_student(name=name,school_id=school_id,programme=programme,faculty=faculty)
         except:
             print("Student not created")
             return None
+        if student:
+            index_student(student)
+            bump_student_version(student.id)
+        return student
+
+
+# Checks one row of a student roster and returns it as a student mapping
+# Raises ValueError describing the first problem with the row
+def _student_from_row(row):
+    missing = [field for field in STUDENT_IMPORT_FIELDS if not (row.get(field) or "").strip()]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    try:
+        student = {"school_id": int(row["school_id"])}
+    except ValueError:
+        raise ValueError("school_id must be a number")
+    for field in ("name", "programme", "faculty"):
+        value = row[field].strip()
+        if len(value) > 100:
+            raise ValueError(f"{field} is longer than 100 characters")
+        student[field] = value
+    return student
+
+
+# Writes a batch of roster students, keyed by school id, in one transaction
+# Students whose school id exists are updated, the others are inserted, with one bulk statement each
+# Returns the number of students created and updated
+def _import_student_batch(batch):
+    existing = dict(
+        db.session.query(Student.school_id, Student.id).filter(Student.school_id.in_(batch))
+    )
+    new = [dict(student, karma=0) for school_id, student in batch.items() if school_id not in existing]
+    updated = [dict(student, id=existing[school_id]) for school_id, student in batch.items() if school_id in existing]
+    db.session.bulk_insert_mappings(Student, new)
+    db.session.bulk_update_mappings(Student, updated)
+    db.session.commit()
+    return len(new), len(updated)
+
+
+# Imports students from a CSV roster with the columns school_id, name, programme and faculty
+# lines is read one line at a time, e.g. an open file, so the roster is never held in memory
+# Students are written in batches of batch_size with one commit per batch, and a student whose
+# school id already exists is updated instead of added again
+# Returns a report of the students created and updated and the rows skipped with their errors,
+# or None if the admin does not exist
+def import_students(admin_id, lines, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    admin = Admin.query.get(admin_id)
+    if not admin:
+        return None
+    report = {"created": 0, "updated": 0, "skipped": 0, "errors": []}
+
+    def add_error(row, error):
+        report["skipped"] += 1
+        if len(report["errors"]) < MAX_IMPORT_ERRORS:
+            report["errors"].append({"row": row, "error": error})
+
+    reader = csv.DictReader(lines)
+    missing = [field for field in STUDENT_IMPORT_FIELDS if field not in (reader.fieldnames or [])]
+    if missing:
+        add_error(1, f"missing columns {', '.join(missing)}")
+        return report
+
+    batch = {}
+    rows = []
+    def write_batch():
+        try:
+            created, updated = _import_student_batch(batch)
+            report["created"] += created
+            report["updated"] += updated
+        except Exception as e:
+            print("Error importing students", e)
+            db.session.rollback()
+            for row in rows:
+                add_error(row, "not imported, the batch failed")
+        batch.clear()
+        rows.clear()
+
+    for row in reader:
+        try:
+            student = _student_from_row(row)
+        except ValueError as e:
+            add_error(reader.line_num, str(e))
+            continue
+        #a school id repeated in the roster is imported once, with its last row
+        batch[student["school_id"]] = student
+        rows.append(reader.line_num)
+        if len(batch) >= batch_size:
+            write_batch()
+    if batch:
+        write_batch()
+
+    if report["created"] or report["updated"]:
+        build_student_index()
+        bump_all_versions()
+    return report
 
 
 # Gets a student by their name
@@ -29,17 +144,79 @@ def get_student_by_school_id(school_id):
     return Student.query.filter_by(school_id=school_id).first()
 
 
+# Searches students by name, programme, faculty and school id
+# Every word of the query must match the start of a word in one of those fields
+# Returns one page of matching students, best matches first and each student once
+def search_students(query, page=1, limit=DEFAULT_PAGE_SIZE):
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return []
+    offset = (max(page, 1) - 1) * limit
+    if db.engine.dialect.name == "postgresql":
+        statement = text(
+            "SELECT student.* FROM student "
+            f"WHERE to_tsvector('simple', {STUDENT_SEARCH_DOCUMENT}) @@ to_tsquery('simple', :match) "
+            f"ORDER BY ts_rank(to_tsvector('simple', {STUDENT_SEARCH_DOCUMENT}), to_tsquery('simple', :match)) DESC, "
+            "student.id LIMIT :limit OFFSET :offset"
+        )
+        match = " & ".join(f"{word}:*" for word in words)
+    else:
+        statement = text(
+            "SELECT student.* FROM student_search JOIN student ON student.id = student_search.rowid "
+            "WHERE student_search MATCH :match ORDER BY bm25(student_search), student.id "
+            "LIMIT :limit OFFSET :offset"
+        )
+        match = " ".join(f'"{word}"*' for word in words)
+    try:
+        return (
+            db.session.query(Student)
+            .from_statement(statement)
+            .params(match=match, limit=limit, offset=offset)
+            .all()
+        )
+    except OperationalError as e:
+        #SQLite without FTS5 has no search table, fall back to matching the start of each field
+        print("Error searching students", e)
+        db.session.rollback()
+        students = Student.query
+        for word in words:
+            students = students.filter(or_(
+                Student.name.ilike(f"{word}%"),
+                Student.programme.ilike(f"{word}%"),
+                Student.faculty.ilike(f"{word}%"),
+                db.cast(Student.school_id, db.String).like(f"{word}%"),
+            ))
+        return students.order_by(Student.id).limit(limit).offset(offset).all()
+
+
 # Gets all students in the database
-def get_all_students():
-    return Student.query.all()
+# profile is the loading profile for the students' relationships, see App/controllers/loading.py
+def get_all_students(profile="list"):
+    return apply_profile(Student.query, Student, profile).all()
 
 
 # Gets all students in the database and returns them as a JSON object
+# The karma of every student is their stored karma
 def get_all_students_json():
-    students = Student.query.all()
-    if not students:
-        return []
-    return [student.to_json() for student in students]
+    return [student_row_to_json(row) for row in student_listing_query()]
+
+
+# Returns one page of students ordered by id, starting after the student id after
+# Returns the students and the cursor for the next page, None if it is the last page
+def get_students_page(after=None, limit=DEFAULT_PAGE_SIZE, profile="list"):
+    return get_page(apply_profile(Student.query, Student, profile), Student.id, after, limit)
+
+
+# Returns one page of students as json, with their stored karma
+def get_students_page_json(after=None, limit=DEFAULT_PAGE_SIZE):
+    rows, next_cursor = get_page(student_listing_query(), Student.id, after, limit)
+    return [student_row_to_json(row) for row in rows], next_cursor
+
+
+# Yields every student as json, reading chunk_size rows from the database at a time
+def stream_students_json(chunk_size=1000):
+    for row in student_listing_query().yield_per(chunk_size):
+        yield student_row_to_json(row)
 
 
 # Gets all reviews for a student given their id.
@@ -48,7 +225,8 @@ def get_all_student_reviews(id):
     student = Student.query.get(id)
     if not student:
         return {"error": "student not found"}, 404
-    return [review.to_json() for review in student.reviews], 200
+    reviews = review_listing_query().filter(Review.student_id == id)
+    return [review_row_to_json(row) for row in reviews], 200
 
 
 # Updates a student given their id, name, programme and faculty
@@ -56,7 +234,11 @@ def update_student(admin_id, student_id, name,school_id, programme, faculty):
     student = Student.query.get(student_id)
     admin= Admin.query.get(admin_id)
     if student and admin:
-        return admin.update_student(student, name, school_id, programme, faculty) #??COME BACK AND FIX
+        student = admin.update_student(student, name, school_id, programme, faculty) #??COME BACK AND FIX
+        if student:
+            index_student(student)
+            bump_student_version(student_id)
+        return student
     return False
 
 # Deletes a student given their id
@@ -64,7 +246,42 @@ def delete_student(student_id, admin_id):
     student = get_student(student_id)
     admin= Admin.query.get(admin_id)
     if student and admin:
+        review_ids = [review.id for review in student.reviews]
+        delete_review_votes(student.reviews)
         db.session.delete(student)
         db.session.commit()
+        unindex_student(student_id)
+        bump_student_version(student_id)
+        for review_id in review_ids:
+            bump_review_version(review_id, student_id)
         return None
     return None
+
+
+# Rebuilds the stored karma of every student from their reviews
+# The review vote counts should be recounted first if they may have drifted
+# Students are processed in chunks of chunk_size ids, with one commit per chunk
+# Returns the number of students whose karma had drifted
+def recount_student_karma(chunk_size=500):
+    fixed = 0
+    last_id = 0
+    while True:
+        students = (
+            apply_profile(Student.query, Student, "detail")
+            .filter(Student.id > last_id)
+            .order_by(Student.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not students:
+            if fixed:
+                bump_all_versions()
+                build_student_index()
+            return fixed
+        for student in students:
+            karma = student.compute_karma()
+            if student.karma != karma:
+                student.karma = karma
+                fixed += 1
+        last_id = students[-1].id
+        db.session.commit()
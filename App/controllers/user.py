@@ -1,5 +1,6 @@
 from App.models import User, Staff, Admin
 from App.database import db
+from App.controllers.auth import invalidate_identity, revoke_tokens
 
 
 # Creates a new admin given their username and password
@@ -10,6 +11,8 @@ def create_admin(username, password):
         db.session.commit()
         return new_admin
     except:
+        #the username is taken, by a staff or another admin
+        db.session.rollback()
         return None
 
 
@@ -21,6 +24,8 @@ def create_staff(username, password):
         db.session.commit()
         return new_staff
     except:
+        #the username is taken, by an admin or another staff
+        db.session.rollback()
         return None
 
 
@@ -32,6 +37,8 @@ def create_staff(username, password):
         db.session.commit()
         return new_staff
     except:
+        #the username is taken, by an admin or another staff
+        db.session.rollback()
         return None
 
 
@@ -65,6 +72,11 @@ def get_staff(id):
     return Staff.query.get(id)
 
 
+# Gets a staff or admin by their id
+def get_user(id):
+    return User.query.get(id)
+
+
 # Gets all users that have a certain access level
 def get_users_by_access(access):
     return User.query.filter_by(access=access).all()
@@ -109,13 +121,19 @@ def get_all_staff_json():
     return [staff.to_json() for staff in staffs]
 
 
-# Updates a user's username given their id and username
-def update_user(id, username):
+# Updates a user's username given their id and username, and their password if one is given
+# A new password revokes the user's tokens
+def update_user(id, username, password=None):
     user = get_user(id)
     if user:
         user.username = username
+        if password is not None:
+            user.set_password(password)
+            user.token_version = (user.token_version or 0) + 1
         db.session.add(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
 
 
@@ -124,7 +142,9 @@ def update_admin(id, username):
     if user:
         user.username = username
         db.session.add(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
 
 def update_staff(id, username):
@@ -132,7 +152,9 @@ def update_staff(id, username):
     if user:
         user.username = username
         db.session.add(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
 
 
@@ -141,19 +163,34 @@ def delete_user(id):
     user = get_user(id)
     if user:
         db.session.delete(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
 
 def delete_admin(id):
     user = get_admin(id)
     if user:
         db.session.delete(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
 
 def delete_staff(id):
     user = get_staff(id)
     if user:
         db.session.delete(user)
-        return db.session.commit()
+        db.session.commit()
+        invalidate_identity(id)
+        return None
     return None
+
+
+# Revokes every token of the staff or admin with the given username, e.g. when a token leaked
+# Returns False if there is no such user
+def revoke_user_tokens(username):
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        return False
+    return revoke_tokens(user.access, user.id)
@@ -1,5 +1,5 @@
 from App.database import db
-from App.models import Vote
+from App.models import Vote, VoteCommand
 from App.models.vote import Value
 
 # Get all votes for a review, given the review id
@@ -27,3 +27,15 @@ def get_vote_by_staff(review_id, staff_id):
             return vote
     return None
 
+
+# Deletes the votes and vote commands of reviews that are about to be deleted
+# Commands left behind would break their foreign key, and replaying the log would give their votes
+# to a new review reusing the id
+def delete_review_votes(reviews):
+    review_ids = [review.id for review in reviews]
+    if review_ids:
+        db.session.execute(Vote.__table__.delete().where(Vote.review_id.in_(review_ids)))
+        db.session.execute(VoteCommand.__table__.delete().where(VoteCommand.review_id.in_(review_ids)))
+    #the deleted votes must not be deleted again by the review's cascade
+    for review in reviews:
+        db.session.expire(review, ["votes"])
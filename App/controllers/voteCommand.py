@@ -1,3 +1,207 @@
+import gzip, json
+from datetime import datetime, timedelta
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import aliased
 from App.database import db
-from App.models import voteCommand
+from App.models import Review, Staff, Vote, VoteCommand, VoteSnapshot, VoteSnapshotVote
+from App.models.vote import Value
 from App.models.voteCommand import Action
+from App.controllers.review import recount_review_votes
+from App.controllers.student import recount_student_karma
+from App.cache import bump_all_versions
+
+# Replay engine for the voteCommand log
+# Every command is stored with the action it ended up applying, a repeated vote being stored as a remove,
+# so replaying the commands in id order gives the state of every vote without reading the vote table.
+# Replays start from the latest snapshot, so only the commands since then are read.
+
+
+# Gets the latest snapshot, or the latest taken at or before the command id since
+def get_latest_vote_snapshot(since=None):
+    snapshots = VoteSnapshot.query
+    if since is not None:
+        snapshots = snapshots.filter(VoteSnapshot.command_id <= since)
+    return snapshots.order_by(VoteSnapshot.command_id.desc(), VoteSnapshot.id.desc()).first()
+
+
+# Replays the voteCommand log from the latest snapshot, or the latest at or before the command id since
+# Votes on deleted reviews or by deleted staff are left out
+# Returns the state of every vote as {(staff_id, review_id): (value, vote_command_id)} and a report
+# of the snapshot started from, the last command replayed and the number of commands replayed
+def replay_votes(since=None, chunk_size=1000):
+    snapshot = get_latest_vote_snapshot(since)
+    state = {}
+    last_id = 0
+    if snapshot:
+        votes = (
+            db.session.query(VoteSnapshotVote.staff_id, VoteSnapshotVote.review_id, VoteSnapshotVote.value, VoteSnapshotVote.vote_command_id)
+            .filter(VoteSnapshotVote.snapshot_id == snapshot.id)
+        )
+        state = {(staff_id, review_id): (value, command_id) for staff_id, review_id, value, command_id in votes.yield_per(chunk_size)}
+        last_id = snapshot.command_id
+    report = {"snapshot": snapshot.id if snapshot else None, "from_command": last_id, "replayed": 0}
+
+    values = {Action.UPVOTE: Value.UPVOTE, Action.DOWNVOTE: Value.DOWNVOTE}
+    commands = (
+        db.session.query(VoteCommand.id, VoteCommand.staff_id, VoteCommand.review_id, VoteCommand.action)
+        .filter(VoteCommand.id > last_id)
+        .order_by(VoteCommand.id)
+    )
+    for id, staff_id, review_id, action in commands.yield_per(chunk_size):
+        if action == Action.REMOVE:
+            state.pop((staff_id, review_id), None)
+        else:
+            state[(staff_id, review_id)] = (values[action], id)
+        last_id = id
+        report["replayed"] += 1
+    report["to_command"] = last_id
+
+    reviews = {id for (id,) in db.session.query(Review.id)}
+    staff = {id for (id,) in db.session.query(Staff.id)}
+    state = {pair: vote for pair, vote in state.items() if pair[0] in staff and pair[1] in reviews}
+    report["votes"] = len(state)
+    return state, report
+
+
+# Compares the vote table with a replayed state
+# Returns the pairs missing from the table, the rows whose value or command differ as update mappings,
+# and the ids of the rows that should not exist
+def diff_votes(state, chunk_size=1000):
+    seen = set()
+    changed = []
+    extra = []
+    votes = db.session.query(Vote.id, Vote.staff_id, Vote.review_id, Vote.value, Vote.vote_command_id)
+    for id, staff_id, review_id, value, vote_command_id in votes.yield_per(chunk_size):
+        expected = state.get((staff_id, review_id))
+        if expected is None:
+            extra.append(id)
+            continue
+        seen.add((staff_id, review_id))
+        if expected != (value, vote_command_id):
+            changed.append({"id": id, "value": expected[0], "vote_command_id": expected[1]})
+    missing = [pair for pair in state if pair not in seen]
+    return missing, changed, extra
+
+
+# Checks the vote table against the voteCommand log without changing anything
+# Returns the replay report with the number of missing, changed and extra votes, all 0 if they agree
+def verify_votes(since=None, chunk_size=1000):
+    state, report = replay_votes(since, chunk_size)
+    missing, changed, extra = diff_votes(state, chunk_size)
+    report.update({"missing": len(missing), "changed": len(changed), "extra": len(extra)})
+    return report
+
+
+# Rebuilds the vote table from the voteCommand log, then the review vote counts and student karma
+# Only the votes that differ from the log are written, in one transaction
+# Meant for recovery with voting paused, votes cast during a rebuild may be recounted wrongly
+# Returns the verify report of the votes fixed, with the number of reviews and students recounted
+def rebuild_votes(since=None, chunk_size=1000):
+    state, report = replay_votes(since, chunk_size)
+    missing, changed, extra = diff_votes(state, chunk_size)
+    try:
+        for start in range(0, len(extra), chunk_size):
+            db.session.execute(Vote.__table__.delete().where(Vote.id.in_(extra[start:start + chunk_size])))
+        db.session.bulk_update_mappings(Vote, changed)
+        db.session.bulk_insert_mappings(Vote, [
+            {"staff_id": staff_id, "review_id": review_id, "value": state[(staff_id, review_id)][0],
+             "vote_command_id": state[(staff_id, review_id)][1]}
+            for staff_id, review_id in missing
+        ])
+        db.session.commit()
+    except Exception as e:
+        print("Error rebuilding votes", e)
+        db.session.rollback()
+        return None
+    report.update({"missing": len(missing), "changed": len(changed), "extra": len(extra)})
+    report["reviews_recounted"] = recount_review_votes(chunk_size)
+    report["students_recounted"] = recount_student_karma(chunk_size)
+    bump_all_versions()
+    return report
+
+
+# Takes a snapshot of the state of every vote as of the latest command, replayed from the last snapshot
+# The votes are written chunk_size rows at a time, with the snapshot in one transaction
+# Returns the new snapshot, or the latest one if no command was logged since
+def take_vote_snapshot(chunk_size=1000):
+    state, report = replay_votes(chunk_size=chunk_size)
+    latest = get_latest_vote_snapshot()
+    if latest and latest.command_id == report["to_command"]:
+        return latest
+    try:
+        snapshot = VoteSnapshot(report["to_command"], len(state))
+        db.session.add(snapshot)
+        db.session.flush()
+        votes = [
+            {"snapshot_id": snapshot.id, "staff_id": staff_id, "review_id": review_id, "value": value, "vote_command_id": command_id}
+            for (staff_id, review_id), (value, command_id) in state.items()
+        ]
+        for start in range(0, len(votes), chunk_size):
+            db.session.execute(VoteSnapshotVote.__table__.insert(), votes[start:start + chunk_size])
+        db.session.commit()
+    except Exception as e:
+        print("Error taking vote snapshot", e)
+        db.session.rollback()
+        return None
+    return snapshot
+
+
+DEFAULT_VOTE_COMMAND_RETENTION_DAYS = 30
+
+
+# Moves superseded vote commands older than the retention window to a gzipped JSON lines archive
+# A command is superseded once a later command exists for the same staff and review, so the latest
+# command of every pair is kept, as is any command a vote points to, and replays give the same votes
+# A command without a created time is older than any cutoff
+# Commands are archived in chunks of chunk_size, each written to the archive before its own short
+# delete transaction, so a crash can repeat rows in the archive but never lose them
+# Returns the number of commands archived and the time commands had to be older than
+def compact_vote_commands(archive_path, retention_days=DEFAULT_VOTE_COMMAND_RETENTION_DAYS, chunk_size=1000, now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    report = {"archived": 0, "cutoff": cutoff.isoformat()}
+    later = aliased(VoteCommand)
+    superseded = exists().where(and_(
+        later.staff_id == VoteCommand.staff_id,
+        later.review_id == VoteCommand.review_id,
+        later.id > VoteCommand.id,
+    ))
+    voted = exists().where(and_(
+        Vote.staff_id == VoteCommand.staff_id,
+        Vote.review_id == VoteCommand.review_id,
+        Vote.vote_command_id == VoteCommand.id,
+    ))
+    last_id = 0
+    with gzip.open(archive_path, "at", encoding="utf-8") as archive:
+        while True:
+            commands = (
+                db.session.query(VoteCommand.id, VoteCommand.staff_id, VoteCommand.review_id, VoteCommand.action, VoteCommand.created)
+                .filter(VoteCommand.id > last_id, or_(VoteCommand.created < cutoff, VoteCommand.created.is_(None)), superseded, ~voted)
+                .order_by(VoteCommand.id)
+                .limit(chunk_size)
+                .all()
+            )
+            if not commands:
+                db.session.commit()
+                return report
+            for id, staff_id, review_id, action, created in commands:
+                archive.write(json.dumps({
+                    "id": id, "staff_id": staff_id, "review_id": review_id,
+                    "action": action.value, "created": created.isoformat() if created else None,
+                }) + "\n")
+            archive.flush()
+            ids = [command.id for command in commands]
+            db.session.execute(VoteCommand.__table__.delete().where(VoteCommand.id.in_(ids)))
+            db.session.commit()
+            report["archived"] += len(ids)
+            last_id = ids[-1]
+
+
+# Reads the commands back from an archive written by compact_vote_commands, each command once
+def read_vote_command_archive(archive_path):
+    seen = set()
+    with gzip.open(archive_path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            command = json.loads(line)
+            if command["id"] not in seen:
+                seen.add(command["id"])
+                yield command
@@ -0,0 +1,140 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+from flask import current_app, has_app_context
+from App.cache import response_cache
+
+# In-process vote queue with group commit
+# With VOTE_QUEUE_ENABLED set, votes are queued and a background thread applies everything queued
+# every VOTE_QUEUE_INTERVAL seconds in one transaction, in the order the votes were queued.
+# Each queued vote gets a ticket whose status can be checked until it is applied or fails.
+# The queue belongs to one worker process. The statuses are also written to the response cache
+# backend for VOTE_QUEUE_STATUS_TTL seconds, so a ticket can be checked from any worker sharing it,
+# which the memory backend, or no backend, does not: then only the worker that queued it knows it.
+
+DEFAULT_VOTE_QUEUE_INTERVAL = 0.005
+DEFAULT_VOTE_QUEUE_BATCH_SIZE = 500
+# The most ticket statuses remembered, the oldest are forgotten first
+MAX_VOTE_QUEUE_STATUSES = 100000
+DEFAULT_VOTE_QUEUE_STATUS_TTL = 3600
+
+
+class VoteQueue:
+
+    # apply takes a list of (staff_id, review_id, action) and returns one result per vote,
+    # the applied command as json or an error message
+    def __init__(self, apply, max_statuses=MAX_VOTE_QUEUE_STATUSES):
+        self.apply = apply
+        self.max_statuses = max_statuses
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.lock = threading.Lock()            # guards the statuses and starting the worker
+        self.apply_lock = threading.Lock()      # one batch is applied at a time, keeping the queue order
+        self.statuses = OrderedDict()
+        self.worker = None
+        self.pid = None
+        self.app = None
+
+    def _set_status(self, ticket, status):
+        with self.lock:
+            self.statuses[ticket] = status
+            self.statuses.move_to_end(ticket)
+            while len(self.statuses) > self.max_statuses:
+                self.statuses.popitem(last=False)
+        if response_cache.backend is None:
+            return
+        try:
+            ttl = self.app.config.get("VOTE_QUEUE_STATUS_TTL", DEFAULT_VOTE_QUEUE_STATUS_TTL)
+            response_cache.backend.set(f"vote-ticket:{ticket}", json.dumps(status).encode(), ttl)
+        except Exception as e:
+            #this worker still knows the status
+            print("Error sharing vote ticket status", e)
+
+    # Starts the worker thread of this process, again after a fork
+    def _start(self):
+        with self.lock:
+            if self.worker and self.worker.is_alive() and self.pid == os.getpid():
+                return
+            if self.pid is None:
+                atexit.register(self.flush)
+            self.app = current_app._get_current_object()
+            self.pid = os.getpid()
+            self.worker = threading.Thread(target=self._run, name="vote-queue", daemon=True)
+            self.worker.start()
+
+    def _run(self):
+        while True:
+            self.ready.wait()
+            #let the votes arriving meanwhile join the same transaction
+            time.sleep(self.app.config.get("VOTE_QUEUE_INTERVAL", DEFAULT_VOTE_QUEUE_INTERVAL))
+            self.flush()
+
+    def _drain(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _apply_batch(self, items):
+        votes = [vote for ticket, vote in items]
+        try:
+            #a flush from a thread with an app context, e.g. at exit, uses it and keeps its session open
+            if has_app_context():
+                results = self.apply(votes)
+            else:
+                with self.app.app_context():
+                    results = self.apply(votes)
+        except Exception as e:
+            print("Error applying queued votes", e)
+            results = ["Vote not applied"] * len(items)
+        for (ticket, vote), result in zip(items, results):
+            if isinstance(result, str):
+                self._set_status(ticket, {"ticket": ticket, "status": "failed", "error": result})
+            else:
+                self._set_status(ticket, {"ticket": ticket, "status": "applied", "command": result})
+
+    # Queues a vote, a (staff_id, review_id, action) tuple, and returns its ticket
+    def submit(self, vote):
+        self._start()
+        ticket = uuid4().hex
+        self._set_status(ticket, {"ticket": ticket, "status": "queued"})
+        self.queue.put((ticket, vote))
+        self.ready.set()
+        return ticket
+
+    # Applies everything queued so far, in batches of VOTE_QUEUE_BATCH_SIZE
+    # Called by the worker, and at exit so queued votes are not lost on shutdown
+    def flush(self):
+        if self.app is None:
+            return
+        batch_size = self.app.config.get("VOTE_QUEUE_BATCH_SIZE", DEFAULT_VOTE_QUEUE_BATCH_SIZE)
+        with self.apply_lock:
+            self.ready.clear()
+            while True:
+                items = self._drain(batch_size)
+                if not items:
+                    return
+                self._apply_batch(items)
+
+    # Returns the status of a ticket: queued, applied with the command, or failed with the error
+    # A ticket of another worker is looked up in the response cache backend
+    # Returns None for an unknown or forgotten ticket
+    def status(self, ticket):
+        with self.lock:
+            status = self.statuses.get(ticket)
+        if status is not None or response_cache.backend is None:
+            return status
+        try:
+            status = response_cache.backend.get(f"vote-ticket:{ticket}")
+        except Exception as e:
+            print("Error reading vote ticket status", e)
+            return None
+        return json.loads(status) if status else None
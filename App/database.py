@@ -1,17 +1,193 @@
+import json
+import logging
+import os
+import time
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from flask import current_app, g, has_app_context, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from App.cache import clear_response_cache
 
 db = SQLAlchemy()
 
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
 
 def get_migrate(app):
-    return Migrate(app, db)
+    return Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
 
 
+# Creates the tables and indexes, returns False if the database needs flask db upgrade first
+# A new database is created from the models and stamped with the latest migration, and the response
+# cache is cleared. An existing database behind the migrations is left alone, its missing columns
+# and duplicate rows are the migrations' to fix, so flask db upgrade can still load the app.
 def create_db(app):
     db.init_app(app)
+    engine = db.get_engine(app)
+    new = not inspect(engine).get_table_names()
     db.create_all(app=app)
+    with engine.begin() as connection:
+        context = MigrationContext.configure(connection)
+        scripts = ScriptDirectory(MIGRATIONS_DIRECTORY)
+        if new:
+            context.stamp(scripts, "heads")
+            clear_response_cache()
+        elif set(context.get_current_heads()) != set(scripts.get_heads()):
+            print("The database is behind the migrations, run flask db upgrade")
+            return False
+    create_indexes(app)
+    create_search_index(app)
+    return True
+
+
+# Creates any index declared on the models that is missing from the database
+# create_all only creates indexes together with new tables, this adds them to existing tables
+# An index that cannot be built, like a unique index over duplicate rows, raises
+def create_indexes(app):
+    engine = db.get_engine(app)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 
 def init_db(app):
     db.init_app(app)
+
+
+# Full-text search index over student name, programme, faculty and school_id
+# On SQLite this is an FTS5 table kept in sync by triggers on student, so every insert, update and
+# delete of a student updates the index in the same transaction.
+# On Postgres it is a GIN index on the tsvector expression searched by search_students.
+STUDENT_SEARCH_DOCUMENT = (
+    "coalesce(name, '') || ' ' || coalesce(programme, '') || ' ' || "
+    "coalesce(faculty, '') || ' ' || cast(school_id as text)"
+)
+
+SQLITE_STUDENT_SEARCH = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS student_search USING fts5(
+        name, programme, faculty, school_id, content='student', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS student_search_insert AFTER INSERT ON student BEGIN
+        INSERT INTO student_search(rowid, name, programme, faculty, school_id)
+        VALUES (new.id, new.name, new.programme, new.faculty, new.school_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS student_search_delete AFTER DELETE ON student BEGIN
+        INSERT INTO student_search(student_search, rowid, name, programme, faculty, school_id)
+        VALUES ('delete', old.id, old.name, old.programme, old.faculty, old.school_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS student_search_update
+    AFTER UPDATE OF name, programme, faculty, school_id ON student BEGIN
+        INSERT INTO student_search(student_search, rowid, name, programme, faculty, school_id)
+        VALUES ('delete', old.id, old.name, old.programme, old.faculty, old.school_id);
+        INSERT INTO student_search(rowid, name, programme, faculty, school_id)
+        VALUES (new.id, new.name, new.programme, new.faculty, new.school_id);
+    END""",
+]
+
+
+def create_search_index(app):
+    engine = db.get_engine(app)
+    try:
+        with engine.begin() as connection:
+            if engine.dialect.name == "sqlite":
+                exists = inspect(connection).has_table("student_search")
+                for statement in SQLITE_STUDENT_SEARCH:
+                    connection.execute(text(statement))
+                if not exists:
+                    #index the students that were added before the search table existed
+                    connection.execute(text("INSERT INTO student_search(student_search) VALUES ('rebuild')"))
+            elif engine.dialect.name == "postgresql":
+                connection.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_student_search ON student "
+                    f"USING gin (to_tsvector('simple', {STUDENT_SEARCH_DOCUMENT}))"
+                ))
+    except Exception as e:
+        print("Error creating student search index", e)
+
+
+# Per-request SQL instrumentation
+# Every statement run while handling a request is counted and timed in g.sql_stats, with the slowest
+# one kept, from engine events on every engine so a changed database URI is still covered.
+# In debug mode, or with SQL_STATS_HEADERS set, the numbers are sent back in X-DB-* headers.
+# Statements slower than SLOW_QUERY_THRESHOLD_MS (100 by default) are written to the slow_queries
+# logger as one JSON object per line, with the view that ran them, also from CLI commands.
+# SLOW_QUERY_LOG is a file to write them to, otherwise they go wherever logging is configured.
+DEFAULT_SLOW_QUERY_THRESHOLD_MS = 100
+slow_query_logger = logging.getLogger("slow_queries")
+
+
+def _view_name():
+    if not has_request_context() or request.endpoint is None:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    return view.__name__ if view else request.endpoint
+
+
+#the start time is kept on the statement's execution context, so a statement that raises, and never
+#gets its after_cursor_execute, leaves nothing behind on the connection
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "query_start", None)
+    if start is None:
+        return
+    duration = (time.perf_counter() - start) * 1000
+    if not has_app_context():
+        return
+    stats = g.get("sql_stats") if has_request_context() else None
+    if stats is not None:
+        stats["statements"] += 1
+        stats["time_ms"] += duration
+        if duration > stats["slowest_ms"]:
+            stats["slowest_ms"] = duration
+            stats["slowest"] = statement
+    if duration >= current_app.config.get("SLOW_QUERY_THRESHOLD_MS", DEFAULT_SLOW_QUERY_THRESHOLD_MS):
+        slow_query_logger.warning(json.dumps({
+            "view": _view_name(),
+            "endpoint": request.endpoint if has_request_context() else None,
+            "method": request.method if has_request_context() else None,
+            "path": request.path if has_request_context() else None,
+            "duration_ms": round(duration, 3),
+            "statement": " ".join(statement.split()),
+            "executemany": executemany,
+        }))
+
+
+def _new_sql_stats():
+    return {"statements": 0, "time_ms": 0.0, "slowest_ms": 0.0, "slowest": None}
+
+
+#g can outlive the request when an app context was already pushed, e.g. in the tests
+def _reset_sql_stats():
+    g.sql_stats = _new_sql_stats()
+
+
+# Returns the statements, total time and slowest statement of the current request so far
+def get_sql_stats():
+    return g.get("sql_stats") or _new_sql_stats()
+
+
+def _add_sql_stats_headers(response):
+    if current_app.debug or current_app.config.get("SQL_STATS_HEADERS"):
+        stats = get_sql_stats()
+        response.headers["X-DB-Statements"] = str(stats["statements"])
+        response.headers["X-DB-Time-Ms"] = f"{stats['time_ms']:.3f}"
+        response.headers["X-DB-Slowest-Ms"] = f"{stats['slowest_ms']:.3f}"
+    return response
+
+
+def setup_sql_instrumentation(app):
+    app.before_request(_reset_sql_stats)
+    app.after_request(_add_sql_stats_headers)
+    path = app.config.get("SLOW_QUERY_LOG")
+    if path and not any(getattr(handler, "baseFilename", None) == path for handler in slow_query_logger.handlers):
+        slow_query_logger.addHandler(logging.FileHandler(path))
+    slow_query_logger.setLevel(logging.WARNING)
@@ -0,0 +1,164 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import jsonify
+from werkzeug.security import check_password_hash, gen_salt, generate_password_hash
+
+# Password hashing with a configurable method and cost, run in a bounded pool
+# PASSWORD_HASH_METHOD is a werkzeug method (sha256, pbkdf2:sha256, pbkdf2:sha512) or scrypt,
+# and PASSWORD_HASH_COST is the pbkdf2 iterations or the scrypt n, a power of two.
+# Hashes carry the method and cost they were made with, so old hashes still verify and are
+# replaced at the next login once the settings change.
+# Every hash and check runs in a pool of PASSWORD_HASH_WORKERS threads, or processes with
+# PASSWORD_HASH_POOL=process, so a login burst uses at most that many cores per worker process.
+# At most PASSWORD_HASH_QUEUE_DEPTH more wait their turn, beyond that PasswordHashPoolFull is raised
+# and the request is answered with a 503 instead of queueing behind everyone else.
+
+DEFAULT_PASSWORD_HASH_METHOD = "sha256"
+DEFAULT_PASSWORD_HASH_COSTS = {"pbkdf2": 260000, "scrypt": 32768}
+DEFAULT_PASSWORD_HASH_QUEUE_DEPTH = 64
+SCRYPT_BLOCK_SIZE = 8
+SCRYPT_PARALLELISM = 1
+
+
+class PasswordHashPoolFull(Exception):
+    pass
+
+
+# Returns the prefix of the hashes made with method and cost, e.g. pbkdf2:sha256:260000
+def hash_settings(method, cost=None):
+    if method.startswith("pbkdf2"):
+        hash_name = method.split(":")[1] if ":" in method else "sha256"
+        return f"pbkdf2:{hash_name}:{cost or DEFAULT_PASSWORD_HASH_COSTS['pbkdf2']}"
+    if method == "scrypt":
+        return f"scrypt:{cost or DEFAULT_PASSWORD_HASH_COSTS['scrypt']}:{SCRYPT_BLOCK_SIZE}:{SCRYPT_PARALLELISM}"
+    return method
+
+
+def _scrypt(password, salt, settings):
+    n, r, p = (int(value) for value in settings.split(":")[1:])
+    return hashlib.scrypt(
+        password.encode(), salt=salt.encode(), n=n, r=r, p=p, maxmem=132 * n * r * p, dklen=64
+    ).hex()
+
+
+# Hashes a password with the settings returned by hash_settings
+# scrypt hashes use the scrypt:n:r:p$salt$hash format of newer werkzeug versions
+def make_password_hash(password, settings):
+    if settings.startswith("scrypt:"):
+        salt = gen_salt(16)
+        return f"{settings}${salt}${_scrypt(password, salt, settings)}"
+    return generate_password_hash(password, method=settings)
+
+
+# Checks a password against a hash made with any settings
+def check_password(pwhash, password):
+    if pwhash.startswith("scrypt:"):
+        if pwhash.count("$") != 2:
+            return False
+        settings, salt, expected = pwhash.split("$")
+        return hmac.compare_digest(_scrypt(password, salt, settings), expected)
+    return check_password_hash(pwhash, password)
+
+
+class PasswordHasher:
+
+    def __init__(self):
+        self.settings = hash_settings(DEFAULT_PASSWORD_HASH_METHOD)
+        self.workers = os.cpu_count() or 1
+        self.queue_depth = DEFAULT_PASSWORD_HASH_QUEUE_DEPTH
+        self.processes = False
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+        self.executor = None
+        self.pid = None
+
+    def configure(self, method=DEFAULT_PASSWORD_HASH_METHOD, cost=None, workers=None, queue_depth=DEFAULT_PASSWORD_HASH_QUEUE_DEPTH, pool="thread"):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            self.settings = hash_settings(method, cost)
+            self.workers = workers if workers is not None else os.cpu_count() or 1
+            self.queue_depth = queue_depth
+            self.processes = pool == "process"
+            self.slots = threading.BoundedSemaphore(max(self.workers, 1) + self.queue_depth)
+            self.executor = None
+
+    # Creates the pool of this process on first use, again after a fork
+    def _executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+                self.executor = pool(max_workers=self.workers)
+                self.pid = os.getpid()
+            return self.executor
+
+    def _run(self, function, *args):
+        if self.workers == 0:
+            return function(*args)
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHashPoolFull()
+        try:
+            return self._executor().submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(make_password_hash, password, self.settings)
+
+    def check(self, pwhash, password):
+        return self._run(check_password, pwhash, password)
+
+    # A hash made with other settings than the current ones should be replaced at the next login
+    def needs_rehash(self, pwhash):
+        return pwhash.split("$", 1)[0] != self.settings
+
+
+# The hasher of this worker process, configured by setup_hashing
+password_hasher = PasswordHasher()
+
+
+def setup_hashing(app):
+    password_hasher.configure(
+        method=app.config.get("PASSWORD_HASH_METHOD", DEFAULT_PASSWORD_HASH_METHOD),
+        cost=app.config.get("PASSWORD_HASH_COST"),
+        workers=app.config.get("PASSWORD_HASH_WORKERS"),
+        queue_depth=app.config.get("PASSWORD_HASH_QUEUE_DEPTH", DEFAULT_PASSWORD_HASH_QUEUE_DEPTH),
+        pool=app.config.get("PASSWORD_HASH_POOL", "thread"),
+    )
+    app.register_error_handler(PasswordHashPoolFull, password_hash_pool_full)
+
+
+def password_hash_pool_full(error):
+    return jsonify({"error": "Too many logins at once, try again shortly"}), 503, {"Retry-After": "1"}
+
+
+# Measures how many password checks a second each worker does for every settings,
+# each a (method, cost) pair, with workers threads or processes checking at once for seconds
+# Returns one row per settings with the checks a second in total and per worker
+def benchmark_password_hashing(settings, workers=1, seconds=2.0, pool="thread"):
+    results = []
+    executor = (ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor)(max_workers=workers)
+    try:
+        for method, cost in settings:
+            name = hash_settings(method, cost)
+            pwhash = make_password_hash("benchmark password", name)
+            checks = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                futures = [executor.submit(check_password, pwhash, "benchmark password") for i in range(workers)]
+                checks += sum(1 for future in futures if future.result())
+            elapsed = time.perf_counter() - start
+            results.append({
+                "settings": name,
+                "workers": workers,
+                "per_second": checks / elapsed,
+                "per_worker_per_second": checks / elapsed / workers,
+                "milliseconds": 1000 * elapsed * workers / checks,
+            })
+    finally:
+        executor.shutdown()
+    return results
@@ -0,0 +1,409 @@
+import asyncio
+import base64
+import json
+import random
+import re
+import time
+from urllib.parse import urlencode, urlsplit
+
+# Load generator for a running server, e.g. gunicorn started as in the Procfile
+# Virtual staff log in through /api/staff-login, then each repeats a weighted mix of actions:
+# browsing students and reviews, writing reviews and toggling votes, with an optional think time
+# between actions. The number of virtual staff follows a profile of stages, each ramping linearly
+# from the previous count to its own over its duration.
+# Every request is timed and counted under its endpoint, with 5xx responses, timeouts and failed
+# connections counted as errors and 4xx responses as rejected.
+# The client is plain asyncio over HTTP/1.1, one connection per virtual staff, kept alive when
+# the server allows it (gunicorn's sync workers close every connection).
+
+DEFAULT_LOAD_MIX = {
+    "browse_students": 25,
+    "view_student": 20,
+    "student_reviews": 20,
+    "view_review": 10,
+    "create_review": 5,
+    "toggle_vote": 20,
+}
+DEFAULT_THINK_TIME = 0.5
+DEFAULT_REQUEST_TIMEOUT = 30.0
+# Students and reviews listed before the test starts, the actions pick from them
+DEFAULT_DISCOVER_LIMIT = 2000
+# How often the number of virtual staff is adjusted to the profile, in seconds
+PROFILE_TICK = 0.1
+
+
+class LoadTestError(Exception):
+    pass
+
+
+# Profiles as stages of (seconds, users), for a peak number of users over a duration
+def constant_profile(users, duration):
+    return [(0, users), (duration, users)]
+
+
+def ramp_profile(users, duration):
+    return [(duration * 0.25, users), (duration * 0.75, users)]
+
+
+def step_profile(users, duration, steps=4):
+    stages = []
+    for step in range(1, steps + 1):
+        stages += [(0, max(1, users * step // steps)), (duration / steps, max(1, users * step // steps))]
+    return stages
+
+
+def spike_profile(users, duration):
+    base = max(1, users // 5)
+    return [(duration * 0.1, base), (duration * 0.3, base), (0, users), (duration * 0.2, users), (0, base), (duration * 0.4, base)]
+
+
+LOAD_PROFILES = {
+    "constant": constant_profile,
+    "ramp": ramp_profile,
+    "step": step_profile,
+    "spike": spike_profile,
+}
+
+
+# Parses stages written as seconds:users pairs, e.g. "30:10,60:50,30:0"
+def parse_stages(text):
+    stages = []
+    for stage in text.split(","):
+        seconds, _, users = stage.partition(":")
+        try:
+            stages.append((float(seconds), int(users)))
+        except ValueError:
+            raise LoadTestError(f"stage {stage} is not seconds:users")
+    return stages
+
+
+# Parses an action mix written as name=weight pairs, e.g. "browse_students=50,toggle_vote=50"
+def parse_mix(text):
+    mix = {}
+    for pair in text.split(","):
+        name, _, weight = pair.partition("=")
+        if name not in DEFAULT_LOAD_MIX:
+            raise LoadTestError(f"unknown action {name}, the actions are {', '.join(DEFAULT_LOAD_MIX)}")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise LoadTestError(f"weight of {name} is not a number")
+    return mix
+
+
+# The number of users the stages ask for after elapsed seconds, None once the stages are over
+def target_users(stages, elapsed):
+    start = 0.0
+    users = 0
+    for seconds, target in stages:
+        if elapsed < start + seconds:
+            return users + (target - users) * (elapsed - start) / seconds
+        start += seconds
+        users = target
+    return None
+
+
+def profile_duration(stages):
+    return sum(seconds for seconds, users in stages)
+
+
+def percentile(timings, share):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0.0
+
+
+class HTTPConnection:
+
+    def __init__(self, host, port, timeout=DEFAULT_REQUEST_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _read_body(self, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    return body
+                body += await self.reader.readexactly(size)
+                await self.reader.readline()
+        if "content-length" in headers:
+            return await self.reader.readexactly(int(headers["content-length"]))
+        return await self.reader.read()
+
+    async def _exchange(self, request):
+        self.writer.write(request)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await self._read_body(headers)
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, headers, body
+
+    # Sends a request and returns the status, headers with lower case names and body
+    # A kept alive connection the server has since closed is opened again once
+    async def request(self, method, path, headers=None, body=None):
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Connection: keep-alive"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if body is not None:
+            lines += ["Content-Type: application/json", f"Content-Length: {len(body)}"]
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        reused = self.writer is not None
+        try:
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            return await asyncio.wait_for(self._exchange(request), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self.close()
+            if not reused:
+                raise
+        except BaseException:
+            self.close()
+            raise
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            return await asyncio.wait_for(self._exchange(request), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.timings = []
+        self.statuses = {}
+        self.errors = 0
+        self.rejected = 0
+
+
+class LoadTest:
+
+    def __init__(self, url, usernames, password, mix=None, think_time=DEFAULT_THINK_TIME,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, seed=0, discover_limit=DEFAULT_DISCOVER_LIMIT):
+        parts = urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise LoadTestError(f"{url} is not an http:// url")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.usernames = usernames
+        self.password = password
+        self.mix = mix or DEFAULT_LOAD_MIX
+        self.think_time = think_time
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.discover_limit = discover_limit
+        self.students = []
+        self.reviews = []
+        self.stats = {}
+        self.peak_users = 0
+        self.started = None
+        self.finished = None
+
+    def connect(self):
+        return HTTPConnection(self.host, self.port, self.timeout)
+
+    # Sends a request, counted under the endpoint name, and returns the status and body
+    # The status is None when no response came back
+    async def call(self, connection, name, method, path, token=None, payload=None):
+        headers = {"Authorization": f"JWT {token}"} if token else {}
+        body = json.dumps(payload).encode() if payload is not None else None
+        stats = self.stats.setdefault(name, EndpointStats())
+        start = time.perf_counter()
+        try:
+            status, headers, body = await connection.request(method, path, headers, body)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            stats.timings.append(time.perf_counter() - start)
+            stats.errors += 1
+            error = type(e).__name__
+            stats.statuses[error] = stats.statuses.get(error, 0) + 1
+            return None, None
+        stats.timings.append(time.perf_counter() - start)
+        stats.statuses[str(status)] = stats.statuses.get(str(status), 0) + 1
+        if status >= 500:
+            stats.errors += 1
+        elif status >= 400:
+            stats.rejected += 1
+        return status, body
+
+    # Returns the token and user id of a staff, None if the login failed
+    async def login(self, connection, username):
+        query = urlencode({"username": username, "password": self.password})
+        status, body = await self.call(connection, "GET /api/staff-login", "GET", f"/api/staff-login?{query}")
+        if status != 200:
+            return None
+        token = json.loads(body)["access_token"]
+        #the user id is a claim of the token, its signature is the server's business
+        claims = token.split(".")[1]
+        return token, json.loads(base64.urlsafe_b64decode(claims + "=" * (-len(claims) % 4)))["identity"]
+
+    # Lists the ids of up to discover_limit students and reviews, following the Link headers
+    async def discover(self):
+        connection = self.connect()
+        try:
+            login = await self.login(connection, self.usernames[0])
+            if login is None:
+                raise LoadTestError(f"{self.usernames[0]} could not log in, seed the staff first, e.g. flask seed")
+            for path, ids in (("/api/students", self.students), ("/api/reviews", self.reviews)):
+                after = None
+                while len(ids) < self.discover_limit:
+                    query = urlencode({"limit": 100, **({"after": after} if after else {})})
+                    status, headers, body = await connection.request("GET", f"{path}?{query}", {"Authorization": f"JWT {login[0]}"})
+                    if status != 200:
+                        break
+                    ids.extend(row["id"] for row in json.loads(body))
+                    found = re.search(r"[?&]after=(\d+)", headers.get("link", ""))
+                    if not found:
+                        break
+                    after = found.group(1)
+        finally:
+            connection.close()
+        if not self.students:
+            raise LoadTestError("no students found, seed the database first, e.g. flask seed")
+
+    def _pick(self, ids, skew=1.0):
+        #a skew above 1 picks the first ids more often, the ones listed first are the hot rows
+        return ids[int(len(ids) * self.rng.random() ** skew)]
+
+    async def browse_students(self, user):
+        after = self._pick(self.students) - 1
+        await self.call(user["connection"], "GET /api/students", "GET", f"/api/students?limit=50&after={max(after, 0)}", user["token"])
+
+    async def view_student(self, user):
+        await self.call(user["connection"], "GET /api/students/<id>", "GET", f"/api/students/{self._pick(self.students, 2)}", user["token"])
+
+    async def student_reviews(self, user):
+        await self.call(user["connection"], "GET /api/students/<id>/reviews", "GET", f"/api/students/{self._pick(self.students, 2)}/reviews", user["token"])
+
+    async def view_review(self, user):
+        if self.reviews:
+            await self.call(user["connection"], "GET /api/reviews/<id>", "GET", f"/api/reviews/{self._pick(self.reviews, 2)}", user["token"])
+
+    async def create_review(self, user):
+        rating = self.rng.choice([1, 3, 5, 6, 7, 8, 8, 9, 9, 10])
+        payload = {"student_id": self._pick(self.students), "staff_id": user["id"], "text": "Load test review", "rating": rating}
+        status, body = await self.call(user["connection"], "POST /api/add-review", "POST", "/api/add-review", user["token"], payload)
+        if status == 201:
+            self.reviews.append(json.loads(body)["id"])
+
+    #most votes go to a few popular reviews, the rows most likely to contend for locks
+    async def toggle_vote(self, user):
+        if self.reviews:
+            action = "upvote" if self.rng.random() < 0.7 else "downvote"
+            await self.call(user["connection"], "PUT /api/reviews/<id>/<action>", "PUT", f"/api/reviews/{self._pick(self.reviews, 3)}/{action}", user["token"])
+
+    # One virtual staff, logging in then acting until stopped
+    async def virtual_user(self, number, stopped):
+        user = {"connection": self.connect()}
+        actions = list(self.mix)
+        weights = [self.mix[action] for action in actions]
+        try:
+            while not stopped.is_set():
+                login = await self.login(user["connection"], self.usernames[number % len(self.usernames)])
+                if login:
+                    user["token"], user["id"] = login
+                    break
+                await asyncio.sleep(1)
+            while not stopped.is_set():
+                action = self.rng.choices(actions, weights)[0]
+                await getattr(self, action)(user)
+                if self.think_time:
+                    try:
+                        await asyncio.wait_for(stopped.wait(), self.rng.expovariate(1 / self.think_time))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            user["connection"].close()
+
+    # Runs the virtual staff through the stages and returns the report
+    async def run(self, stages):
+        await self.discover()
+        self.stats.clear()
+        users = []
+        tasks = []
+        loop = asyncio.get_running_loop()
+        self.started = loop.time()
+        started = time.perf_counter()
+        while True:
+            target = target_users(stages, loop.time() - self.started)
+            if target is None:
+                break
+            target = round(target)
+            while len(users) < target:
+                stopped = asyncio.Event()
+                tasks.append(asyncio.ensure_future(self.virtual_user(len(users), stopped)))
+                users.append(stopped)
+            while len(users) > target:
+                users.pop().set()
+            self.peak_users = max(self.peak_users, len(users))
+            await asyncio.sleep(PROFILE_TICK)
+        for stopped in users:
+            stopped.set()
+        #the virtual staff finish the request they are on, those stopped earlier included
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+            for task in pending:
+                task.cancel()
+        self.finished = time.perf_counter() - started
+        return self.report()
+
+    def report(self):
+        elapsed = self.finished or 1.0
+        endpoints = {}
+        everything = EndpointStats()
+        for name, stats in sorted(self.stats.items()):
+            endpoints[name] = _endpoint_report(stats, elapsed)
+            everything.timings += stats.timings
+            everything.errors += stats.errors
+            everything.rejected += stats.rejected
+            for status, count in stats.statuses.items():
+                everything.statuses[status] = everything.statuses.get(status, 0) + count
+        return {
+            "url": f"http://{self.host}:{self.port}",
+            "seconds": round(elapsed, 3),
+            "peak_users": self.peak_users,
+            "mix": self.mix,
+            "think_time": self.think_time,
+            "total": _endpoint_report(everything, elapsed),
+            "endpoints": endpoints,
+        }
+
+
+def _endpoint_report(stats, elapsed):
+    requests = len(stats.timings)
+    return {
+        "requests": requests,
+        "per_second": round(requests / elapsed, 2),
+        "p50_ms": round(1000 * percentile(stats.timings, 0.5), 3),
+        "p90_ms": round(1000 * percentile(stats.timings, 0.9), 3),
+        "p99_ms": round(1000 * percentile(stats.timings, 0.99), 3),
+        "max_ms": round(1000 * max(stats.timings, default=0.0), 3),
+        "errors": stats.errors,
+        "rejected": stats.rejected,
+        "error_rate": round(stats.errors / requests, 4) if requests else 0.0,
+        "statuses": stats.statuses,
+    }
+
+
+# Runs a load test against url with the given stages and returns its report
+def run_load_test(url, stages, usernames, password, **options):
+    return asyncio.run(LoadTest(url, usernames, password, **options).run(stages))
@@ -9,9 +9,15 @@ from datetime import timedelta
 
 from App.models import User, Staff, Admin
 
-from App.database import create_db, db
+from App.database import create_db, db, setup_sql_instrumentation
 
-from App.controllers import setup_jwt
+from App.hashing import setup_hashing
+
+from App.cache import setup_cache
+
+from App.metrics import setup_metrics
+
+from App.controllers import setup_jwt, build_student_index, get_identity
 
 from App.views import user_views, index_views, review_views, student_views
 
@@ -39,6 +45,13 @@ def loadConfig(app, config):
         app.config["DEBUG"] = os.environ.get("ENV").upper() != "PRODUCTION"
         app.config["ENV"] = os.environ.get("ENV")
         delta = os.environ.get("JWT_EXPIRATION_DELTA", 7)
+        #password hashing, response cache and slow query log settings, see App/hashing.py, App/cache.py and App/database.py
+        for key in ("PASSWORD_HASH_METHOD", "PASSWORD_HASH_POOL", "RESPONSE_CACHE_BACKEND", "RESPONSE_CACHE_DIR", "RESPONSE_CACHE_NAMESPACE", "RESPONSE_CACHE_URL", "SLOW_QUERY_LOG"):
+            if key in os.environ:
+                app.config[key] = os.environ[key]
+        for key in ("PASSWORD_HASH_COST", "PASSWORD_HASH_WORKERS", "PASSWORD_HASH_QUEUE_DEPTH", "RESPONSE_CACHE_TTL", "RESPONSE_CACHE_SIZE", "SLOW_QUERY_THRESHOLD_MS"):
+            if key in os.environ:
+                app.config[key] = int(os.environ[key])
 
     app.config["JWT_EXPIRATION_DELTA"] = timedelta(days=int(delta))
 
@@ -48,12 +61,20 @@ def loadConfig(app, config):
 login_manager = LoginManager()
 @login_manager.user_loader
 def load_user(user_id):
-    return Staff.query.get(user_id) or Admin.query.get(user_id)
+    id, _, version = user_id.partition(":")
+    user = get_identity(id)
+    if user and (user.token_version or 0) == int(version or 0):
+        return user
+    return None
 
 def create_app(config={}):
     app = Flask(__name__, static_url_path="/static")
     CORS(app)
     loadConfig(app, config)
+    setup_hashing(app)
+    setup_cache(app)
+    setup_sql_instrumentation(app)
+    setup_metrics(app)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["TEMPLATES_AUTO_RELOAD"] = True
     app.config["PREFERRED_URL_SCHEME"] = "https"
@@ -61,9 +82,12 @@ def create_app(config={}):
     photos = UploadSet("photos", TEXT + DOCUMENTS + IMAGES)
     configure_uploads(app, photos)
     add_views(app, views)
-    create_db(app)
+    schema_current = create_db(app)
     login_manager.init_app(app)
     setup_jwt(app)
+    if schema_current:
+        with app.app_context():
+            build_student_index()
     app.app_context().push()
     return app
 
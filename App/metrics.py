@@ -0,0 +1,287 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from App.database import db
+from App.cache import response_cache
+from App.controllers.auth import get_identity_cache_stats
+
+# Prometheus metrics for /metrics, aggregated across the worker processes of one server
+# Each process keeps its samples in memory and writes them to its own file in METRICS_DIR at most
+# every METRICS_FLUSH_INTERVAL seconds, and /metrics sums the files of every process.
+# Counters and histograms of exited workers are kept so totals never go backwards, gauges are only
+# summed over live processes. METRICS_DIR should be emptied when the server starts, see gunicorn.conf.py.
+
+DEFAULT_METRICS_FLUSH_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def default_metrics_dir():
+    return os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "app-metrics"))
+
+
+class Metric:
+
+    def __init__(self, registry, name, kind, help, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name, labels, amount)
+
+    def dec(self, amount=1, **labels):
+        self.registry.add(self.name, labels, -amount)
+
+    def set(self, value, **labels):
+        self.registry.put(self.name, labels, value)
+
+    def observe(self, value, **labels):
+        for bucket in self.buckets:
+            if value <= bucket:
+                self.registry.add(f"{self.name}_bucket", dict(labels, le=repr(bucket)), 1)
+        self.registry.add(f"{self.name}_bucket", dict(labels, le="+Inf"), 1)
+        self.registry.add(f"{self.name}_sum", labels, value)
+        self.registry.add(f"{self.name}_count", labels, 1)
+
+
+class MetricsRegistry:
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.samples = {}                   # (sample name, sorted labels) -> value
+        self.collectors = []                # called before each flush to set gauges
+        self.derived = []                   # called with the totals of every process to add samples
+        self.flushed = 0.0
+        self.interval = DEFAULT_METRICS_FLUSH_INTERVAL
+        self.app = None
+
+    def metric(self, name, kind, help, buckets=None):
+        self.metrics[name] = Metric(self, name, kind, help, buckets)
+        return self.metrics[name]
+
+    def add(self, name, labels, amount):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def put(self, name, labels, value):
+        with self.lock:
+            self.samples[(name, tuple(sorted(labels.items())))] = value
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    # Writes the samples of this process to its file, replaced atomically
+    def flush(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print("Error collecting metrics", e)
+        with self.lock:
+            samples = [[name, list(labels), value] for (name, labels), value in self.samples.items()]
+            self.flushed = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(descriptor, "w") as file:
+            json.dump({"pid": os.getpid(), "samples": samples}, file)
+        os.replace(temporary, self._path(os.getpid()))
+
+    def maybe_flush(self):
+        if time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    # Sums the samples of every process, gauges only from the processes still running
+    def collect(self):
+        self.flush()
+        gauges = {name for name, metric in self.metrics.items() if metric.kind == "gauge"}
+        totals = {}
+        for entry in os.listdir(self.directory):
+            if not (entry.startswith("metrics-") and entry.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, entry)) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            alive = _is_alive(data["pid"])
+            for name, labels, value in data["samples"]:
+                if name in gauges and not alive:
+                    continue
+                key = (name, tuple(tuple(label) for label in labels))
+                totals[key] = totals.get(key, 0) + value
+        for derive in self.derived:
+            derive(totals)
+        return totals
+
+    # Returns every metric in the Prometheus text format
+    def render(self):
+        totals = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            names = {name, f"{name}_bucket", f"{name}_sum", f"{name}_count"} if metric.kind == "histogram" else {name}
+            for (sample, labels), value in sorted(totals.items(), key=_sample_order):
+                if sample in names:
+                    lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+        if os.path.isdir(self.directory):
+            for entry in os.listdir(self.directory):
+                if entry.startswith("metrics-"):
+                    os.unlink(os.path.join(self.directory, entry))
+
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+#buckets in increasing order with +Inf last, the rest by name and labels
+def _sample_order(item):
+    (name, labels), value = item
+    le = dict(labels).get("le")
+    other = tuple(label for label in labels if label[0] != "le")
+    return (name, other, float(le) if le else 0.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# The metrics of this worker process
+metrics = MetricsRegistry(default_metrics_dir())
+
+http_requests = metrics.metric("http_requests_total", "counter", "Requests handled, by blueprint, endpoint, method and status")
+http_latency = metrics.metric("http_request_duration_seconds", "histogram", "Request latency in seconds, by blueprint and endpoint", LATENCY_BUCKETS)
+http_in_flight = metrics.metric("http_requests_in_flight", "gauge", "Requests being handled, by blueprint and endpoint")
+db_checked_out = metrics.metric("db_pool_checked_out", "gauge", "Database connections checked out of the pool")
+db_overflow = metrics.metric("db_pool_overflow", "gauge", "Connections open beyond the pool size, for pools that have one")
+cache_requests = metrics.metric("cache_requests_total", "counter", "Cache lookups, by cache and result")
+cache_hit_ratio = metrics.metric("cache_hit_ratio", "gauge", "Share of the cache lookups answered from the cache, by cache")
+vote_commands = metrics.metric("vote_commands_total", "counter", "Vote commands applied, by action")
+
+# Connections checked out of every pool of this process, counted from the pool events
+# so pools without a checkedout count, like SQLite's NullPool, are covered too
+checked_out = {"count": 0}
+checked_out_lock = threading.Lock()
+
+
+@event.listens_for(Pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with checked_out_lock:
+        checked_out["count"] += 1
+
+
+@event.listens_for(Pool, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    with checked_out_lock:
+        checked_out["count"] -= 1
+
+
+# Counts applied vote commands, given as json, called by the review controller after each commit
+def count_vote_commands(commands):
+    for command in commands:
+        vote_commands.inc(action=command["action"])
+
+
+def _collect_pool():
+    db_checked_out.set(checked_out["count"])
+    overflow = getattr(db.get_engine(metrics.app).pool, "overflow", None)
+    if overflow:
+        db_overflow.set(max(overflow(), 0))
+
+
+def _collect_caches():
+    response = response_cache.stats()
+    identity = get_identity_cache_stats()
+    for cache, hits, misses in (("response", response["hits"] + response["not_modified"], response["misses"]),
+                                ("identity", identity["hits"], identity["misses"])):
+        cache_requests.set(hits, cache=cache, result="hit")
+        cache_requests.set(misses, cache=cache, result="miss")
+
+
+# The hit ratios are worked out from the lookups of every process, a ratio can not be summed
+def _derive_hit_ratios(totals):
+    lookups = {}
+    for (name, labels), value in list(totals.items()):
+        if name == "cache_requests_total":
+            labels = dict(labels)
+            lookups.setdefault(labels["cache"], {})[labels["result"]] = value
+    for cache, results in lookups.items():
+        total = results.get("hit", 0) + results.get("miss", 0)
+        totals[("cache_hit_ratio", (("cache", cache),))] = results.get("hit", 0) / total if total else 0
+
+
+def _labels():
+    return {"blueprint": request.blueprint or "", "endpoint": request.endpoint or "none"}
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_labels = _labels()
+    http_in_flight.inc(**g.metrics_labels)
+
+
+def _end_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        http_latency.observe(time.perf_counter() - start, **g.metrics_labels)
+        http_requests.inc(method=request.method, status=str(response.status_code), **g.metrics_labels)
+    return response
+
+
+#runs even when the request failed before its response was made
+def _teardown_request(error):
+    labels = g.pop("metrics_labels", None)
+    if labels is not None:
+        http_in_flight.dec(**labels)
+        metrics.maybe_flush()
+
+
+def metrics_view():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def setup_metrics(app):
+    metrics.directory = app.config.get("METRICS_DIR", metrics.directory)
+    metrics.interval = app.config.get("METRICS_FLUSH_INTERVAL", DEFAULT_METRICS_FLUSH_INTERVAL)
+    metrics.app = app
+    metrics.collectors = [_collect_pool, _collect_caches]
+    metrics.derived = [_derive_hit_ratios]
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    atexit.register(metrics.flush)
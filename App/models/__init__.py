@@ -5,4 +5,5 @@ from .admin import *
 from .staff import *
 from .vote import *
 from .voteCommand import *
+from .voteSnapshot import *
 from .command import *
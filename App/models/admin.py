@@ -3,7 +3,8 @@ from .student import Student
 from App.database import db
 
 class Admin (User):
-    
+    __mapper_args__ = {"polymorphic_identity": "admin"}
+
     def __init__(self, username, password):
         self.username = username
         self.set_password(password)
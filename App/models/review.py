@@ -3,15 +3,22 @@ from App.database import db
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.mutable import MutableDict
 from .vote import Vote, Value
+from .student import Student
 from .command import Command
 
 
 class Review(db.Model):
+    #a staff can only review a student once, the index also serves lookups by staff
+    __table_args__ = (
+        db.Index("ix_review_staff_id_student_id", "staff_id", "student_id", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    staff_id = db.Column(db.Integer, db.ForeignKey("staff.id"), nullable=False)
+    staff_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey("student.id"), nullable=False)
     text = db.Column(db.String(1000), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
+    num_upvotes = db.Column(db.Integer, nullable=False, default=0)
+    num_downvotes = db.Column(db.Integer, nullable=False, default=0)
     votes = db.relationship(
         "Vote", backref="review", lazy=True, cascade="all, delete-orphan"
     )
@@ -20,25 +27,46 @@ class Review(db.Model):
         self.staff_id = staff_id
         self.student_id = student_id
         self.text = text
-        self.rating= rating
+        self.rating= int(rating)
+        self.num_upvotes = 0
+        self.num_downvotes = 0
 
+    #the vote counts are stored on the review and kept up to date by VoteCommand
     def get_num_upvotes(self):
-        if not self.votes:
-            return 0
-        num_upvotes=0
-        for vote in self.votes:
-            if (vote.value==Value.UPVOTE):
-                num_upvotes= num_upvotes+1
-        return num_upvotes
+        return self.num_upvotes or 0
     
     def get_num_downvotes (self):
-        if not self.votes:
-            return 0
-        num_downvotes=0
-        for vote in self.votes:
-            if (vote.value==Value.DOWNVOTE):
-                num_downvotes=num_downvotes+1
-        return num_downvotes
+        return self.num_downvotes or 0
+
+    #adds to the stored vote counts with a single UPDATE so votes cast at the same time are not lost
+    #the student's karma changes by the weight of each vote in the same transaction
+    #the change is only sent to the database, so it is part of whatever transaction the caller commits
+    def add_votes(self, upvotes=0, downvotes=0):
+        Review.query.filter_by(id=self.id).update(
+            {
+                Review.num_upvotes: Review.num_upvotes + upvotes,
+                Review.num_downvotes: Review.num_downvotes + downvotes,
+            },
+            synchronize_session=False,
+        )
+        self.add_student_karma(self.get_vote_weight() * (upvotes - downvotes))
+
+    #adds a change in this review's karma to the karma stored on its student
+    #the change is also kept on the session, for the autocomplete index to apply when it commits
+    def add_student_karma(self, karma):
+        if karma:
+            Student.query.filter_by(id=self.student_id).update(
+                {Student.karma: Student.karma + karma}, synchronize_session=False
+            )
+            changes= db.session.info.setdefault("karma_changes", {})
+            changes[self.student_id]= changes.get(self.student_id, 0) + karma
+
+    #how much one upvote changes the karma of this review, a downvote changes it by the negative
+    #see get_karma: the weight is rating-5, except for a neutral review where it is 1
+    def get_vote_weight(self):
+        if (self.rating==5):
+            return 1
+        return self.rating-5
 
     #for a positive or negative review: increases the weight of an upvote or downvote by 1 for each rating above 5 
     #e.g  rating 6/4= +/- 1, rating 7/3= +/- 2, rating 8/2= +/- 3, rating 9/1= +/- 4, rating 10= +/- 5
@@ -4,7 +4,7 @@ from App.database import db
 
 class Staff (User):
 
-    __tablename__ = 'staff'
+    __mapper_args__ = {"polymorphic_identity": "staff"}
     reviews= db.relationship('Review', backref=db.backref('staff', lazy='joined'))
 
     def __init__(self, username, password):
@@ -3,10 +3,11 @@ from App.database import db
 
 class Student(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    school_id= db.Column(db.Integer, nullable=False)
-    name = db.Column(db.String(100), nullable=False)
+    school_id= db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False, index=True)
     faculty = db.Column(db.String(100), nullable=False)
     programme = db.Column(db.String(100), nullable=False)
+    karma = db.Column(db.Integer, nullable=False, default=0)
     reviews = db.relationship(
         "Review", backref="student", lazy=True, cascade="all, delete-orphan"
     )
@@ -16,8 +17,14 @@ class Student(db.Model):
         self.name=name
         self.faculty = faculty
         self.programme = programme
+        self.karma = 0
 
+    #the karma is stored on the student and kept up to date as reviews and votes change
     def get_karma(self):
+        return self.karma or 0
+
+    #adds up the karma of every review, used to rebuild the stored karma
+    def compute_karma(self):
         karma = 0
         reviews = self.reviews
         if not reviews:
@@ -1,26 +1,38 @@
-from werkzeug.security import check_password_hash, generate_password_hash
 from App.database import db
 from flask_login import UserMixin
+from App.hashing import password_hasher
 
 
+#Staff and Admin share this table, told apart by access, so a user is found by id or username in one query
 class User(db.Model, UserMixin):
-    __abstract__ = True
+    __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String, nullable=False, unique=True)
-    password = db.Column(db.String(120), nullable=False)
+    username = db.Column(db.String, nullable=False, unique=True, index=True)
+    password = db.Column(db.String(255), nullable=False)
     access = db.Column(db.String(20), nullable=False)
+    #signed into every JWT, bumping it revokes the user's tokens
+    token_version = db.Column(db.Integer, nullable=False, default=0)
+    __mapper_args__ = {"polymorphic_on": access, "polymorphic_identity": "user"}
 
     def __init__(self, username, password):
         self.username = username
         self.set_password(password)     
     
+    #the session keeps the token version with the id, so bumping it ends the user's sessions too
+    def get_id(self):
+        return f"{self.id}:{self.token_version or 0}"
+
     def to_json(self):
         return {"id": self.id, "username": self.username}
 
     def set_password(self, password):
         """Create hashed password."""
-        self.password = generate_password_hash(password, method="sha256")
+        self.password = password_hasher.hash(password)
 
     def check_password(self, password):
         """Check hashed password."""
-        return check_password_hash(self.password, password)
+        return password_hasher.check(self.password, password)
+
+    def password_needs_rehash(self):
+        """Check if the password was hashed with other settings than the current ones."""
+        return password_hasher.needs_rehash(self.password)
@@ -1,6 +1,7 @@
 #Receiver
 from App.database import db
 from datetime import datetime
+from sqlalchemy.dialects import postgresql, sqlite
 import enum
 
 class Value (enum.Enum):
@@ -8,9 +9,13 @@ class Value (enum.Enum):
     DOWNVOTE= -1
 
 class Vote (db.Model):
+    #a staff can only have one vote on a review, the index also serves lookups by staff
+    __table_args__ = (
+        db.Index("ix_vote_staff_id_review_id", "staff_id", "review_id", unique=True),
+    )
     id= db.Column(db.Integer, primary_key=True)
-    staff_id = db.Column(db.Integer, db.ForeignKey("staff.id"), nullable=False)
-    review_id = db.Column(db.Integer, db.ForeignKey("review.id"), nullable=False)
+    staff_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    review_id = db.Column(db.Integer, db.ForeignKey("review.id"), nullable=False, index=True)
     vote_command_id= db.Column(db.Integer, db.ForeignKey("voteCommand.id"), nullable=False)
     value= db.Column(db.Enum(Value), nullable=False)
 
@@ -27,4 +32,25 @@ class Vote (db.Model):
             "vote_command_id":self.vote_command_id,
             "value":self.value
         }
-       
+
+#inserts the vote of a staff on a review, or updates it if there is one, in a single
+#INSERT ... ON CONFLICT DO UPDATE statement on the unique (staff_id, review_id) index
+def upsert_vote(staff_id, review_id, vote_command_id, value):
+    if db.engine.dialect.name == "postgresql":
+        insert = postgresql.insert
+    else:
+        insert = sqlite.insert
+    statement = insert(Vote.__table__).values(
+        staff_id=staff_id, review_id=review_id, vote_command_id=vote_command_id, value=value
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["staff_id", "review_id"],
+        set_={"value": statement.excluded.value, "vote_command_id": statement.excluded.vote_command_id},
+    )
+    db.session.execute(statement)
+
+#deletes the vote of a staff on a review
+def delete_vote(staff_id, review_id):
+    db.session.execute(
+        Vote.__table__.delete().where(Vote.staff_id == staff_id, Vote.review_id == review_id)
+    )
@@ -1,8 +1,10 @@
 #Concrete Command
 from App.database import db
-from .vote import Vote, Value
+from .vote import Vote, Value, upsert_vote, delete_vote
+from .review import Review
 from .command import Command
 import enum
+from datetime import datetime
 
 class Action (enum.Enum):
     UPVOTE= "upvote"
@@ -11,73 +13,63 @@ class Action (enum.Enum):
 
 class VoteCommand (Command):
     __tablename__ = 'voteCommand'
-    staff_id = db.Column(db.Integer, db.ForeignKey("staff.id"), nullable=False)
-    review_id = db.Column(db.Integer, db.ForeignKey("review.id"), nullable=False)
+    staff_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    review_id = db.Column(db.Integer, db.ForeignKey("review.id"), nullable=False, index=True)
     action= db.Column(db.Enum(Action), nullable=False)
+    created= db.Column(db.DateTime, default=datetime.utcnow)
 
     def __init__(self, staff_id, review_id, action):
         self.staff_id= staff_id
         self.review_id=review_id
         self.action=action
+        self.created= datetime.utcnow()
 
+    #applies the command to the vote of its staff on its review, along with the review's vote counts
+    #voting the same way twice removes the vote, and the command is recorded as a remove
+    #nothing is committed, the caller commits the command and its effects in one transaction
     def execute(self)  -> None:
-        if (self.action==Action.UPVOTE or self.action==Action.DOWNVOTE):
-            self.vote()
-        elif (self.action==Action.REMOVE):
-            self.remove_vote()
-     
+        current= db.session.query(Vote.value).filter_by(staff_id=self.staff_id, review_id=self.review_id).scalar()
+        upvotes, downvotes= self.apply(current)
+        if (upvotes or downvotes):
+            Review.query.get(self.review_id).add_votes(upvotes, downvotes)
+
+    #applies the command given the current value of the vote, None if there is no vote
+    #returns the change in the number of upvotes and downvotes of the review
+    def apply(self, current):
+        if (self.get_value() is not None and self.get_value()==current):
+            self.action= Action.REMOVE
+        if (self.action==Action.REMOVE):
+            return self.remove_vote(current)
+        return self.vote(current)
+
+    #the vote value this command sets, None for a remove
+    def get_value(self):
+        if (self.action==Action.UPVOTE):
+            return Value.UPVOTE
+        elif (self.action==Action.DOWNVOTE):
+            return Value.DOWNVOTE
+        return None
 
     def to_json(self):
         return{
             "id" : self.id,
             "staff_id":self.staff_id,
             "review_id":self.review_id,
-            "action":self.action
+            "action":self.action.value
         }
 
     #handles creating and updating a vote
-    def vote(self):
-        try:
-            vote= Vote.query.filter_by(staff_id=self.staff_id, review_id=self.review_id).first()
-            if not vote:    #if voting on a review for the first time
-                if (self.action==Action.UPVOTE):
-                    vote= Vote(staff_id=self.staff_id, review_id= self.review_id, vote_command_id=self.id, value=Value.UPVOTE)
-                elif (self.action==Action.DOWNVOTE):
-                    vote= Vote(staff_id= self.staff_id, review_id= self.review_id, vote_command_id=self.id, value=Value.DOWNVOTE)
-                db.session.add(vote)
-                db.session.commit()
-                print('Vote created')
-                return None
-            else:   #if changing a vote
-                if (self.action==Action.UPVOTE):
-                    vote.value= Value.UPVOTE
-                elif (self.action==Action.DOWNVOTE):
-                    vote.value= Value.DOWNVOTE
-                db.session.add(vote)
-                db.session.commit()
-                print ('Vote updated')
-                return None
-        except Exception as e:
-            print('Error creating vote', e)
-            db.session.rollback()
-            return None
-        
-    #removes a vote if it is already and upvote and the user upvotes again or it is already a downvote and the user downvotes again
-    def remove_vote(self):
-        try:
-            vote= Vote.query.filter_by(staff_id=self.staff_id, review_id=self.review_id).first()
-            if vote:
-                db.session.delete(vote)
-                db.session.commit()
-                print ('Vote removed')
-                return None
-            else:
-                print('Vote not found')
-                return None 
-        except Exception as e:
-            print('Error removing vote', e)
-            db.session.rollback()
-            return None    
+    def vote(self, current):
+        value= self.get_value()
+        upsert_vote(self.staff_id, self.review_id, self.id, value)
+        upvotes= (value==Value.UPVOTE) - (current==Value.UPVOTE)
+        downvotes= (value==Value.DOWNVOTE) - (current==Value.DOWNVOTE)
+        return upvotes, downvotes
 
-        
-    
\ No newline at end of file
+    #removes a vote if it is already and upvote and the user upvotes again or it is already a downvote and the user downvotes again
+    def remove_vote(self, current):
+        if current is None:
+            print('Vote not found')
+            return 0, 0
+        delete_vote(self.staff_id, self.review_id)
+        return -(current==Value.UPVOTE), -(current==Value.DOWNVOTE)
@@ -0,0 +1,35 @@
+from App.database import db
+from App.models.vote import Value
+from datetime import datetime
+
+#The state of every vote as of a command in the voteCommand log, where replaying the log starts from
+class VoteSnapshot (db.Model):
+    __tablename__ = 'voteSnapshot'
+    id= db.Column(db.Integer, primary_key=True)
+    #the last command included, not a foreign key so old commands can be archived
+    command_id= db.Column(db.Integer, nullable=False, index=True)
+    created= db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    num_votes= db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, command_id, num_votes=0):
+        self.command_id= command_id
+        self.num_votes= num_votes
+        self.created= datetime.utcnow()
+
+    def to_json(self):
+        return{
+            "id": self.id,
+            "command_id": self.command_id,
+            "created": self.created.isoformat(),
+            "num_votes": self.num_votes
+        }
+
+#One vote of a snapshot, the primary key serves reading a snapshot back in order
+#staff_id and review_id are not foreign keys, deleted staff and reviews are left out when replaying
+class VoteSnapshotVote (db.Model):
+    __tablename__ = 'voteSnapshotVote'
+    snapshot_id= db.Column(db.Integer, db.ForeignKey("voteSnapshot.id"), primary_key=True)
+    staff_id= db.Column(db.Integer, primary_key=True, autoincrement=False)
+    review_id= db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value= db.Column(db.Enum(Value), nullable=False)
+    vote_command_id= db.Column(db.Integer, nullable=False)
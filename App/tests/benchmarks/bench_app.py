@@ -0,0 +1,291 @@
+import json, os, platform, shutil, tempfile, time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from App.database import create_db, db
+from App.cache import response_cache
+from App.models import Review, Staff, Student
+from App.controllers.auth import identity_cache, token_version_cache
+from App.controllers.seed import SEED_PASSWORD, seed_database
+from App.controllers import (
+    authenticate,
+    get_all_reviews_json,
+    get_all_students_json,
+    get_student,
+    vote_on_review,
+)
+
+# Benchmarks of the hot controllers and endpoints
+# Every benchmark runs against a temporary database seeded with flask seed's generator, grown
+# through each dataset size in turn, so the same sizes always get the same data.
+# A benchmark is timed for a number of iterations after one warm up run, with a fresh session
+# for each iteration so nothing is served from the identity map, and the response cache off
+# so the endpoints are timed on a miss. Each result has the latency percentiles in milliseconds
+# and the most SQL statements an iteration ran.
+# Run with flask bench run, or through pytest with flask test bench, and compare two runs with
+# flask bench compare. The file is named bench_*.py so the normal test run does not collect it.
+
+DEFAULT_BENCH_SIZES = (100, 1000, 5000)
+DEFAULT_BENCH_ITERATIONS = 20
+# A benchmark regresses when its median gets slower by more than this share
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+# Changes in the median smaller than this are noise, whatever their share
+MIN_REGRESSION_MS = 0.1
+# The dataset of each size: staff per student, reviews per student and votes per review
+BENCH_STUDENTS_PER_STAFF = 20
+BENCH_REVIEWS_PER_STUDENT = 5
+BENCH_VOTE_DENSITY = 1.0
+
+
+# Counts the SQL statements run inside the with block, on every engine
+@contextmanager
+def count_statements():
+    counted = [0]
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counted[0] += 1
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counted
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+
+def percentile(timings, share):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+# Points the app at an empty temporary database for the with block, with the caches cleared
+# and the response cache and slow query log turned off, and puts everything back after
+@contextmanager
+def bench_database(app):
+    directory = tempfile.mkdtemp(prefix="bench-")
+    saved = {key: app.config.get(key) for key in ("SQLALCHEMY_DATABASE_URI", "SLOW_QUERY_THRESHOLD_MS")}
+    backend = response_cache.backend
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(directory, "bench.db")
+    app.config["SLOW_QUERY_THRESHOLD_MS"] = float("inf")
+    response_cache.backend = None
+    db.session.remove()
+    identity_cache.clear()
+    token_version_cache.clear()
+    try:
+        create_db(app)
+        yield
+    finally:
+        db.session.remove()
+        db.engine.dispose()
+        for key, value in saved.items():
+            if value is None:
+                app.config.pop(key, None)
+            else:
+                app.config[key] = value
+        response_cache.backend = backend
+        identity_cache.clear()
+        token_version_cache.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Adds students, staff and their reviews and votes until the database has size students
+# step is the seed, a different one for each size
+def grow_dataset(size, step):
+    students = size - Student.query.count()
+    staff = max(size // BENCH_STUDENTS_PER_STAFF, 1) - Staff.query.count()
+    if students > 0 or staff > 0:
+        seed_database(max(students, 0), max(staff, 0), BENCH_REVIEWS_PER_STUDENT, BENCH_VOTE_DENSITY, seed=step)
+
+
+# The client, logins and rows the benchmarks use: a staff logged in both through /auth and the
+# session, and the review in the middle of the table with its student
+def bench_context(app):
+    staff = Staff.query.order_by(Staff.id).first()
+    review = Review.query.order_by(Review.id).offset(Review.query.count() // 2).first()
+    student = get_student(review.student_id)
+    client = app.test_client()
+    token = client.post("/auth", json={"username": staff.username, "password": SEED_PASSWORD}).json["access_token"]
+    client.post("/staff-login", data={"username": staff.username, "password": SEED_PASSWORD})
+    return {
+        "app": app,
+        "client": client,
+        "headers": {"Authorization": f"JWT {token}"},
+        "staff_id": staff.id,
+        "username": staff.username,
+        "student_id": student.id,
+        "school_id": student.school_id,
+        "review_id": review.id,
+    }
+
+
+def _get(url, json=False):
+    def benchmark(context):
+        path = url.format(**context)
+        headers = context["headers"] if json else {}
+        def run():
+            response = context["client"].get(path, headers=headers)
+            if response.status_code >= 400:
+                raise RuntimeError(f"GET {path} returned {response.status_code}")
+        return run
+    return benchmark
+
+
+def _get_karma(context):
+    def run():
+        return get_student(context["student_id"]).get_karma()
+    return run
+
+
+#voting the same way twice removes the vote, so the iterations alternate casting and removing it
+def _vote(context):
+    return lambda: vote_on_review(context["review_id"], context["staff_id"], "upvote")
+
+
+# Each benchmark is given the context and returns the function to time
+BENCHMARKS = {
+    "get_all_students_json": lambda context: get_all_students_json,
+    "get_all_reviews_json": lambda context: get_all_reviews_json,
+    "Student.get_karma": _get_karma,
+    "vote_on_review": _vote,
+    "authenticate": lambda context: lambda: authenticate(context["username"], SEED_PASSWORD),
+    "GET /api/students": _get("/api/students?limit=50", json=True),
+    "GET /api/students/<id>": _get("/api/students/{student_id}", json=True),
+    "GET /api/students/<id>/reviews": _get("/api/students/{student_id}/reviews", json=True),
+    "GET /api/reviews": _get("/api/reviews?limit=50", json=True),
+    "GET /api/reviews/<id>": _get("/api/reviews/{review_id}", json=True),
+    "GET /": _get("/"),
+    "GET /staff-students": _get("/staff-students?limit=50"),
+    "GET /staff-students/<school_id>": _get("/staff-students/{school_id}"),
+    "GET /staff-reviews": _get("/staff-reviews?limit=50"),
+}
+
+
+# Times one benchmark and returns its result
+def measure(name, size, run, iterations=DEFAULT_BENCH_ITERATIONS):
+    db.session.remove()
+    run()
+    timings = []
+    statements = 0
+    for i in range(iterations):
+        db.session.remove()
+        with count_statements() as counted:
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        statements = max(statements, counted[0])
+    return {
+        "name": name,
+        "size": size,
+        "iterations": iterations,
+        "p50_ms": round(percentile(timings, 0.5), 4),
+        "p90_ms": round(percentile(timings, 0.9), 4),
+        "p99_ms": round(percentile(timings, 0.99), 4),
+        "mean_ms": round(sum(timings) / len(timings), 4),
+        "max_ms": round(max(timings), 4),
+        "statements": statements,
+    }
+
+
+def new_report(sizes, iterations):
+    return {
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "sizes": list(sizes),
+        "iterations": iterations,
+        "results": [],
+    }
+
+
+def write_report(report, path):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+# Runs every benchmark, or the given names, at every size and returns the report
+def run_benchmarks(app, sizes=DEFAULT_BENCH_SIZES, iterations=DEFAULT_BENCH_ITERATIONS, names=None):
+    report = new_report(sizes, iterations)
+    with bench_database(app):
+        for step, size in enumerate(sorted(sizes)):
+            grow_dataset(size, step)
+            context = bench_context(app)
+            for name, benchmark in BENCHMARKS.items():
+                if names and name not in names:
+                    continue
+                report["results"].append(measure(name, size, benchmark(context), iterations))
+    return report
+
+
+# Compares two reports, returning a row for every benchmark and size in both
+# A row is a regression when the median got slower by more than threshold, or the benchmark
+# runs more SQL statements than before
+def compare_reports(base, head, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    before = {(result["name"], result["size"]): result for result in base["results"]}
+    rows = []
+    for result in head["results"]:
+        old = before.get((result["name"], result["size"]))
+        if old is None:
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        slower = change > threshold and result["p50_ms"] - old["p50_ms"] >= MIN_REGRESSION_MS
+        rows.append({
+            "name": result["name"],
+            "size": result["size"],
+            "base_p50_ms": old["p50_ms"],
+            "head_p50_ms": result["p50_ms"],
+            "change": change,
+            "base_statements": old["statements"],
+            "head_statements": result["statements"],
+            "regression": slower or result["statements"] > old["statements"],
+        })
+    return rows
+
+
+"""
+    pytest entry, run by flask test bench
+    BENCH_SIZES, BENCH_ITERATIONS, BENCH_OUTPUT, BENCH_BASELINE and BENCH_THRESHOLD configure the run
+"""
+
+BENCH_SIZES = [int(size) for size in os.environ.get("BENCH_SIZES", ",".join(map(str, DEFAULT_BENCH_SIZES))).split(",")]
+
+
+@pytest.fixture(scope="module")
+def bench_report():
+    from wsgi import app
+    report = new_report(BENCH_SIZES, int(os.environ.get("BENCH_ITERATIONS", DEFAULT_BENCH_ITERATIONS)))
+    with bench_database(app):
+        yield app, report
+    if os.environ.get("BENCH_OUTPUT"):
+        write_report(report, os.environ["BENCH_OUTPUT"])
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    path = os.environ.get("BENCH_BASELINE")
+    if not path:
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+# One dataset per size, grown in order, with the context its benchmarks share
+@pytest.fixture(scope="module", params=sorted(BENCH_SIZES))
+def bench_size(request, bench_report):
+    app, report = bench_report
+    grow_dataset(request.param, sorted(BENCH_SIZES).index(request.param))
+    return request.param, bench_context(app)
+
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_benchmark(name, bench_size, bench_report, baseline):
+    size, context = bench_size
+    app, report = bench_report
+    result = measure(name, size, BENCHMARKS[name](context), report["iterations"])
+    report["results"].append(result)
+    if baseline:
+        threshold = float(os.environ.get("BENCH_THRESHOLD", DEFAULT_REGRESSION_THRESHOLD))
+        for row in compare_reports(baseline, {"results": [result]}, threshold):
+            assert not row["regression"], (
+                f'{name} at {size}: median {row["base_p50_ms"]}ms -> {row["head_p50_ms"]}ms, '
+                f'statements {row["base_statements"]} -> {row["head_statements"]}'
+            )
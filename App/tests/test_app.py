@@ -1,11 +1,28 @@
-import pytest, logging, unittest, os
+import asyncio, pytest, re, shutil, logging, unittest, os, io, random, json, time, tempfile, multiprocessing, threading
+import jwt
+from contextlib import contextmanager
+from unittest import mock
+from datetime import datetime, timedelta
+from flask import request
+from flask_migrate import upgrade
+from sqlalchemy import event, inspect, text
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.serving import make_server
 
-from App.main import create_app
-from App.database import create_db
-from App.models import User, Student, Review, Admin, Staff
+from App.main import create_app, load_user
+from App.database import create_db, create_indexes, db, MIGRATIONS_DIRECTORY
+from App.models import User, Student, Review, Admin, Staff, Vote, VoteCommand, VoteSnapshotVote
+from sqlalchemy.exc import IntegrityError, OperationalError
 from App.models.vote import Value
-from App.controllers.auth import authenticate
+from App.models.voteCommand import Action
+from App.controllers.auth import (
+    authenticate,
+    IdentityCache,
+    get_identity,
+    get_identity_cache_stats,
+    identity,
+    revoke_tokens,
+)
 from App.controllers.user import (
     create_admin,
     create_staff,
@@ -23,7 +40,9 @@ from App.controllers.user import (
     update_staff,
     delete_user,
     delete_admin,
-    delete_staff
+    delete_staff,
+    get_user,
+    get_users_by_access,
 )
 from App.controllers.student import (
     create_student,
@@ -32,8 +51,12 @@ from App.controllers.student import (
     get_student_by_school_id,
     get_all_students,
     get_all_students_json,
+    get_all_student_reviews,
+    get_students_page,
+    search_students,
     update_student,
     delete_student,
+    recount_student_karma,
 )
 
 from App.controllers.review import (
@@ -46,18 +69,89 @@ from App.controllers.review import (
     get_all_reviews,
     get_all_reviews_json,
     get_reviews_by_student,
-    vote_on_review
+    vote_on_review,
+    vote_on_reviews,
+    vote_queue,
+    get_queued_vote_status,
+    recount_review_votes,
+    get_reviews_page_json
 )
 
 from App.controllers.vote import (
     get_staff_votes
 )
 
+from App.controllers.karma import (
+    review_karma_query,
+    student_karma_query
+)
+
+from App.controllers.pagination import get_page_args
+
+from App.controllers.student import import_students, get_students_page_json
+
+from App.controllers.voteQueue import VoteQueue
+
+from App.controllers.seed import seed_database
+
+from App.controllers.voteCommand import (
+    take_vote_snapshot,
+    rebuild_votes,
+    verify_votes,
+    replay_votes,
+    compact_vote_commands,
+    read_vote_command_archive,
+)
+
+from App.cache import (
+    MemoryBackend,
+    FileSystemBackend,
+    RespBackend,
+    RespStandIn,
+    ResponseCache,
+    bump_all_versions,
+    cache_dir,
+    response_cache,
+    setup_cache,
+)
+from App.metrics import metrics
+from App.loadtest import LoadTest, parse_stages, step_profile, target_users
+from App.hashing import PasswordHasher, PasswordHashPoolFull, password_hasher
+from App.controllers.autocomplete import PrefixIndex, build_student_index, autocomplete_students, start_student_index_sync
+
 from wsgi import app
 
 
 LOGGER = logging.getLogger(__name__)
 
+
+# Records the SQL statements run inside the with block, used to catch N+1 queries
+@contextmanager
+def count_queries():
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+# Casts the votes of one staff member from a separate process, used by the vote stress test
+def cast_votes(staff_id, votes):
+    db.session.remove()
+    db.engine.dispose()
+    for review_id, action in votes:
+        vote_on_review(review_id, staff_id, action)
+    db.session.remove()
+
+
+# Logs in through Flask-JWT and returns the header for authenticated API requests
+def get_auth_header(client, username, password):
+    response = client.post("/auth", json={"username": username, "password": password})
+    return {"Authorization": f"JWT {response.json['access_token']}"}
+
 """
    Unit Tests
 """
@@ -132,7 +226,167 @@ class StudentUnitTests(unittest.TestCase):
         self.assertEqual(student.get_karma(), 0)
 
 
+class PrefixIndexUnitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex(top_size=3, crowded=2)
+        self.index.build([
+            (1, "Ann Lee", 816100, 5),
+            (2, "Annabel Smith", 816101, 9),
+            (3, "Bob Annis", 816200, 1),
+            (4, "Annie Hall", 816102, -2),
+        ])
+
+    def ids(self, prefix, limit=10):
+        return [student["id"] for student in self.index.search(prefix, limit)]
+
+    def test_search_ranks_by_karma(self):
+        self.assertEqual(self.ids("ann"), [2, 1, 3])
+        self.assertEqual(self.ids("ANN", limit=2), [2, 1])
+        self.assertEqual(self.ids("ann lee"), [1])
+        self.assertEqual(self.ids("8162"), [3])
+        self.assertEqual(self.ids("zed"), [])
+        self.assertEqual(self.ids("  "), [])
+
+    def test_add_and_remove_update_cached_prefixes(self):
+        self.assertEqual(self.ids("a"), [2, 1, 3])
+        self.index.add(5, "Anya Ray", 816300, 7)
+        self.assertEqual(self.ids("a"), [2, 5, 1])
+        self.index.remove(2)
+        self.assertEqual(self.ids("a"), [5, 1, 3])
+        self.index.add(4, "Annie Hall", 816102, 10)
+        self.assertEqual(self.ids("a"), [4, 5, 1])
+        self.index.add(4, "Zoe Hall", 816102, 10)
+        self.assertEqual(self.ids("a"), [5, 1, 3])
+        self.assertEqual(self.ids("zoe"), [4])
+
+    # Karma changes move students within the cached top lists instead of dropping the lists
+    def test_karma_changes_keep_cached_prefixes(self):
+        self.assertEqual(self.ids("a"), [2, 1, 3])
+        top = self.index.tops["a"]
+        self.index.add_karma(3, 10)
+        self.assertEqual(self.ids("a"), [3, 2, 1])
+        self.index.add_karma(2, -20)
+        self.assertEqual(self.ids("a"), [3, 1, 4])
+        self.index.add(1, "Ann Lee", 816100, 30)
+        self.assertEqual(self.ids("a"), [1, 3, 4])
+        self.assertIs(self.index.tops["a"], top)
+        self.index.add_karma(99, 5)
+        self.assertEqual(self.ids("a", limit=2), [1, 3])
+
+
+class IdentityCacheUnitTests(unittest.TestCase):
+
+    def test_lru_and_ttl(self):
+        cache = IdentityCache(size=2, ttl=60)
+        cache.set(1, "rick")
+        cache.set(2, "morty")
+        self.assertEqual(cache.get(1), "rick")
+        cache.set(3, "summer")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "summer")
+        cache.invalidate(3)
+        self.assertIsNone(cache.get(3))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "size": 1})
+        cache.ttl = -1
+        cache.set(1, "rick")
+        self.assertIsNone(cache.get(1))
+
+
 # Unit tests for Review model
+class PasswordHasherUnitTests(unittest.TestCase):
+
+    def test_hash_settings(self):
+        for method, cost, prefix in [("pbkdf2:sha256", 1000, "pbkdf2:sha256:1000$"), ("scrypt", 1024, "scrypt:1024:8:1$"), ("sha256", None, "sha256$")]:
+            hasher = PasswordHasher()
+            hasher.configure(method, cost, workers=1)
+            pwhash = hasher.hash("mypass")
+            assert pwhash.startswith(prefix)
+            assert hasher.check(pwhash, "mypass") and not hasher.check(pwhash, "notmypass")
+            assert not hasher.needs_rehash(pwhash)
+            hasher.configure(method, 2048, workers=0)
+            self.assertEqual(hasher.needs_rehash(pwhash), cost is not None)
+            assert hasher.check(pwhash, "mypass")
+
+    def test_pool_full(self):
+        hasher = PasswordHasher()
+        hasher.configure("pbkdf2:sha256", 1000, workers=1, queue_depth=0)
+        pwhash = hasher.hash("mypass")
+        hasher.slots.acquire()
+        with self.assertRaises(PasswordHashPoolFull):
+            hasher.check(pwhash, "mypass")
+        hasher.slots.release()
+        assert hasher.check(pwhash, "mypass")
+
+
+class LoadTestUnitTests(unittest.TestCase):
+
+    def test_stages(self):
+        stages = parse_stages("10:20,5:20,10:0")
+        self.assertEqual(stages, [(10.0, 20), (5.0, 20), (10.0, 0)])
+        self.assertEqual([target_users(stages, t) for t in (0, 5, 12, 20)], [0, 10, 20, 10])
+        self.assertIsNone(target_users(stages, 25))
+        #a stage of 0 seconds jumps straight to its users
+        self.assertEqual([target_users(step_profile(8, 4), t) for t in (0, 1.5, 3.5)], [2, 4, 8])
+
+
+class CacheBackendUnitTests(unittest.TestCase):
+
+    def check_backend(self, backend):
+        backend.clear()
+        self.assertEqual(backend.get_counters(["epoch", "review:1"]), [None, None])
+        backend.add_counter("epoch", "abc")
+        backend.add_counter("epoch", "def")
+        backend.incr(["review:1", "review:1", "student:1"])
+        self.assertEqual([str(value) for value in backend.get_counters(["epoch", "review:1", "student:1"])], ["abc", "2", "1"])
+        assert backend.get("response:x") is None
+        backend.set("response:x", b'{"body": "\\n"}', 60)
+        self.assertEqual(backend.get("response:x"), b'{"body": "\\n"}')
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryBackend(size=2))
+
+    def test_filesystem_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(FileSystemBackend(directory))
+
+    # Entries replaced by newer versions are never read again, the sweep deletes them
+    def test_filesystem_backend_sweep(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileSystemBackend(directory, size=2, sweep_interval=3600)
+            backend.set("response:old", b"old", -1)
+            for i in range(3):
+                backend.set(f"response:{i}", b"body", 60 + i)
+            self.assertEqual(len(os.listdir(backend.entries)), 4)
+            backend.sweep()
+            self.assertEqual((backend.get("response:old"), backend.get("response:0")), (None, None))
+            self.assertEqual([backend.get("response:1"), backend.get("response:2")], [b"body", b"body"])
+
+    def test_cache_dir_per_database(self):
+        first = cache_dir({"SQLALCHEMY_DATABASE_URI": "sqlite:///one.db"})
+        self.assertNotEqual(first, cache_dir({"SQLALCHEMY_DATABASE_URI": "sqlite:///two.db"}))
+        self.assertNotEqual(first, cache_dir({"SQLALCHEMY_DATABASE_URI": "sqlite:///one.db", "RESPONSE_CACHE_NAMESPACE": "other"}))
+        self.assertEqual(cache_dir({"SQLALCHEMY_DATABASE_URI": "sqlite:///one.db", "RESPONSE_CACHE_DIR": "/x"}), "/x")
+
+    # Two workers with the default backend, a bump in one changes the versions the other sees
+    def test_filesystem_backend_shared_by_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = ResponseCache(FileSystemBackend(directory)), ResponseCache(FileSystemBackend(directory))
+            before = second.versions(["student:1"])
+            first.bump("student:1")
+            self.assertNotEqual(second.versions(["student:1"]), before)
+            self.assertEqual(first.versions(["student:1"]), second.versions(["student:1"]))
+
+    def test_resp_backend(self):
+        server = RespStandIn(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.check_backend(RespBackend(f"redis://127.0.0.1:{server.server_address[1]}/0"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
 class ReviewUnitTests(unittest.TestCase):
     def test_new_review(self):
         review = Review(1, 1, "good", 1)
@@ -182,9 +436,12 @@ class ReviewUnitTests(unittest.TestCase):
 # scope="class" would execute the fixture once and resued for all methods in the class
 @pytest.fixture(autouse=True, scope="module")
 def empty_db():
-    app.config.update({"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///test.db"})
+    cache_directory = tempfile.mkdtemp(prefix="test-response-cache-")
+    app.config.update({"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///test.db", "RESPONSE_CACHE_DIR": cache_directory})
+    setup_cache(app)
     create_db(app)
     yield app.test_client()
+    shutil.rmtree(cache_directory, ignore_errors=True)
     # os.unlink(os.getcwd() + "/App/test.db")
 
 
@@ -200,17 +457,17 @@ class UsersIntegrationTests(unittest.TestCase):
         assert test_admin.username == admin.username and admin.access == "admin"
 
     def test_create_staff(self):
-        test_staff = create_staff("rick", "rickpass")
-        staff = get_staff_by_username("rick")
-        assert staff.username == "rick" and staff.access =="staff"
+        test_staff = create_staff("rick_staff", "rickpass")
+        staff = get_staff_by_username("rick_staff")
+        assert staff.username == "rick_staff" and staff.access =="staff"
 
     def test_get_admin(self):
         admin = get_admin(1)
         assert "rick" == admin.username
 
     def test_get_staff(self):
-        staff = get_staff(1)
-        assert "rick" == staff.username
+        staff = get_staff(get_staff_by_username("rick_staff").id)
+        assert "rick_staff" == staff.username
 
     def test_get_all_admins_json(self):
         admins = get_all_admins()
@@ -228,9 +485,9 @@ class UsersIntegrationTests(unittest.TestCase):
         assert get_admin(admin.id).username == "Daniel"
 
     def test_update_staff(self):
-        staff = create_staff("kyle","pass")
-        update_staff(staff.id, "Daniel")
-        assert get_staff(staff.id).username == "Daniel"
+        staff = create_staff("kyle_staff","pass")
+        update_staff(staff.id, "Danielle")
+        assert get_staff(staff.id).username == "Danielle"
 
     def test_delete_admin(self):
         admin = create_admin("rob", "robpass")
@@ -239,14 +496,14 @@ class UsersIntegrationTests(unittest.TestCase):
         assert get_admin(aid) is None
     
     def test_delete_staff(self):
-        staff = create_staff("rob", "robpass")
+        staff = create_staff("rob_staff", "robpass")
         sid = staff.id
         delete_staff(sid)
         assert get_staff(sid) is None
 
     def test_staff_get_votes(self):
         test_admin = create_admin("brock", "pass")
-        test_staff = create_staff("brock", "pass")
+        test_staff = create_staff("brock_staff", "pass")
         test_student1 = create_student(test_admin.id, "billy", 998,"CS","FST")
         test_student2 = create_student(test_admin.id, "billy", 997,"CS","FST")
         test_review1 = create_review_by_student_id(test_student1.id, test_staff.id, "good", 5)
@@ -257,6 +514,34 @@ class UsersIntegrationTests(unittest.TestCase):
         for vote in votes:
             self.assertEqual(vote.staff_id, test_staff.id)
 
+    def test_update_and_delete_user_revoke_tokens(self):
+        client = app.test_client()
+        staff = create_staff("revoke-user-staff", "pass")
+        headers = get_auth_header(client, "revoke-user-staff", "pass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        update_user(staff.id, "revoke-user-staff")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        update_user(staff.id, "revoke-user-staff", "newpass")
+        assert client.get("/api/students/1", headers=headers).status_code == 401
+        assert authenticate("revoke-user-staff", "pass") is None
+        headers = get_auth_header(client, "revoke-user-staff", "newpass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        delete_user(staff.id)
+        assert client.get("/api/students/1", headers=headers).status_code == 401
+
+    def test_user_routes(self):
+        client = app.test_client()
+        create_admin("routes-admin", "pass")
+        staff = create_staff("routes-staff", "pass")
+        headers = get_auth_header(client, "routes-admin", "pass")
+        response = client.get(f"/api/user/{staff.id}", headers=headers)
+        self.assertEqual((response.status_code, response.json["username"]), (200, "routes-staff"))
+        self.assertEqual(client.get(f"/api/user/{staff.id}", headers=get_auth_header(client, "routes-staff", "pass")).status_code, 403)
+        self.assertEqual(client.delete(f"/api/users/{staff.id}", headers=headers).status_code, 200)
+        assert get_user(staff.id) is None
+        self.assertEqual(client.get(f"/api/user/{staff.id}", headers=headers).status_code, 404)
+        self.assertEqual(client.delete(f"/api/users/{staff.id}", headers=headers).status_code, 404)
+
 
 
 
@@ -386,6 +671,29 @@ class StudentIntegrationTests(unittest.TestCase):
             assert test_review.get_num_downvotes() == 1
             assert test_student.get_karma() == -5
 
+    def test_student_karma_follows_reviews(self):
+        test_staff = create_staff("sasha2", "pass")
+        test_staff2 = create_staff("historia", "pass")
+        test_student = create_student(1, "billy", 12 ,"CS","FST")
+        test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 8)
+        assert test_student.karma == 8
+        vote_on_review(test_review.id, test_staff2.id, "upvote")
+        assert test_student.karma == 11
+        update_review(test_review.id, "bad", 2)
+        assert test_student.karma == -11
+        delete_review(test_review.id)
+        assert test_student.karma == 0
+
+    def test_recount_student_karma(self):
+        test_staff = create_staff("falco", "pass")
+        test_student = create_student(1, "billy", 13 ,"CS","FST")
+        create_review_by_student_id(test_student.id, test_staff.id, "good", 7)
+        test_student.karma = 100
+        db.session.commit()
+        assert recount_student_karma(chunk_size=3) >= 1
+        assert test_student.get_karma() == 7
+        assert recount_student_karma() == 0
+
 
 
 
@@ -393,7 +701,8 @@ class StudentIntegrationTests(unittest.TestCase):
 class ReviewIntegrationTests(unittest.TestCase):
     
     def test_create_review_by_student_id(self):
-        test_review = create_review_by_student_id(1, 1, "good", 5)
+        test_staff = create_staff("gary", "pass")
+        test_review = create_review_by_student_id(1, test_staff.id, "good", 5)
         review = get_review(test_review.id)
         assert test_review.text == review.text
     
@@ -418,7 +727,8 @@ class ReviewIntegrationTests(unittest.TestCase):
         assert get_review(test_review.id).rating == 2
 
     def test_delete_review(self):
-        test_review = create_review_by_student_id(1, 4, "good", 5)
+        test_staff = create_staff("brendan", "pass")
+        test_review = create_review_by_student_id(1, test_staff.id, "good", 5)
         assert test_review.text == "good"
         delete_review(test_review.id)
         assert get_review(test_review.id) == None
@@ -438,7 +748,7 @@ class ReviewIntegrationTests(unittest.TestCase):
         test_staff = create_staff("jimmy", "pass")
         test_review = create_review_by_student_id(1, test_staff.id, "good", 5)
         i = test_review.get_num_upvotes()
-        vote_command = vote_on_review(test_review.id, 1, "upvote")
+        vote_command = vote_on_review(test_review.id, test_staff.id, "upvote")
         assert i == 0
         assert test_review.get_num_upvotes() == 1
 
@@ -446,21 +756,21 @@ class ReviewIntegrationTests(unittest.TestCase):
         test_staff = create_staff("johnathon", "pass")
         test_review = create_review_by_student_id(1, test_staff.id, "good", 5)
         i = test_review.get_num_downvotes()
-        vote_command = vote_on_review(test_review.id, 1, "downvote")
+        vote_command = vote_on_review(test_review.id, test_staff.id, "downvote")
         assert i == 0
         assert test_review.get_num_downvotes() == 1
 
     def test_review_get_karma(self):
         with self.subTest("No votes"):
             test_admin = create_admin("winston", "pass")
-            test_staff = create_staff("winston", "pass")
+            test_staff = create_staff("winston_staff", "pass")
             test_student = create_student(test_admin.id,"larry",100, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             self.assertEqual(test_review.get_karma(), 5)
         
         with self.subTest("One upvote"):
             test_admin = create_admin("vinny", "pass")
-            test_staff = create_staff("vinny", "pass")
+            test_staff = create_staff("vinny_staff", "pass")
             test_student = create_student(test_admin.id,"larry",200, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             vote_command = vote_on_review(test_review.id, test_staff.id, "upvote")
@@ -469,7 +779,7 @@ class ReviewIntegrationTests(unittest.TestCase):
 
         with self.subTest("Upvote twice by same staff"):
             test_admin = create_admin("jean", "pass")
-            test_staff = create_staff("jean", "pass")
+            test_staff = create_staff("jean_staff", "pass")
             test_student = create_student(test_admin.id,"larry",300, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             vote_command = vote_on_review(test_review.id, test_staff.id, "upvote")
@@ -481,7 +791,7 @@ class ReviewIntegrationTests(unittest.TestCase):
         
         with self.subTest("One Downvote"):
             test_admin = create_admin("gerald", "pass")
-            test_staff = create_staff("gerald", "pass")
+            test_staff = create_staff("gerald_staff", "pass")
             test_student = create_student(test_admin.id,"larry",400, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             vote_command = vote_on_review(test_review.id, test_staff.id, "downvote")
@@ -490,7 +800,7 @@ class ReviewIntegrationTests(unittest.TestCase):
 
         with self.subTest("Downvote twice by same staff"):
             test_admin = create_admin("eren", "pass")
-            test_staff = create_staff("eren", "pass")
+            test_staff = create_staff("eren_staff", "pass")
             test_student = create_student(test_admin.id,"larry",500, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             vote_command = vote_on_review(test_review.id, test_staff.id, "downvote")
@@ -502,7 +812,7 @@ class ReviewIntegrationTests(unittest.TestCase):
 
         with self.subTest("Upvote then downvote by same staff"):
             test_admin = create_admin("levi", "pass")
-            test_staff = create_staff("levi", "pass")
+            test_staff = create_staff("levi_staff", "pass")
             test_student = create_student(test_admin.id,"larry",600, "CS", "FST")
             test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
             vote_command = vote_on_review(test_review.id, test_staff.id, "upvote")
@@ -515,7 +825,7 @@ class ReviewIntegrationTests(unittest.TestCase):
 
     def test_review_get_all_votes(self):
         test_admin = create_admin("finn", "pass")
-        test_staff = create_staff("finn", "pass")
+        test_staff = create_staff("finn_staff", "pass")
         test_staff2 = create_staff("polly", "pass")
         test_student = create_student(test_admin.id,"larry",700, "CS", "FST")
         test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5) 
@@ -525,13 +835,1161 @@ class ReviewIntegrationTests(unittest.TestCase):
         for vote in votes:
             self.assertEqual(vote.value, Value.UPVOTE)
     
+    def test_vote_counts_stored_on_review(self):
+        test_admin = create_admin("sasha", "pass")
+        test_staff = create_staff("sasha_staff", "pass")
+        test_staff2 = create_staff("connie2", "pass")
+        test_student = create_student(test_admin.id,"larry",750, "CS", "FST")
+        test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
+        vote_on_review(test_review.id, test_staff.id, "upvote")
+        vote_on_review(test_review.id, test_staff2.id, "downvote")
+        self.assertEqual((test_review.num_upvotes, test_review.num_downvotes), (1, 1))
+        vote_on_review(test_review.id, test_staff2.id, "upvote")
+        self.assertEqual((test_review.num_upvotes, test_review.num_downvotes), (2, 0))
+        vote_on_review(test_review.id, test_staff.id, "upvote")
+        self.assertEqual((test_review.num_upvotes, test_review.num_downvotes), (1, 0))
+
+    def test_recount_review_votes(self):
+        test_admin = create_admin("ymir", "pass")
+        test_staff = create_staff("ymir_staff", "pass")
+        test_student = create_student(test_admin.id,"larry",760, "CS", "FST")
+        test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
+        vote_on_review(test_review.id, test_staff.id, "upvote")
+        test_review.num_upvotes = 7
+        test_review.num_downvotes = 3
+        db.session.commit()
+        assert recount_review_votes(chunk_size=2) >= 1
+        self.assertEqual(test_review.get_num_upvotes(), 1)
+        self.assertEqual(test_review.get_num_downvotes(), 0)
+        assert recount_review_votes() == 0
+
+    def test_unique_review_and_vote(self):
+        test_admin = create_admin("kenny", "pass")
+        test_staff = create_staff("kenny_staff", "pass")
+        test_student = create_student(test_admin.id,"larry",770, "CS", "FST")
+        test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)
+        assert create_review_by_student_id(test_student.id, test_staff.id, "again", 9) == "Review exists"
+        assert len(get_reviews_by_student(test_student.id)) == 1
+        assert test_student.get_karma() == 5
+        vote_command = vote_on_review(test_review.id, test_staff.id, "upvote")
+        db.session.add(Vote(test_staff.id, test_review.id, vote_command["id"], Value.DOWNVOTE))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
     def test_get_review_by_student(self):
         test_admin = create_admin("misty", "pass")
-        test_staff = create_staff("misty", "pass")
+        test_staff = create_staff("misty_staff", "pass")
         test_student = create_student(test_admin.id,"larry",800, "CS", "FST")
         test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 5)       
         reviews = get_reviews_by_student(test_student.id)
         for review in reviews:
             self.assertEqual(test_review.id, review.id)
 
-        
+
+# Integration tests for the SQL karma engine
+# The model methods are the reference implementation, the engine must agree with them on any data
+class KarmaEngineIntegrationTests(unittest.TestCase):
+
+    def test_engine_matches_python_karma(self):
+        rng = random.Random(3613)
+        for n in range(3):
+            admin = create_admin(f"karma-admin-{n}", "pass")
+            staffs = [create_staff(f"karma-staff-{n}-{i}", "pass") for i in range(6)]
+            students = [
+                create_student(admin.id, "karma", 5000 + n * 100 + i, "CS", "FST")
+                for i in range(4)
+            ]
+            reviews = []
+            for student in students:
+                for staff in rng.sample(staffs, rng.randint(0, 4)):
+                    reviews.append(
+                        create_review_by_student_id(student.id, staff.id, "text", rng.randint(1, 10))
+                    )
+            for i in range(40):
+                review = rng.choice(reviews)
+                staff = rng.choice(staffs)
+                vote_on_review(review.id, staff.id, rng.choice(["upvote", "downvote"]))
+
+            for row in review_karma_query():
+                review = get_review(row.id)
+                num_upvotes = len([vote for vote in review.votes if vote.value == Value.UPVOTE])
+                num_downvotes = len([vote for vote in review.votes if vote.value == Value.DOWNVOTE])
+                self.assertEqual(row.karma, review.get_karma())
+                self.assertEqual((row.num_upvotes, row.num_downvotes), (num_upvotes, num_downvotes))
+
+            for row in student_karma_query():
+                student = get_student(row.id)
+                self.assertEqual(row.karma, student.compute_karma())
+                self.assertEqual(row.karma, student.get_karma())
+
+    def test_get_all_student_reviews(self):
+        reviews, status = get_all_student_reviews(1)
+        assert status == 200
+        assert reviews == [review.to_json() for review in get_reviews_by_student(1)]
+        assert get_all_student_reviews(0)[1] == 404
+
+
+# Integration tests for keyset pagination
+class PaginationIntegrationTests(unittest.TestCase):
+
+    def test_get_page_args(self):
+        with app.test_request_context("/?after=5&limit=100000"):
+            after, limit = get_page_args(request.args)
+            assert after == 5
+            assert limit == 100
+        with app.test_request_context("/?after=x&limit=y"):
+            assert get_page_args(request.args) == (None, 20)
+
+    def test_reviews_pages_cover_all_reviews(self):
+        pages = []
+        reviews, next_cursor = get_reviews_page_json(limit=3)
+        pages += reviews
+        while next_cursor:
+            reviews, next_cursor = get_reviews_page_json(after=next_cursor, limit=3)
+            assert len(reviews) <= 3
+            pages += reviews
+        assert pages == get_all_reviews_json()
+
+    # Pages are read from the stored counters, with no aggregate over the vote table
+    def test_pages_match_stored_counters(self):
+        admin = create_admin("page-counters-admin", "pass")
+        staff = create_staff("page-counters-staff", "pass")
+        student = create_student(admin.id, "Falco Grice", 812001, "CS", "FST")
+        review = create_review_by_student_id(student.id, staff.id, "Quick", 8)
+        vote_on_review(review.id, staff.id, "upvote")
+        with count_queries() as statements:
+            students, next_cursor = get_students_page_json(after=student.id - 1, limit=1)
+            reviews, next_cursor = get_reviews_page_json(after=review.id - 1, limit=1)
+        assert not [statement for statement in statements if re.search(r"(from|join) vote\b", statement.lower())]
+        self.assertEqual(students, [get_student(student.id).to_json()])
+        self.assertEqual(reviews, [get_review(review.id).to_json()])
+        self.assertEqual((reviews[0]["num_upvotes"], reviews[0]["karma"], students[0]["karma"]), (1, 11, 11))
+
+    def test_api_reviews_link_header(self):
+        client = app.test_client()
+        create_staff("pieck", "pass")
+        headers = get_auth_header(client, "pieck", "pass")
+        response = client.get("/api/reviews?limit=2", headers=headers)
+        assert response.status_code == 200
+        assert len(response.json) == 2
+        assert 'rel="next"' in response.headers["Link"]
+        assert f"after={response.json[-1]['id']}" in response.headers["Link"]
+
+    def test_staff_students_page_navigation(self):
+        client = app.test_client()
+        create_staff("porco", "pass")
+        client.post("/staff-login", data={"username": "porco", "password": "pass"})
+        students, next_cursor = get_students_page(limit=1)
+        response = client.get("/staff-students?limit=1")
+        assert response.status_code == 200
+        assert f"after={next_cursor}".encode() in response.data
+        response = client.get(f"/staff-students?limit=1&after={next_cursor}")
+        assert b"First page" in response.data
+
+
+# Integration tests for the streaming exports
+class StreamingIntegrationTests(unittest.TestCase):
+
+    def test_stream_reviews_ndjson(self):
+        client = app.test_client()
+        create_staff("colt", "pass")
+        headers = get_auth_header(client, "colt", "pass")
+        app.config["STREAM_CHUNK_SIZE"] = 3
+        response = client.get("/api/reviews/stream", headers=headers)
+        del app.config["STREAM_CHUNK_SIZE"]
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.data.decode().splitlines()
+        assert [json.loads(line) for line in lines] == get_all_reviews_json()
+
+    def test_stream_students_array(self):
+        client = app.test_client()
+        create_staff("marco", "pass")
+        headers = get_auth_header(client, "marco", "pass")
+        app.config["STREAM_CHUNK_SIZE"] = 4
+        response = client.get("/api/students/stream?format=array", headers=headers)
+        del app.config["STREAM_CHUNK_SIZE"]
+        assert response.status_code == 200
+        assert json.loads(response.data) == get_all_students_json()
+
+
+# Integration tests for the number of SQL statements each endpoint runs
+# The counts must not grow with the number of rows, so an N+1 query fails here
+class QueryCountIntegrationTests(unittest.TestCase):
+
+    # the JWT identity comes from the identity cache after the first request, so every statement serves the request
+    def test_json_endpoints(self):
+        client = app.test_client()
+        create_staff("yelena", "pass")
+        headers = get_auth_header(client, "yelena", "pass")
+        client.get("/api/students/1", headers=headers)
+        #the warm up response is cached, start from an empty response cache
+        bump_all_versions()
+        expected = {
+            "/api/reviews?limit=50": 1,
+            "/api/students?limit=50": 1,
+            "/api/students/1/reviews": 2,
+            "/api/reviews/1": 1,
+            "/api/students/1": 1,
+        }
+        for url, num_statements in expected.items():
+            with count_queries() as statements:
+                response = client.get(url, headers=headers)
+            assert response.status_code == 200
+            self.assertEqual(len(statements), num_statements, url)
+        #the cached responses run no statement at all
+        for url in ["/api/reviews?limit=50", "/api/students/1/reviews", "/api/reviews/1", "/api/students/1"]:
+            with count_queries() as statements:
+                assert client.get(url, headers=headers).status_code == 200
+            self.assertEqual(statements, [], url)
+
+    # the Flask-Login user comes from the identity cache after the first request
+    def test_html_endpoints(self):
+        client = app.test_client()
+        create_staff("onyankopon", "pass")
+        client.post("/staff-login", data={"username": "onyankopon", "password": "pass"})
+        school_id = get_student(1).school_id
+        client.get("/staff-students?limit=1")
+        expected = {
+            "/staff-students?limit=50": 1,
+            "/staff-reviews?limit=50": 1,
+            "/admin-students?limit=50": 1,
+            "/admin-reviews?limit=50": 1,
+            f"/staff-students/{school_id}": 2,
+        }
+        for url, num_statements in expected.items():
+            with count_queries() as statements:
+                response = client.get(url)
+            assert response.status_code == 200
+            self.assertEqual(len(statements), num_statements, url)
+
+    def test_loading_profiles(self):
+        reviews = get_reviews_by_student(1, profile="with_votes")
+        with count_queries() as statements:
+            for review in reviews:
+                review.votes
+        assert statements == []
+        with self.assertRaises(ValueError):
+            get_all_reviews(profile="everything")
+
+
+# Stress test for votes cast at the same time from several processes
+class VoteConcurrencyIntegrationTests(unittest.TestCase):
+
+    def test_concurrent_votes(self):
+        rng = random.Random(2022)
+        admin = create_admin("stress-admin", "pass")
+        author = create_staff("stress-author", "pass")
+        staffs = [create_staff(f"stress-staff-{i}", "pass") for i in range(6)]
+        reviews = [
+            create_review_by_student_id(
+                create_student(admin.id, "stress", 9000 + i, "CS", "FST").id, author.id, "text", rating
+            )
+            for i, rating in enumerate([3, 5, 8])
+        ]
+        review_ids = [review.id for review in reviews]
+        #the first four staff vote from one process each, the last two from two processes at once
+        plans = [
+            (staff.id, [(rng.choice(review_ids), rng.choice(["upvote", "downvote"])) for i in range(30)])
+            for staff in staffs[:4] + staffs[4:] + staffs[4:]
+        ]
+
+        db.session.remove()
+        db.engine.dispose()
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=cast_votes, args=plan) for plan in plans]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(120)
+            self.assertEqual(process.exitcode, 0)
+
+        votes = Vote.query.filter(Vote.review_id.in_(review_ids)).all()
+        actual = {(vote.staff_id, vote.review_id): vote.value for vote in votes}
+        commands = VoteCommand.query.filter(VoteCommand.review_id.in_(review_ids)).order_by(VoteCommand.id).all()
+        self.assertEqual(len(commands), 30 * len(plans))
+
+        #replaying the command log in order gives the votes, and every vote points at its latest command
+        replayed = {}
+        last_command = {}
+        for command in commands:
+            key = (command.staff_id, command.review_id)
+            replayed[key] = command.get_value()
+            last_command[key] = command.id
+        self.assertEqual(actual, {key: value for key, value in replayed.items() if value is not None})
+        for vote in votes:
+            self.assertEqual(vote.vote_command_id, last_command[(vote.staff_id, vote.review_id)])
+
+        #a staff voting from a single process toggles exactly as if the votes were cast one by one
+        for staff_id, plan in plans[:4]:
+            expected = {}
+            for review_id, action in plan:
+                value = Value.UPVOTE if action == "upvote" else Value.DOWNVOTE
+                expected[review_id] = None if expected.get(review_id) == value else value
+            for review_id, value in expected.items():
+                self.assertEqual(actual.get((staff_id, review_id)), value)
+
+        for review_id in review_ids:
+            review = get_review(review_id)
+            values = [value for (staff_id, vote_review_id), value in actual.items() if vote_review_id == review_id]
+            self.assertEqual(review.num_upvotes, values.count(Value.UPVOTE))
+            self.assertEqual(review.num_downvotes, values.count(Value.DOWNVOTE))
+            self.assertEqual(review.student.get_karma(), review.student.compute_karma())
+
+
+# Integration tests for the student search index
+class StudentSearchIntegrationTests(unittest.TestCase):
+
+    def test_search_students(self):
+        admin = create_admin("search-admin", "pass")
+        zeke = create_student(admin.id, "Zeke Jaeger", 816001, "Zoology", "FST")
+        create_student(admin.id, "Grisha Jaeger", 816002, "Medicine", "FMS")
+        with self.subTest("Name prefix"):
+            names = [student.name for student in search_students("jaeg")]
+            self.assertCountEqual(names, ["Zeke Jaeger", "Grisha Jaeger"])
+        with self.subTest("Every word must match, once per student"):
+            students = search_students("zeke zoology jaeger")
+            self.assertEqual([student.id for student in students], [zeke.id])
+        with self.subTest("School id"):
+            self.assertEqual([student.id for student in search_students("816001")], [zeke.id])
+        with self.subTest("Pages"):
+            first = search_students("jaeger", page=1, limit=1)
+            second = search_students("jaeger", page=2, limit=1)
+            self.assertEqual(len(first + second), 2)
+            self.assertNotEqual(first[0].id, second[0].id)
+        with self.subTest("Kept in sync on update and delete"):
+            update_student(admin.id, zeke.id, "Zeke Fritz", 816001, "Zoology", "FST")
+            self.assertEqual([student.id for student in search_students("fritz")], [zeke.id])
+            self.assertEqual([student.name for student in search_students("jaeger")], ["Grisha Jaeger"])
+            delete_student(zeke.id, admin.id)
+            self.assertEqual(search_students("fritz"), [])
+        with self.subTest("No words"):
+            self.assertEqual(search_students("*%"), [])
+
+    def test_search_endpoint(self):
+        client = app.test_client()
+        admin = create_admin("search-staff", "pass")
+        create_staff("search-staff", "pass")
+        create_student(admin.id, "Kruger", 816003, "History", "FHE")
+        create_student(admin.id, "Kruger Eren", 816004, "History", "FHE")
+        headers = get_auth_header(client, "search-staff", "pass")
+        response = client.get("/api/students/search/krug", headers=headers)
+        assert response.status_code == 200
+        self.assertCountEqual([student["name"] for student in response.json], ["Kruger", "Kruger Eren"])
+        first = client.get("/api/students/search/krug?limit=1", headers=headers).json
+        second = client.get("/api/students/search/krug?limit=1&page=2", headers=headers).json
+        self.assertEqual(len(first + second), 2)
+        self.assertNotEqual(first[0]["id"], second[0]["id"])
+        response = client.get(f"/api/students/search/krug?limit=1&after={first[0]['id']}", headers=headers)
+        assert response.status_code == 400
+        response = client.get("/api/students/search/nobody", headers=headers)
+        assert response.status_code == 404
+
+
+class AutocompleteIntegrationTests(unittest.TestCase):
+
+    def test_autocomplete_students(self):
+        build_student_index()
+        admin = create_admin("autocomplete-admin", "pass")
+        staff = create_staff("autocomplete-staff", "pass")
+        mikasa = create_student(admin.id, "Mikasa Ackerman", 817001, "History", "FHE")
+        levi = create_student(admin.id, "Levi Ackerman", 817002, "History", "FHE")
+        review = create_review_by_student_id(levi.id, staff.id, "Strongest", 10)
+        with self.subTest("Prefix of a word, highest karma first"):
+            self.assertEqual([s["id"] for s in autocomplete_students("acker")], [levi.id, mikasa.id])
+        with self.subTest("Votes re-rank the students"):
+            create_review_by_student_id(mikasa.id, staff.id, "Loyal", 10)
+            vote_on_review(review.id, staff.id, "downvote")
+            results = autocomplete_students("acker")
+            self.assertEqual([s["id"] for s in results], [mikasa.id, levi.id])
+            self.assertEqual(results[1]["karma"], get_student(levi.id).karma)
+        with self.subTest("School id"):
+            self.assertEqual([s["id"] for s in autocomplete_students("817001")], [mikasa.id])
+        with self.subTest("Deleted students are removed"):
+            delete_student(mikasa.id, admin.id)
+            self.assertEqual([s["id"] for s in autocomplete_students("mika")], [])
+
+    # A change made by another worker, written straight to the table, shows up after the next sync
+    def test_autocomplete_syncs_with_database(self):
+        admin = create_admin("autocomplete-sync", "pass")
+        eren = create_student(admin.id, "Eren Yeager", 817004, "History", "FHE")
+        zeke = create_student(admin.id, "Zeke Yeager", 817005, "History", "FHE")
+        autocomplete_students("yeager")
+        db.session.execute(Student.__table__.update().where(Student.id == zeke.id).values(karma=50))
+        db.session.execute(Student.__table__.delete().where(Student.id == eren.id))
+        db.session.commit()
+        self.assertEqual(len(autocomplete_students("yeager")), 2)
+        stop = start_student_index_sync(app, interval=0.05)
+        try:
+            for attempt in range(100):
+                results = autocomplete_students("yeager")
+                if len(results) == 1:
+                    break
+                time.sleep(0.05)
+        finally:
+            stop.set()
+        self.assertEqual([(s["id"], s["karma"]) for s in results], [(zeke.id, 50)])
+
+    # A rolled back vote leaves the index alone
+    def test_rolled_back_karma_is_not_indexed(self):
+        admin = create_admin("autocomplete-rollback", "pass")
+        student = create_student(admin.id, "Grisha Yeager", 817006, "Medicine", "FMS")
+        review = Review(create_staff("autocomplete-rollback-staff", "pass").id, student.id, "Doctor", 9)
+        db.session.add(review)
+        review.add_student_karma(review.get_karma())
+        db.session.rollback()
+        self.assertEqual(autocomplete_students("grisha")[0]["karma"], 0)
+
+    def test_autocomplete_endpoint(self):
+        client = app.test_client()
+        admin = create_admin("autocomplete-endpoint", "pass")
+        create_staff("autocomplete-endpoint", "pass")
+        create_student(admin.id, "Armin Arlert", 817003, "History", "FHE")
+        headers = get_auth_header(client, "autocomplete-endpoint", "pass")
+        autocomplete_students("arm")
+        with count_queries() as statements:
+            response = client.get("/api/students/autocomplete?q=arm&k=5", headers=headers)
+        assert response.status_code == 200
+        assert [student["name"] for student in response.json] == ["Armin Arlert"]
+        assert not [s for s in statements if "student" in s.lower()]
+        response = client.get("/api/students/autocomplete?q=nobody", headers=headers)
+        assert response.status_code == 200 and response.json == []
+
+
+class VoteBatchIntegrationTests(unittest.TestCase):
+
+    def test_vote_on_reviews(self):
+        admin = create_admin("batch-admin", "pass")
+        staff = create_staff("batch-voter", "pass")
+        reviewer = create_staff("batch-reviewer", "pass")
+        student = create_student(admin.id, "Hange Zoe", 818001, "Chemistry", "FST")
+        other = create_student(admin.id, "Moblit Berner", 818002, "Chemistry", "FST")
+        review = create_review_by_student_id(student.id, reviewer.id, "Curious", 8)
+        other_review = create_review_by_student_id(other.id, reviewer.id, "Loyal", 3)
+        vote_on_review(other_review.id, staff.id, "downvote")
+        commands = vote_on_reviews(staff.id, [
+            {"review_id": review.id, "action": "upvote"},
+            {"review_id": other_review.id, "action": "downvote"},
+            {"review_id": review.id, "action": "downvote"},
+        ])
+        self.assertEqual([command["action"] for command in commands], ["upvote", "remove", "downvote"])
+        review, other_review = get_review(review.id), get_review(other_review.id)
+        self.assertEqual((review.get_num_upvotes(), review.get_num_downvotes()), (0, 1))
+        self.assertEqual((other_review.get_num_upvotes(), other_review.get_num_downvotes()), (0, 0))
+        self.assertEqual(get_student(student.id).get_karma(), get_student(student.id).compute_karma())
+        self.assertEqual(get_student(other.id).get_karma(), get_student(other.id).compute_karma())
+
+    def test_vote_on_reviews_rejects_the_whole_batch(self):
+        admin = create_admin("batch-reject-admin", "pass")
+        staff = create_staff("batch-reject-voter", "pass")
+        student = create_student(admin.id, "Erwin Smith", 818003, "Politics", "FSS")
+        review = create_review_by_student_id(student.id, staff.id, "Commander", 9)
+        valid = {"review_id": review.id, "action": "upvote"}
+        for votes in (
+            [valid, {"review_id": review.id, "action": "sideways"}],
+            [valid, {"review_id": "x", "action": "upvote"}],
+            [valid, {"review_id": 999999, "action": "upvote"}],
+            [],
+        ):
+            with self.subTest(votes=votes):
+                self.assertIsInstance(vote_on_reviews(staff.id, votes), str)
+                self.assertEqual(get_review(review.id).get_num_upvotes(), 0)
+        self.assertIsInstance(vote_on_reviews(staff.id, [valid] * 3, max_size=2), str)
+
+    def test_vote_batch_endpoint(self):
+        client = app.test_client()
+        admin = create_admin("batch-endpoint-admin", "pass")
+        staff = create_staff("batch-endpoint", "pass")
+        students = [create_student(admin.id, f"Scout {i}", 818100 + i, "History", "FHE") for i in range(20)]
+        reviews = [create_review_by_student_id(s.id, staff.id, "Brave", 7) for s in students]
+        headers = get_auth_header(client, "batch-endpoint", "pass")
+        votes = [{"review_id": review.id, "action": "upvote"} for review in reviews]
+        with count_queries() as statements:
+            response = client.post("/api/votes/batch", json={"votes": votes}, headers=headers)
+        assert response.status_code == 200
+        assert len(response.json) == 20
+        assert all(get_review(review.id).get_num_upvotes() == 1 for review in reviews)
+        #one IN query for the reviews and one for the current votes, not one query per vote
+        assert len([s for s in statements if s.lstrip().upper().startswith("SELECT")]) <= 4
+        response = client.post("/api/votes/batch", json=[{"review_id": reviews[0].id}], headers=headers)
+        assert response.status_code == 400
+
+
+class StudentImportIntegrationTests(unittest.TestCase):
+
+    def test_import_students(self):
+        admin = create_admin("import-admin", "pass")
+        create_student(admin.id, "Old Name", 819001, "History", "FHE")
+        roster = io.StringIO(
+            "school_id,name,programme,faculty\n"
+            "819001,Reiner Braun,Engineering,FET\n"
+            "819002,Bertolt Hoover,Engineering,FET\n"
+            "notanumber,Annie Leonhart,Law,FSS\n"
+            "819003,,Law,FSS\n"
+            "819004,Porco Galliard,Law,FSS\n"
+            "819004,Marcel Galliard,Law,FSS\n"
+        )
+        report = import_students(admin.id, roster, batch_size=2)
+        self.assertEqual((report["created"], report["updated"], report["skipped"]), (2, 1, 2))
+        self.assertEqual([error["row"] for error in report["errors"]], [4, 5])
+        self.assertEqual(get_student_by_school_id(819001).name, "Reiner Braun")
+        self.assertEqual(get_student_by_school_id(819004).name, "Marcel Galliard")
+        self.assertEqual(Student.query.filter_by(school_id=819004).count(), 1)
+        self.assertEqual([s["name"] for s in autocomplete_students("bertolt")], ["Bertolt Hoover"])
+
+    def test_import_students_checks_columns_and_admin(self):
+        report = import_students(create_admin("import-columns", "pass").id, io.StringIO("school_id,name\n1,Eren\n"))
+        self.assertEqual(report["errors"], [{"row": 1, "error": "missing columns programme, faculty"}])
+        self.assertIsNone(import_students(999999, io.StringIO("")))
+
+    def test_import_endpoint(self):
+        client = app.test_client()
+        create_admin("import-endpoint-admin", "pass")
+        create_staff("import-endpoint", "pass")
+        headers = get_auth_header(client, "import-endpoint-admin", "pass")
+        roster = b"school_id,name,programme,faculty\n819010,Pieck Finger,Law,FSS\n"
+        response = client.post(
+            "/api/students/import",
+            data={"file": (io.BytesIO(roster), "roster.csv")},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert response.json["created"] == 1
+        response = client.post("/api/students/import", data=roster, content_type="text/csv", headers=headers)
+        assert response.json["updated"] == 1
+
+    #only an admin can import or add students, whatever admin id the request names
+    def test_import_endpoint_needs_admin(self):
+        client = app.test_client()
+        admin = create_admin("import-gate-admin", "pass")
+        create_staff("import-gate-staff", "pass")
+        headers = get_auth_header(client, "import-gate-staff", "pass")
+        roster = b"school_id,name,programme,faculty\n819011,Porco Galliard,Law,FSS\n"
+        response = client.post(f"/api/students/import?admin_id={admin.id}", data=roster, content_type="text/csv", headers=headers)
+        self.assertEqual(response.status_code, 403)
+        student = {"admin_id": admin.id, "name": "Porco Galliard", "school_id": 819011, "programme": "Law", "faculty": "FSS"}
+        self.assertEqual(client.post("/api/add-student", json=student, headers=headers).status_code, 403)
+        self.assertIsNone(get_student_by_school_id(819011))
+        admin_headers = get_auth_header(client, "import-gate-admin", "pass")
+        self.assertEqual(client.post("/api/add-student", json=student, headers=admin_headers).status_code, 201)
+
+
+class VoteQueueIntegrationTests(unittest.TestCase):
+
+    def test_group_commit_keeps_order(self):
+        batches = []
+        def apply(votes):
+            batches.append(votes)
+            return [{"vote": vote} for vote in votes]
+        queue = VoteQueue(apply)
+        tickets = [queue.submit((1, 1, i)) for i in range(50)]
+        for _ in range(500):
+            if all(queue.status(ticket)["status"] != "queued" for ticket in tickets):
+                break
+            time.sleep(0.01)
+        self.assertEqual([queue.status(ticket)["command"]["vote"] for ticket in tickets], [(1, 1, i) for i in range(50)])
+        self.assertEqual([vote for batch in batches for vote in batch], [(1, 1, i) for i in range(50)])
+        self.assertLess(len(batches), 50)
+        self.assertIsNone(queue.status("unknown"))
+
+    def test_ticket_status_shared_between_workers(self):
+        queue = VoteQueue(lambda votes: [{"vote": vote} for vote in votes])
+        ticket = queue.submit((1, 1, "upvote"))
+        queue.flush()
+        #another worker's queue finds the status through the response cache backend
+        self.assertEqual(VoteQueue(None).status(ticket), {"ticket": ticket, "status": "applied", "command": {"vote": [1, 1, "upvote"]}})
+        self.assertIsNone(VoteQueue(None).status("unknown"))
+
+    def test_queued_votes(self):
+        admin = create_admin("queue-admin", "pass")
+        staff = create_staff("queue-voter", "pass")
+        student = create_student(admin.id, "Sasha Blouse", 820001, "Culinary", "FFA")
+        review = create_review_by_student_id(student.id, staff.id, "Hungry", 7)
+        client = app.test_client()
+        headers = get_auth_header(client, "queue-voter", "pass")
+        app.config["VOTE_QUEUE_ENABLED"] = True
+        try:
+            tickets = [vote_on_review(review.id, staff.id, action)["ticket"] for action in ("upvote", "upvote", "downvote")]
+            self.assertEqual(vote_on_review(999999, staff.id, "upvote"), "Must have a Staff account to vote")
+            self.assertEqual(vote_on_review(review.id, admin.id, "upvote"), "Must have a Staff account to vote")
+            self.assertEqual(vote_on_review(review.id, staff.id, "sideways"), "Invalid action")
+            assert client.put("/api/reviews/999999/upvote", headers=headers).status_code == 400
+            response = client.put(f"/api/reviews/{review.id}/upvote", headers=headers)
+            assert response.status_code == 202
+            vote_queue.flush()
+        finally:
+            app.config["VOTE_QUEUE_ENABLED"] = False
+        actions = [get_queued_vote_status(ticket)["command"]["action"] for ticket in tickets]
+        self.assertEqual(actions, ["upvote", "remove", "downvote"])
+        response = client.get(f"/api/votes/queue/{response.json['ticket']}", headers=headers)
+        assert response.json["status"] == "applied" and response.json["command"]["action"] == "upvote"
+        #the votes may have been applied by the queue's thread, with this session's copies left stale
+        db.session.expire_all()
+        review = get_review(review.id)
+        self.assertEqual((review.get_num_upvotes(), review.get_num_downvotes()), (1, 0))
+        self.assertEqual(get_student(student.id).get_karma(), get_student(student.id).compute_karma())
+
+
+class VoteReplayIntegrationTests(unittest.TestCase):
+
+    def test_rebuild_votes_from_log(self):
+        admin = create_admin("replay-admin", "pass")
+        staffs = [create_staff(f"replay-staff-{i}", "pass") for i in range(3)]
+        student = create_student(admin.id, "Connie Springer", 821001, "Geography", "FSS")
+        review = create_review_by_student_id(student.id, staffs[0].id, "Fast", 8)
+        vote_on_review(review.id, staffs[0].id, "upvote")
+        vote_on_review(review.id, staffs[1].id, "downvote")
+        snapshot = take_vote_snapshot(chunk_size=1)
+        self.assertEqual(take_vote_snapshot().id, snapshot.id)
+        votes = VoteSnapshotVote.query.filter_by(snapshot_id=snapshot.id).filter(VoteSnapshotVote.review_id == review.id)
+        self.assertEqual(
+            sorted((vote.staff_id, vote.value) for vote in votes),
+            [(staffs[0].id, Value.UPVOTE), (staffs[1].id, Value.DOWNVOTE)],
+        )
+        self.assertEqual(snapshot.num_votes, VoteSnapshotVote.query.filter_by(snapshot_id=snapshot.id).count())
+        vote_on_review(review.id, staffs[1].id, "downvote")
+        vote_on_review(review.id, staffs[2].id, "upvote")
+        self.assertEqual(verify_votes()["missing"] + verify_votes()["changed"] + verify_votes()["extra"], 0)
+        state, report = replay_votes()
+        self.assertEqual((report["snapshot"], report["replayed"]), (snapshot.id, 2))
+
+        #a bad deploy drops one vote, flips another and double counts the review
+        db.session.delete(Vote.query.filter_by(staff_id=staffs[2].id, review_id=review.id).first())
+        Vote.query.filter_by(staff_id=staffs[0].id, review_id=review.id).first().value = Value.DOWNVOTE
+        get_review(review.id).num_upvotes = 5
+        db.session.commit()
+        report = verify_votes()
+        self.assertEqual((report["missing"], report["changed"], report["extra"]), (1, 1, 0))
+
+        report = rebuild_votes(since=snapshot.command_id)
+        self.assertEqual(report["snapshot"], snapshot.id)
+        self.assertEqual((report["missing"], report["changed"]), (1, 1))
+        review = get_review(review.id)
+        self.assertEqual((review.get_num_upvotes(), review.get_num_downvotes()), (2, 0))
+        self.assertEqual(get_student(student.id).get_karma(), get_student(student.id).compute_karma())
+        report = verify_votes()
+        self.assertEqual((report["missing"], report["changed"], report["extra"]), (0, 0, 0))
+
+    def test_rebuild_command_exit_code(self):
+        admin = create_admin("replay-command-admin", "pass")
+        staff = create_staff("replay-command-staff", "pass")
+        student = create_student(admin.id, "Sasha Blouse", 821003, "Archery", "FFA")
+        review = create_review_by_student_id(student.id, staff.id, "Hungry", 7)
+        vote_on_review(review.id, staff.id, "upvote")
+        Vote.query.filter_by(staff_id=staff.id, review_id=review.id).first().value = Value.DOWNVOTE
+        db.session.commit()
+        runner = app.test_cli_runner()
+        self.assertEqual(runner.invoke(args=["vote", "verify"]).exit_code, 1)
+        self.assertEqual(runner.invoke(args=["vote", "rebuild"]).exit_code, 0)
+        self.assertEqual(runner.invoke(args=["vote", "verify"]).exit_code, 0)
+        #a rebuild that leaves the votes different from the log fails
+        mismatch = {"votes": 1, "missing": 0, "changed": 1, "extra": 0}
+        with mock.patch("wsgi.verify_votes", return_value=mismatch):
+            result = runner.invoke(args=["vote", "rebuild"])
+        self.assertEqual(result.exit_code, 1)
+        assert "still differ" in result.output
+
+    def test_deleted_reviews_leave_the_log(self):
+        admin = create_admin("replay-delete-admin", "pass")
+        staff = create_staff("replay-delete-staff", "pass")
+        student = create_student(admin.id, "Ymir Fritz", 821002, "History", "FHE")
+        review = create_review_by_student_id(student.id, staff.id, "Ancient", 6)
+        vote_on_review(review.id, staff.id, "upvote")
+        delete_review(review.id)
+        self.assertEqual(VoteCommand.query.filter_by(review_id=review.id).count(), 0)
+        self.assertEqual(Vote.query.filter_by(review_id=review.id).count(), 0)
+
+
+class VoteCompactionIntegrationTests(unittest.TestCase):
+
+    def test_compact_vote_commands(self):
+        admin = create_admin("compact-admin", "pass")
+        staff = create_staff("compact-staff", "pass")
+        other = create_staff("compact-other", "pass")
+        student = create_student(admin.id, "Jean Kirstein", 822001, "Horse Riding", "FFA")
+        review = create_review_by_student_id(student.id, staff.id, "Honest", 7)
+        for action in ("upvote", "upvote", "downvote", "upvote", "downvote"):
+            vote_on_review(review.id, staff.id, action)
+        vote_on_review(review.id, other.id, "upvote")
+        vote_on_review(review.id, other.id, "upvote")
+        old = datetime.utcnow() - timedelta(days=40)
+        VoteCommand.query.filter_by(review_id=review.id).update({"created": old})
+        db.session.commit()
+        vote_on_review(review.id, other.id, "downvote")
+        before = verify_votes()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "archive.jsonl.gz")
+            report = compact_vote_commands(path, retention_days=30, chunk_size=2)
+            self.assertEqual(report["archived"], 6)
+            archived = list(read_vote_command_archive(path))
+            self.assertEqual(len(archived), 6)
+            self.assertTrue(all(command["review_id"] == review.id for command in archived))
+            self.assertEqual(compact_vote_commands(path, retention_days=30)["archived"], 0)
+
+        commands = VoteCommand.query.filter_by(review_id=review.id).order_by(VoteCommand.id).all()
+        self.assertEqual([command.action.value for command in commands], ["downvote", "downvote"])
+        for vote in Vote.query.filter_by(review_id=review.id):
+            self.assertIsNotNone(VoteCommand.query.get(vote.vote_command_id))
+        after = verify_votes()
+        self.assertEqual((after["votes"], after["missing"], after["changed"], after["extra"]), (before["votes"], 0, 0, 0))
+
+    def test_compact_commands_without_created_time(self):
+        admin = create_admin("compact-null-admin", "pass")
+        staff = create_staff("compact-null-staff", "pass")
+        student = create_student(admin.id, "Connie Springer", 822002, "Horse Riding", "FFA")
+        review = create_review_by_student_id(student.id, staff.id, "Funny", 6)
+        vote_on_review(review.id, staff.id, "upvote")
+        vote_on_review(review.id, staff.id, "downvote")
+        first = VoteCommand.query.filter_by(review_id=review.id).order_by(VoteCommand.id).first()
+        first.created = None
+        first_id = first.id
+        db.session.commit()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "archive.jsonl.gz")
+            self.assertEqual(compact_vote_commands(path, retention_days=30)["archived"], 1)
+            archived = list(read_vote_command_archive(path))
+            self.assertEqual([(command["id"], command["created"]) for command in archived], [(first_id, None)])
+        self.assertEqual([command.action.value for command in VoteCommand.query.filter_by(review_id=review.id)], ["downvote"])
+
+
+
+class IdentityCacheIntegrationTests(unittest.TestCase):
+
+    def test_cached_identity(self):
+        staff = create_staff("cache-staff", "pass")
+        staff_id = staff.id
+        get_identity(staff_id)
+        hits = get_identity_cache_stats()["hits"]
+        with count_queries() as statements:
+            user = get_identity(staff_id)
+        self.assertEqual(statements, [])
+        self.assertEqual(get_identity_cache_stats()["hits"], hits + 1)
+        self.assertEqual((user.id, user.username, user.access), (staff_id, "cache-staff", "staff"))
+        update_staff(staff_id, "cache-staff-renamed")
+        self.assertEqual(get_identity(staff_id).username, "cache-staff-renamed")
+
+    def test_deleted_identity(self):
+        staff = create_staff("cache-deleted", "pass")
+        staff_id = staff.id
+        client = app.test_client()
+        headers = get_auth_header(client, "cache-deleted", "pass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        delete_staff(staff_id)
+        assert get_identity(staff_id) is None
+
+
+class JWTClaimsIntegrationTests(unittest.TestCase):
+
+    def test_token_claims(self):
+        client = app.test_client()
+        staff = create_staff("claims-staff", "pass")
+        headers = get_auth_header(client, "claims-staff", "pass")
+        payload = jwt.decode(headers["Authorization"].split()[1], verify=False)
+        self.assertEqual((payload["identity"], payload["access"], payload["token_version"]), (staff.id, "staff", 0))
+
+    def test_access_claims(self):
+        client = app.test_client()
+        create_staff("claims-voter", "pass")
+        admin = create_admin("claims-admin-only", "pass")
+        staff_headers = get_auth_header(client, "claims-voter", "pass")
+        admin_headers = get_auth_header(client, "claims-admin-only", "pass")
+        student = create_student(admin.id, "Floch Forster", 823001, "Politics", "FSS")
+        data = {"name": "Floch Forster", "school_id": 823001, "programme": "Law", "faculty": "FSS"}
+        assert client.put(f"/api/students/{student.id}", json=data, headers=staff_headers).status_code == 403
+        response = client.put(f"/api/students/{student.id}", json=data, headers=admin_headers)
+        assert response.status_code == 200 and response.json["programme"] == "Law"
+        assert client.put("/api/reviews/1/upvote", headers=admin_headers).status_code == 403
+
+    def test_revoked_and_old_tokens(self):
+        client = app.test_client()
+        staff = create_staff("claims-revoked", "pass")
+        headers = get_auth_header(client, "claims-revoked", "pass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        revoke_tokens("staff", staff.id)
+        assert client.get("/api/students/1", headers=headers).status_code == 401
+        headers = get_auth_header(client, "claims-revoked", "pass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+
+        now = datetime.utcnow()
+        old = jwt.encode(
+            {"identity": staff.id, "iat": now, "nbf": now, "exp": now + timedelta(days=1)},
+            app.config["JWT_SECRET_KEY"], algorithm="HS256",
+        ).decode()
+        response = client.get("/api/students/1", headers={"Authorization": f"JWT {old}"})
+        assert response.status_code == 401
+
+    def test_revoke_command(self):
+        client = app.test_client()
+        create_staff("claims-revoke-command", "pass")
+        headers = get_auth_header(client, "claims-revoke-command", "pass")
+        assert client.get("/api/students/1", headers=headers).status_code == 200
+        result = app.test_cli_runner().invoke(args=["user", "revoke", "claims-revoke-command"])
+        self.assertEqual((result.exit_code, result.output), (0, "Tokens of claims-revoke-command revoked\n"))
+        assert client.get("/api/students/1", headers=headers).status_code == 401
+        result = app.test_cli_runner().invoke(args=["user", "revoke", "nobody-at-all"])
+        self.assertEqual(result.exit_code, 1)
+
+
+class UserTableIntegrationTests(unittest.TestCase):
+
+    def test_one_user_table(self):
+        admin = create_admin("table-admin", "adminpass")
+        staff = create_staff("table-staff", "staffpass")
+        self.assertNotEqual(admin.id, staff.id)
+        assert create_staff("table-admin", "pass") is None
+        self.assertEqual(authenticate("table-admin", "adminpass").access, "admin")
+        self.assertEqual(authenticate("table-staff", "staffpass").access, "staff")
+        assert authenticate("table-staff", "adminpass") is None
+        assert isinstance(get_user(staff.id), Staff) and get_admin(staff.id) is None
+        assert all(user.access == "admin" for user in get_users_by_access("admin"))
+        with count_queries() as statements:
+            authenticate("table-staff", "staffpass")
+        self.assertEqual(len(statements), 1)
+
+
+# The schema before the stored vote counts, karma, token versions, unique indexes and snapshot vote rows
+OLD_SCHEMA = [
+    "CREATE TABLE student (id INTEGER PRIMARY KEY, school_id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, "
+    "faculty VARCHAR(100) NOT NULL, programme VARCHAR(100) NOT NULL)",
+    'CREATE TABLE "user" (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE, password VARCHAR(255) NOT NULL, '
+    "access VARCHAR(20) NOT NULL)",
+    "CREATE TABLE review (id INTEGER PRIMARY KEY, staff_id INTEGER NOT NULL, student_id INTEGER NOT NULL, "
+    "text VARCHAR(1000) NOT NULL, rating INTEGER NOT NULL)",
+    'CREATE TABLE "voteCommand" (id INTEGER PRIMARY KEY, staff_id INTEGER NOT NULL, review_id INTEGER NOT NULL, '
+    "action VARCHAR(8) NOT NULL)",
+    "CREATE TABLE vote (id INTEGER PRIMARY KEY, staff_id INTEGER NOT NULL, review_id INTEGER NOT NULL, "
+    "vote_command_id INTEGER NOT NULL, value VARCHAR(8) NOT NULL)",
+    'CREATE TABLE "voteSnapshot" (id INTEGER PRIMARY KEY, command_id INTEGER NOT NULL, created DATETIME NOT NULL, '
+    "votes JSON NOT NULL)",
+    "INSERT INTO student VALUES (1, 100, 'Ann Old', 'FST', 'CS'), (2, 101, 'Bob Old', 'FST', 'CS')",
+    "INSERT INTO \"voteSnapshot\" VALUES (1, 3, '2026-01-01 00:00:00.000000', "
+    "'[[2, 1, \"DOWNVOTE\", 2], [1, 3, \"UPVOTE\", 3]]')",
+    "INSERT INTO \"user\" VALUES (1, 'old1', 'x', 'staff'), (2, 'old2', 'x', 'staff')",
+    "INSERT INTO review VALUES (1, 1, 1, 'good', 8), (2, 1, 1, 'again', 2), (3, 2, 2, 'fine', 5)",
+    "INSERT INTO \"voteCommand\" VALUES (1, 2, 1, 'UPVOTE'), (2, 2, 1, 'DOWNVOTE'), (3, 2, 2, 'UPVOTE')",
+    "INSERT INTO vote VALUES (1, 2, 1, 1, 'UPVOTE'), (2, 2, 1, 2, 'DOWNVOTE'), (3, 2, 2, 3, 'UPVOTE'), "
+    "(4, 1, 3, 3, 'UPVOTE')",
+]
+
+
+# The same database before staff and admins shared the user table
+OLD_USER_TABLES_SCHEMA = [statement for statement in OLD_SCHEMA if '"user"' not in statement] + [
+    "CREATE TABLE staff (id INTEGER PRIMARY KEY, username VARCHAR, password VARCHAR, access VARCHAR)",
+    "CREATE TABLE admin (id INTEGER PRIMARY KEY, username VARCHAR, password VARCHAR, access VARCHAR)",
+    "INSERT INTO staff VALUES (1, 'old1', :password, 'staff'), (2, 'old2', :password, 'staff'), (3, 'shared', :password, 'staff')",
+    "INSERT INTO admin VALUES (1, 'boss', :password, 'admin'), (2, 'shared', :password, 'admin'), (5, 'solo', :password, 'admin')",
+]
+
+
+class MigrationIntegrationTests(unittest.TestCase):
+
+    @contextmanager
+    def old_database(self, schema=OLD_SCHEMA):
+        directory = tempfile.mkdtemp()
+        uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(directory, "old.db")
+        db.session.remove()
+        try:
+            password = generate_password_hash("oldpass", method="sha256")
+            for statement in schema:
+                db.session.execute(text(statement), {"password": password})
+            db.session.commit()
+            yield
+        finally:
+            db.session.remove()
+            db.engine.dispose()
+            app.config["SQLALCHEMY_DATABASE_URI"] = uri
+
+    def test_upgrade_old_database(self):
+        with self.old_database():
+            self.assertFalse(create_db(app))
+            upgrade(directory=MIGRATIONS_DIRECTORY)
+            self.assertTrue(create_db(app))
+            #the latest vote and the first review are kept, with the second review's votes
+            self.assertEqual([id for (id,) in db.session.execute(text("SELECT id FROM vote ORDER BY id"))], [2, 4])
+            self.assertEqual([id for (id,) in db.session.execute(text("SELECT id FROM review ORDER BY id"))], [1, 3])
+            self.assertEqual((get_review(1).num_upvotes, get_review(1).num_downvotes), (0, 1))
+            self.assertEqual([get_student(1).karma, get_student(2).karma], [5, 6])
+            self.assertEqual(get_staff(1).token_version, 0)
+            self.assertEqual(VoteCommand.query.filter(VoteCommand.created.is_(None)).count(), 0)
+            state, report = replay_votes()
+            self.assertEqual(state, {(2, 1): (Value.DOWNVOTE, 2), (1, 3): (Value.UPVOTE, 3)})
+            self.assertEqual((report["snapshot"], take_vote_snapshot().num_votes), (1, 2))
+            indexes = {index["name"] for table in ("vote", "review") for index in inspect(db.engine).get_indexes(table)}
+            assert {"ix_vote_staff_id_review_id", "ix_review_staff_id_student_id"} <= indexes
+
+    def test_upgrade_moves_old_user_tables(self):
+        with self.old_database(OLD_USER_TABLES_SCHEMA):
+            self.assertFalse(create_db(app))
+            upgrade(directory=MIGRATIONS_DIRECTORY)
+            self.assertTrue(create_db(app))
+            users = {user.id: (user.username, user.access, user.token_version) for user in User.query}
+            #staff keep their ids, admins whose id is taken move past every old id, bumping both token versions
+            self.assertEqual(users, {
+                1: ("old1", "staff", 1), 2: ("old2", "staff", 1), 3: ("shared", "staff", 0),
+                5: ("solo", "admin", 0), 6: ("boss", "admin", 1), 7: ("shared-admin", "admin", 1),
+            })
+            self.assertEqual(authenticate("boss", "oldpass").id, 6)
+            self.assertEqual(get_review(1).staff_id, 1)
+            #sessions and tokens issued before the upgrade no longer load whoever has the id now
+            assert load_user("1") is None and identity({"identity": 1}) is None
+            self.assertEqual(load_user("5").username, "solo")
+            self.assertEqual(load_user(get_user(1).get_id()).username, "old1")
+
+    def test_unique_index_over_duplicates_fails(self):
+        with self.old_database():
+            db.create_all()
+            with self.assertRaises(IntegrityError):
+                create_indexes(app)
+
+
+class PasswordHashingIntegrationTests(unittest.TestCase):
+
+    def tearDown(self):
+        password_hasher.configure()
+
+    def test_rehash_on_login(self):
+        staff = create_staff("rehash-staff", "pass")
+        assert staff.password.startswith("sha256$")
+        password_hasher.configure("pbkdf2:sha256", 1000)
+        client = app.test_client()
+        response = client.get("/api/staff-login?username=rehash-staff&password=pass")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(get_staff(staff.id).password.startswith("pbkdf2:sha256:1000$"))
+        self.assertEqual(authenticate("rehash-staff", "pass").id, staff.id)
+        assert authenticate("rehash-staff", "wrong") is None
+
+    def test_login_burst_rejected(self):
+        create_staff("burst-staff", "pass")
+        password_hasher.configure(workers=1, queue_depth=0)
+        client = app.test_client()
+        password_hasher.slots.acquire()
+        try:
+            response = client.get("/api/staff-login?username=burst-staff&password=pass")
+        finally:
+            password_hasher.slots.release()
+        self.assertEqual((response.status_code, response.headers["Retry-After"]), (503, "1"))
+        self.assertEqual(client.get("/api/staff-login?username=burst-staff&password=pass").status_code, 200)
+
+
+class ResponseCacheIntegrationTests(unittest.TestCase):
+
+    def test_etag_and_not_modified(self):
+        client = app.test_client()
+        test_admin = create_admin("etag-admin", "pass")
+        test_staff = create_staff("etag-staff", "pass")
+        test_student = create_student(test_admin.id, "etag student", 88001, "CS", "FST")
+        test_review = create_review_by_student_id(test_student.id, test_staff.id, "good", 7)
+        headers = get_auth_header(client, "etag-staff", "pass")
+        student_url = f"/api/students/{test_student.id}"
+        review_url = f"/api/reviews/{test_review.id}"
+        self.assertIsInstance(response_cache.backend, FileSystemBackend)
+        first = client.get(student_url, headers=headers)
+        etag = first.headers["ETag"]
+        assert not etag.startswith("W/")
+        again = client.get(student_url, headers=headers)
+        self.assertEqual((again.headers["ETag"], again.get_json()), (etag, first.get_json()))
+        response = client.get(student_url, headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual((response.status_code, response.data), (304, b""))
+        review_etag = client.get(review_url, headers=headers).headers["ETag"]
+
+        #a vote changes the review and the student's karma
+        self.assertEqual(client.put(f"{review_url}/upvote", headers=headers).status_code, 200)
+        response = client.get(student_url, headers=dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual((response.status_code, response.get_json()["karma"]), (200, 9))
+        response = client.get(review_url, headers=dict(headers, **{"If-None-Match": review_etag}))
+        self.assertEqual((response.status_code, response.get_json()["num_upvotes"]), (200, 1))
+        assert client.get(f"/api/students/{test_student.id}/reviews", headers=headers).get_json()[0]["karma"] == 9
+        assert client.get("/api/students/999999", headers=headers).status_code == 404
+        assert client.get("/api/students/999999", headers=headers).status_code == 404
+
+    def test_shared_backend(self):
+        server = RespStandIn(("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        backend = response_cache.backend
+        response_cache.backend = RespBackend(f"redis://127.0.0.1:{server.server_address[1]}/0")
+        try:
+            client = app.test_client()
+            create_staff("resp-staff", "pass")
+            headers = get_auth_header(client, "resp-staff", "pass")
+            first = client.get("/api/reviews?limit=2", headers=headers)
+            hits = response_cache.stats()["hits"]
+            second = client.get("/api/reviews?limit=2", headers=headers)
+            self.assertEqual(response_cache.stats()["hits"], hits + 1)
+            self.assertEqual((second.get_json(), second.headers["Link"]), (first.get_json(), first.headers["Link"]))
+            update_review(first.get_json()[0]["id"], "edited", 3)
+            third = client.get("/api/reviews?limit=2", headers=dict(headers, **{"If-None-Match": first.headers["ETag"]}))
+            self.assertEqual((third.status_code, third.get_json()[0]["text"]), (200, "edited"))
+        finally:
+            response_cache.backend = backend
+            server.shutdown()
+            server.server_close()
+        #with the server gone the views still answer, uncached
+        response_cache.backend = RespBackend("redis://127.0.0.1:1/0")
+        try:
+            assert client.get("/api/reviews?limit=2", headers=headers).status_code == 200
+        finally:
+            response_cache.backend = backend
+
+
+class SQLInstrumentationIntegrationTests(unittest.TestCase):
+
+    def setUp(self):
+        app.config.update({"SQL_STATS_HEADERS": True, "SLOW_QUERY_THRESHOLD_MS": 0})
+
+    def tearDown(self):
+        del app.config["SQL_STATS_HEADERS"]
+        del app.config["SLOW_QUERY_THRESHOLD_MS"]
+
+    def test_stats_headers(self):
+        client = app.test_client()
+        create_staff("sql-staff", "pass")
+        client.post("/staff-login", data={"username": "sql-staff", "password": "pass"})
+        client.get("/staff-students?limit=5")
+        with count_queries() as statements:
+            response = client.get("/staff-students?limit=5")
+        self.assertEqual(response.headers["X-DB-Statements"], str(len(statements)))
+        assert float(response.headers["X-DB-Time-Ms"]) >= float(response.headers["X-DB-Slowest-Ms"]) > 0
+        #each request is counted on its own
+        response = client.get("/staff-students?limit=5")
+        self.assertEqual(response.headers["X-DB-Statements"], str(len(statements)))
+
+    def test_slow_query_log(self):
+        client = app.test_client()
+        staff = create_staff("slow-staff", "pass")
+        review = create_review_by_student_id(1, staff.id, "slow", 5)
+        headers = get_auth_header(client, "slow-staff", "pass")
+        with self.assertLogs("slow_queries", level="WARNING") as logs:
+            assert client.put(f"/api/reviews/{review.id}/upvote", headers=headers).status_code == 200
+        entries = [json.loads(record.getMessage()) for record in logs.records]
+        assert entries and all(entry["view"] == "vote_action_postman" for entry in entries)
+        self.assertEqual((entries[0]["method"], entries[0]["path"]), ("PUT", f"/api/reviews/{review.id}/upvote"))
+        assert any(entry["statement"].startswith("INSERT INTO \"voteCommand\"") for entry in entries)
+
+    # A statement that raises is not timed, and the next one on the connection is timed on its own
+    def test_failed_statement(self):
+        with db.engine.connect() as connection:
+            for attempt in range(3):
+                with self.assertRaises(OperationalError):
+                    connection.execute(text("SELECT * FROM no_such_table"))
+            with self.assertLogs("slow_queries", level="WARNING") as logs:
+                connection.execute(text("SELECT 1"))
+            self.assertEqual([json.loads(record.getMessage())["statement"] for record in logs.records], ["SELECT 1"])
+            self.assertEqual(connection.info, {})
+
+
+class MetricsIntegrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous = metrics.directory
+        metrics.directory = self.directory.name
+
+    def tearDown(self):
+        metrics.directory = self.previous
+        self.directory.cleanup()
+
+    def get_samples(self, client):
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        assert response.content_type.startswith("text/plain")
+        samples = {}
+        for line in response.get_data(as_text=True).splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_metrics_endpoint(self):
+        client = app.test_client()
+        staff = create_staff("metrics-staff", "pass")
+        review = create_review_by_student_id(1, staff.id, "metrics", 5)
+        headers = get_auth_header(client, "metrics-staff", "pass")
+        before = self.get_samples(client)
+        requests = 'http_requests_total{blueprint="student_views",endpoint="student_views.get_student_action_postman",method="GET",status="200"}'
+        votes = 'vote_commands_total{action="upvote"}'
+        client.get("/api/students/1", headers=headers)
+        client.get("/api/students/1", headers=headers)
+        client.put(f"/api/reviews/{review.id}/upvote", headers=headers)
+        samples = self.get_samples(client)
+        self.assertEqual(samples[requests] - before.get(requests, 0), 2)
+        self.assertEqual(samples[votes] - before.get(votes, 0), 1)
+        latency = 'http_request_duration_seconds_count{blueprint="student_views",endpoint="student_views.get_student_action_postman"}'
+        assert samples[latency] >= 2
+        assert samples[latency.replace("_count{", "_bucket{") [:-1] + ',le="+Inf"}'] == samples[latency]
+        #the /metrics request itself is the one in flight
+        self.assertEqual(samples['http_requests_in_flight{blueprint="",endpoint="metrics"}'], 1)
+        assert samples["db_pool_checked_out"] >= 0
+        assert 0 < samples['cache_hit_ratio{cache="response"}'] <= 1
+
+    def test_processes_aggregated(self):
+        client = app.test_client()
+        live, dead = os.getppid(), 2 ** 22 + 1
+        for pid in (live, dead):
+            with open(os.path.join(metrics.directory, f"metrics-{pid}.json"), "w") as file:
+                json.dump({"pid": pid, "samples": [
+                    ["vote_commands_total", [["action", "downvote"]], 5],
+                    ["http_requests_in_flight", [["blueprint", "review_views"], ["endpoint", "review_views.vote_action_postman"]], 2],
+                ]}, file)
+        own = metrics.samples.get(("vote_commands_total", (("action", "downvote"),)), 0)
+        samples = self.get_samples(client)
+        #the counters of exited workers are kept, their gauges are not
+        self.assertEqual(samples['vote_commands_total{action="downvote"}'], own + 10)
+        self.assertEqual(samples['http_requests_in_flight{blueprint="review_views",endpoint="review_views.vote_action_postman"}'], 2)
+
+
+class SeedIntegrationTests(unittest.TestCase):
+
+    def test_seed_database(self):
+        counts = lambda: [model.query.count() for model in (Staff, Student, Review, VoteCommand, Vote)]
+        before = counts()
+        report = seed_database(300, 20, 6, 3.0, seed=2301, batch_size=100)
+        after = counts()
+        self.assertEqual([b - a for a, b in zip(before, after)],
+                         [report["staff"], report["students"], report["reviews"], report["vote_commands"], report["votes"]])
+        self.assertEqual((report["staff"], report["students"]), (20, 300))
+        assert report["reviews"] > 0 and report["vote_commands"] > report["votes"] > 0
+        assert authenticate("seed2301-staff20", "seedpass")
+        #the same staff can not be seeded twice
+        self.assertIsNone(seed_database(1, 20, 1, 0, seed=2301))
+
+        #the seeded counts, karma and votes agree with the ones rebuilt from the rows and the log
+        self.assertEqual(recount_review_votes(), 0)
+        self.assertEqual(recount_student_karma(), 0)
+        report = verify_votes()
+        self.assertEqual((report["missing"], report["changed"], report["extra"]), (0, 0, 0))
+        #toggled votes leave commands that were later removed or changed
+        assert VoteCommand.query.filter_by(action=Action.REMOVE).count() > 0
+        ratings = {rating for (rating,) in db.session.query(Review.rating).distinct()}
+        self.assertEqual(ratings, set(range(1, 11)))
+        #the indexes dropped while seeding are back
+        indexes = {index["name"] for index in inspect(db.engine).get_indexes("vote")}
+        assert {"ix_vote_staff_id_review_id", "ix_vote_review_id"} <= indexes
+
+
+class LoadTestIntegrationTests(unittest.TestCase):
+
+    def test_load_test(self):
+        staff = create_staff("load-staff1", "pass")
+        create_staff("load-staff2", "pass")
+        admin = create_admin("load-admin", "pass")
+        student = create_student(admin.id, "Hange Zoe", 825001, "Biology", "FST")
+        create_review_by_student_id(student.id, staff.id, "Curious", 9)
+        server = make_server("127.0.0.1", 0, app, threaded=False)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            test = LoadTest(f"http://127.0.0.1:{server.server_port}", ["load-staff1", "load-staff2"], "pass",
+                            mix={"browse_students": 1, "view_student": 1, "toggle_vote": 1}, think_time=0.01)
+            report = asyncio.run(test.run([(0, 3), (1.0, 3)]))
+        finally:
+            server.shutdown()
+        self.assertEqual(report["peak_users"], 3)
+        self.assertEqual(report["endpoints"]["GET /api/staff-login"]["statuses"], {"200": 3})
+        for name in ("GET /api/students", "GET /api/students/<id>", "PUT /api/reviews/<id>/<action>"):
+            assert report["endpoints"][name]["requests"] > 0
+        self.assertEqual(report["total"]["errors"], 0)
+        assert report["total"]["p99_ms"] >= report["total"]["p50_ms"] > 0
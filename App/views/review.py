@@ -1,15 +1,28 @@
-from flask import Blueprint, jsonify, request, render_template, flash, redirect, url_for
-from flask_jwt import jwt_required, current_identity
+from flask import Blueprint, current_app, jsonify, request, render_template, flash, redirect, url_for
+from flask_jwt import current_identity
 from flask_login import current_user, login_required
 
+from App.cache import cached_response
+
 from App.controllers import (
+    jwt_claims_required,
     create_review,
     create_review_postman,
     get_review,
     get_all_reviews,
     update_review,
     delete_review,
-    vote_on_review
+    vote_on_review,
+    vote_on_reviews,
+    get_queued_vote_status,
+    get_reviews_page,
+    get_reviews_page_json,
+    get_page_args,
+    next_page_link,
+    stream_reviews_json,
+    stream_json_response,
+    get_stream_chunk_size,
+    MAX_VOTE_BATCH_SIZE,
 )
 
 review_views = Blueprint("review_views", __name__, template_folder="../templates")
@@ -17,19 +30,20 @@ review_views = Blueprint("review_views", __name__, template_folder="../templates
 
 # Create review given user id, student id and text for Postman
 @review_views.route("/api/add-review", methods=["POST"])
-@jwt_required()
+@jwt_claims_required()
 def create_review_action_postman():
     data = request.json
     review = create_review_postman(
         student_id=data["student_id"],staff_id=data["staff_id"],  text=data["text"], rating=data["rating"]
     )
-    if review:
+    #the controller returns a message when the review could not be created, e.g. the staff already reviewed the student
+    if review and not isinstance(review, str):
         return jsonify(review.to_json()), 201
     return jsonify({"error": "review not created"}), 400
 
 #Add reviews by student for Postman testing
 @review_views.route("/api/add-review/<student_id>", methods=["POST", "GET"])
-@jwt_required()
+@jwt_claims_required()
 def add_review_by_student_action_postman(student_id):
     if request.method == "POST":
         if current_user.access == "staff":
@@ -90,32 +104,52 @@ def add_review_by_student(school_id):
 # List all reviews
 
 # List all reviews for Postman
+# Paginated with ?after=<review id>&limit=<n>, the next page is given in the Link header
+# Cached with an ETag, a change to any review makes new ones
 @review_views.route("/api/reviews", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
+@cached_response(lambda: ["reviews"])
 def get_all_reviews_action_postman():
-    reviews = get_all_reviews()
-    return jsonify([review.to_json() for review in reviews]), 200
+    after, limit = get_page_args(request.args)
+    reviews, next_cursor = get_reviews_page_json(after, limit)
+    response = jsonify(reviews)
+    if next_cursor:
+        response.headers["Link"] = next_page_link(next_cursor, limit)
+    return response, 200
+
+
+# Exports all reviews for Postman and the nightly sync
+# Streams NDJSON by default, or a JSON array with ?format=array
+@review_views.route("/api/reviews/stream", methods=["GET"])
+@jwt_claims_required()
+def stream_reviews_action_postman():
+    reviews = stream_reviews_json(get_stream_chunk_size())
+    return stream_json_response(reviews, array=request.args.get("format") == "array")
 
 
 @review_views.route("/admin-reviews", methods=["GET"])
 @login_required
 def admin_show_all_reviews():
-    reviews = get_all_reviews()
-    return render_template("admin-reviews.html", reviews=reviews)
+    after, limit = get_page_args(request.args)
+    reviews, next_cursor = get_reviews_page(after, limit)
+    return render_template("admin-reviews.html", reviews=reviews, next_cursor=next_cursor, limit=limit)
 
 
 @review_views.route("/staff-reviews", methods=["GET", "DELETE"])
 @login_required
 def staff_show_all_reviews():
-    reviews = get_all_reviews()
-    return render_template("staff-reviews.html", reviews=reviews, current_user=current_user)
+    after, limit = get_page_args(request.args)
+    reviews, next_cursor = get_reviews_page(after, limit)
+    return render_template("staff-reviews.html", reviews=reviews, current_user=current_user, next_cursor=next_cursor, limit=limit)
 
 
 # Gets review given review id
 
 # Gets review given review id for Postman
+# Cached with an ETag, send it back in If-None-Match to get a 304 while the review is unchanged
 @review_views.route("/api/reviews/<int:review_id>", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
+@cached_response(lambda review_id: [f"review:{review_id}"])
 def get_review_action_postman(review_id):
     review = get_review(review_id)
     if review:
@@ -126,25 +160,52 @@ def get_review_action_postman(review_id):
 #If the action is upvote and the review is already upvoted the action changes to remove vote, same for downvote
 #Only the staff can vote
 @review_views.route("/api/reviews/<int:review_id>/<string:action>", methods=["PUT"])
-@jwt_required()
+@jwt_claims_required("staff")
 def vote_action_postman(review_id, action):
-    data= request.json()
     message= vote_on_review(review_id, current_identity.id, action)
-    if (message=="Must have a Staff account to vote"):
+    if isinstance(message, str):
         return jsonify({"message": f"{message}"}), 400
+    elif message.get("status") == "queued":
+        return jsonify(message), 202
     else:   
         return jsonify(message), 200
 
 
+#Gets the status of a vote queued while VOTE_QUEUE_ENABLED is set, given the ticket returned with the 202
+#The status is queued, applied with the command, or failed with the error
+@review_views.route("/api/votes/queue/<string:ticket>", methods=["GET"])
+@jwt_claims_required()
+def queued_vote_status_action_postman(ticket):
+    status= get_queued_vote_status(ticket)
+    if status:
+        return jsonify(status), 200
+    return jsonify({"error": "ticket not found"}), 404
+
+
+#Applies a list of {"review_id", "action"} votes by the current identity in one transaction for Postman
+#Each vote toggles like a single vote, and if any vote is invalid none of them are applied
+#Only the staff can vote
+@review_views.route("/api/votes/batch", methods=["POST"])
+@jwt_claims_required("staff")
+def vote_batch_action_postman():
+    data = request.get_json(silent=True) or {}
+    votes = data.get("votes") if isinstance(data, dict) else data
+    max_size = current_app.config.get("MAX_VOTE_BATCH_SIZE", MAX_VOTE_BATCH_SIZE)
+    message= vote_on_reviews(current_identity.id, votes, max_size)
+    if isinstance(message, str):
+        return jsonify({"message": f"{message}"}), 400
+    return jsonify(message), 200
+
+
 # Updates post given post id and new text for Postman
 # Only the original reviewer can edit a review
 @review_views.route("/api/update-review/<int:review_id>", methods=["PUT"])
-@jwt_required()
+@jwt_claims_required()
 def update_review_action_postman(review_id):
     data = request.json
     review = get_review(review_id)
     if review:
-        if (current_identity.id == review.user_id):
+        if (current_identity.access == "staff" and current_identity.id == review.staff_id):
             update_review(review_id, text=data["text"], rating=data["rating"])
             return jsonify({"message": "post updated successfully"}), 200
         else:
@@ -180,11 +241,11 @@ def edit_review(review_id):
 # Deletes post given post id for Postman
 # Only admins or the original reviewer can delete a review
 @review_views.route("/api/delete-review/<int:review_id>", methods=["DELETE"])
-@jwt_required()
+@jwt_claims_required()
 def delete_review_action_postman(review_id):
     review = get_review(review_id)
     if review:
-        if current_identity.id == review.user_id or get_admin(current_identity.id):
+        if current_identity.access == "admin" or (current_identity.access == "staff" and current_identity.id == review.staff_id):
             delete_review(review_id)
             return jsonify({"message": "post deleted successfully"}), 200
         else:
@@ -211,7 +272,7 @@ def remove_review(review_id):
 
 # Gets all votes for a given review
 @review_views.route("/api/reviews/<int:review_id>/votes", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
 def get_review_votes_action(review_id):
     review = get_review(review_id)
     if review:
@@ -1,8 +1,12 @@
+import codecs
 from flask import Blueprint, jsonify, request, render_template, flash, redirect, url_for
-from flask_jwt import jwt_required, current_identity
+from flask_jwt import current_identity
 from flask_login import current_user, login_required
 
+from App.cache import cached_response
+
 from App.controllers import (
+    jwt_claims_required,
     create_student,
     get_student,
     get_student_by_school_id,
@@ -11,6 +15,18 @@ from App.controllers import (
     get_all_student_reviews,
     get_reviews_by_student,
     update_student,
+    get_students_page,
+    get_students_page_json,
+    get_page_args,
+    next_page_link,
+    search_students,
+    import_students,
+    autocomplete_students,
+    stream_students_json,
+    stream_json_response,
+    get_stream_chunk_size,
+    student_index,
+    DEFAULT_AUTOCOMPLETE_LIMIT,
 )
 
 
@@ -20,17 +36,35 @@ student_views = Blueprint("student_views", __name__, template_folder="../templat
 # Create student given name, programme and faculty for Postman
 # Must be an admin to access this route
 @student_views.route("/api/add-student", methods=["POST"])
-@jwt_required()
+@jwt_claims_required("admin")
 def add_student_postman():
     data=request.get_json()
-    if data["admin_id"] and data["name"] and data["school_id"] and data["programme"] and data["faculty"]:
-        student = create_student(admin_id=data["admin_id"], name=data["name"], school_id=data["school_id"], programme=data["programme"], faculty=data["faculty"])
+    if data.get("name") and data.get("school_id") and data.get("programme") and data.get("faculty"):
+        student = create_student(admin_id=current_identity.id, name=data["name"], school_id=data["school_id"], programme=data["programme"], faculty=data["faculty"])
         if student:
             return student.to_json(), 201
         return jsonify({"error": "student not created"}), 400
     return jsonify({"error": "unauthorized access"}), 401
 
 
+# Imports students from a CSV roster for Postman and the registry sync
+# Must be an admin, the students are imported by the admin of the token
+# Send the roster as a "file" upload, or as a text/csv body
+# The columns are school_id, name, programme and faculty, and existing school ids are updated
+# Returns the number of students created and updated and the rows that were skipped
+@student_views.route("/api/students/import", methods=["POST"])
+@jwt_claims_required("admin")
+def import_students_postman():
+    admin_id = current_identity.id
+    upload = request.files.get("file")
+    stream = upload.stream if upload else request.stream
+    #decoded one line at a time as the roster is read
+    report = import_students(admin_id, codecs.iterdecode(stream, "utf-8-sig"))
+    if report is None:
+        return jsonify({"error": "unauthorized access"}), 401
+    return jsonify(report), 200
+
+
 @student_views.route("/add-student", methods=["POST", "GET"])
 @login_required
 def add_student():
@@ -56,22 +90,20 @@ def add_student():
 # Updates student given student id, name, programme and faculty for Postman
 # Must be an admin to access this route
 @student_views.route("/api/students/<int:student_id>", methods=["PUT"])
-@jwt_required()
+@jwt_claims_required("admin")
 def update_student_action_postman(student_id):
-    admin= get_admin(current_identity.id)
-    if admin:
-        data = request.json
-        student = update_student(
-            student_id,
-            name=data["name"],
-            school_id=data["school_id"],
-            programme=data["programme"],
-            faculty=data["faculty"],
-        )
-        if student:
-            return jsonify(student.to_json()), 200
-        return jsonify({"error": "student not updated"}), 400
-    return jsonify({"error": "unauthorized"}), 401
+    data = request.json
+    student = update_student(
+        current_identity.id,
+        student_id,
+        name=data["name"],
+        school_id=data["school_id"],
+        programme=data["programme"],
+        faculty=data["faculty"],
+    )
+    if student:
+        return jsonify(student.to_json()), 200
+    return jsonify({"error": "student not updated"}), 400
 
 
 @student_views.route("/edit-student/<school_id>", methods=["POST", "GET"])
@@ -100,34 +132,52 @@ def edit_student(school_id):
 # Lists all students
 
 # Lists all students for Postman
+# Paginated with ?after=<student id>&limit=<n>, the next page is given in the Link header
 @student_views.route("/api/students", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
 def get_all_students_action_postman():
-    students = get_all_students()
+    after, limit = get_page_args(request.args)
+    students, next_cursor = get_students_page_json(after, limit)
     if students:
-        return jsonify([student.to_json() for student in students]), 200
+        response = jsonify(students)
+        if next_cursor:
+            response.headers["Link"] = next_page_link(next_cursor, limit)
+        return response, 200
     return jsonify({"error": "students not found"}), 404
 
 
+# Exports all students for Postman and the nightly sync
+# Streams NDJSON by default, or a JSON array with ?format=array
+@student_views.route("/api/students/stream", methods=["GET"])
+@jwt_claims_required()
+def stream_students_action_postman():
+    students = stream_students_json(get_stream_chunk_size())
+    return stream_json_response(students, array=request.args.get("format") == "array")
+
+
 @student_views.route("/admin-students", methods=["GET"])
 @login_required
 def admin_show_all_students():
-    students = get_all_students()
-    return render_template("admin-students.html", students=students)
+    after, limit = get_page_args(request.args)
+    students, next_cursor = get_students_page(after, limit)
+    return render_template("admin-students.html", students=students, next_cursor=next_cursor, limit=limit)
 
 
 @student_views.route("/staff-students", methods=["GET"])
 @login_required
 def staff_show_all_students():
-    students = get_all_students()
-    return render_template("staff-students.html", students=students)
+    after, limit = get_page_args(request.args)
+    students, next_cursor = get_students_page(after, limit)
+    return render_template("staff-students.html", students=students, next_cursor=next_cursor, limit=limit)
 
 
 # Gets a student given student id
 
 # Gets a student given student id for Postman
+# Cached with an ETag, send it back in If-None-Match to get a 304 while the student is unchanged
 @student_views.route("/api/students/<int:student_id>", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
+@cached_response(lambda student_id: [f"student:{student_id}"])
 def get_student_action_postman(student_id):
     student = get_student(student_id)
     if student:
@@ -137,7 +187,7 @@ def get_student_action_postman(student_id):
 
 # Gets a student given their name for Postman
 @student_views.route("/api/students/name/<string:name>", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
 def get_student_by_name_action_postman(name):
     students = get_students_by_name(name)
     if students:
@@ -146,7 +196,7 @@ def get_student_by_name_action_postman(name):
 
 # Gets a student given their school_id for Postman
 @student_views.route("/api/students/school_id/<string:school_id>", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
 def get_student_by_school_id_action_postman(school_id):
     students = get_students_by_school_id(school_id)
     if students:
@@ -154,12 +204,14 @@ def get_student_by_school_id_action_postman(school_id):
     return jsonify({"error": "student not found"}), 404
 
 # Lists all reviews for a given student for Postman
+# Cached with an ETag, like the student
 @student_views.route("/api/students/<int:student_id>/reviews", methods=["GET"])
-@jwt_required()
+@jwt_claims_required()
+@cached_response(lambda student_id: [f"student:{student_id}"])
 def get_all_student_reviews_action_postman(student_id):
-    reviews = get_all_student_reviews(student_id)
+    reviews, status = get_all_student_reviews(student_id)
     if reviews:
-       return jsonify([review.to_json() for review in reviews]), 200
+       return jsonify(reviews), status
     return jsonify({"message": "reviews not found"}), 404
 
 
@@ -180,20 +232,26 @@ def admin_show_all_reviews_for_student(school_id):
     
 
 #Search Students for Postman
+#Matches name, programme, faculty and school id, best matches first, paginated with ?page=<n>&limit=<n>
+#The results are ranked rather than ordered by id, so the ?after=<id> cursor of the listings is refused
 @student_views.route("/api/students/search/<string:val>", methods=["GET"])
-@jwt_required()
-def search_postman():
-    students=[]
-    student=get_student(val)
-    if student:
-        students.append(student)
-    groupA= get_students_by_name(val)
-    for student in groupA:
-        students.append(student)
-    groupB= get_students_by_school_id(val)
-    for student in groupB:
-        students.append(student)
+@jwt_claims_required()
+def search_postman(val):
+    if "after" in request.args:
+        return jsonify({"error": "search results are paginated with ?page=<n>, not ?after=<id>"}), 400
+    _, limit = get_page_args(request.args)
+    students = search_students(val, page=request.args.get("page", 1, type=int), limit=limit)
     if students:
         return jsonify([student.to_json() for student in students]), 200
     else:
         return jsonify({"message": "students not found"}), 404
+
+
+# Suggests students as a name or school id is typed, for Postman and the search box
+# Matches the start of the full name, any word of the name or the school id, highest karma first
+# Returns at most ?k=<n> students, 10 by default, and an empty list when nothing matches
+@student_views.route("/api/students/autocomplete", methods=["GET"])
+@jwt_claims_required()
+def autocomplete_postman():
+    limit = max(1, min(request.args.get("k", DEFAULT_AUTOCOMPLETE_LIMIT, type=int), student_index.top_size))
+    return jsonify(autocomplete_students(request.args.get("q", ""), limit)), 200
@@ -5,6 +5,7 @@ import flask_login
 from flask_jwt import JWT
 
 from App.controllers import (
+    jwt_claims_required,
     create_admin,
     create_staff,
     get_admin,
@@ -15,9 +16,11 @@ from App.controllers import (
     get_all_users_json,
     get_all_admins_json,
     get_all_staff_json,
+    get_user,
     get_users_by_access,
     delete_user,
     login_user,
+    create_access_token,
     logout_user,
     get_staff_by_username,
     get_admin_by_username,
@@ -69,8 +72,8 @@ def logout():
 def staff_login():
     if request.method == "POST":
         data = request.form
-        staff = get_staff_by_username(data["username"])
-        if staff and staff.check_password(data["password"]):
+        staff = authenticate(data["username"], data["password"])
+        if staff and staff.access == "staff":
             login_user(staff)
             flash(f"Log in successful! Welcome, {current_user.username}!")
             return redirect(url_for('student_views.staff_show_all_students'))
@@ -82,8 +85,8 @@ def staff_login():
 def admin_login():
     if request.method == "POST":
         data = request.form
-        admin = get_admin_by_username(data["username"])
-        if admin and admin.check_password(data["password"]):
+        admin = authenticate(data["username"], data["password"])
+        if admin and admin.access == "admin":
             login_user(admin)
             flash(f"Log in successful! Welcome, {current_user.username}!")
             return redirect(url_for('student_views.admin_show_all_students'))
@@ -148,20 +151,16 @@ def admin_signup():
 # Get all users route for Postman
 # Must be an admin to access this route
 @user_views.route("/api/users/<int:admin_id>", methods=["GET"])
-@jwt_required()
-def get_users_action_postman():
-    if get_admin(admin_id):
-        users = get_all_users_json()
-        return jsonify(users), 200
-    return jsonify({"message": "Access denied"}), 403
+@jwt_claims_required("admin")
+def get_users_action_postman(admin_id):
+    users = get_all_users_json()
+    return jsonify(users), 200
 
 # Get user by id route
 # Must be an admin to access this route
-@user_views.route("/api/user/<int:admin_id>", methods=["GET"])
-@jwt_required()
+@user_views.route("/api/user/<int:user_id>", methods=["GET"])
+@jwt_claims_required("admin")
 def get_user_action_postman(user_id):
-    if get_admin(admin_id):
-        return jsonify({"message": "Access denied"}), 403
     user = get_user(user_id)
     if user:
         return jsonify(user.to_json()), 200
@@ -170,11 +169,9 @@ def get_user_action_postman(user_id):
 
 # Delete user route
 # Must be an admin to access this route
-@user_views.route("/api/users/<int:admin_id>", methods=["DELETE"])
-@jwt_required()
+@user_views.route("/api/users/<int:user_id>", methods=["DELETE"])
+@jwt_claims_required("admin")
 def delete_user_action(user_id):
-    if get_admin(admin_id):
-        return jsonify({"message": "Access denied"}), 403
     user = get_user(user_id)
     if user:
         delete_user(user_id)
@@ -185,11 +182,9 @@ def delete_user_action(user_id):
 # Get user by access level route
 # Must be an admin to access this route
 @user_views.route("/api/users/access/<string:access>", methods=["GET"])
-@jwt_required()
+@jwt_claims_required("admin")
 def get_user_by_access_action(access):
-    if not get_admin(current_identity.id):
-        return jsonify({"message": "Access denied"}), 403
-    users = get_users_by_access(access_level)
+    users = get_users_by_access(access)
     if users:
         return jsonify([user.to_json() for user in users]), 200
     return jsonify({"message": "No users found"}), 404
@@ -197,14 +192,15 @@ def get_user_by_access_action(access):
 #POSTMAN ROUTES
 
 # Staff Log in route for Postman
+# Returns a JWT for the API routes, like /auth
 @user_views.route("/api/staff-login", methods=['GET'])
 def staff_login_action_postman():
     data=request.form
     username= request.args.get('username')
     password= request.args.get('password')
     staff=authenticate(username,password)
-    if staff and get_staff(staff.id):
-        return jsonify({"message":"Logged in"}), 200
+    if staff and staff.access == "staff":
+        return jsonify({"message":"Logged in", "access_token": create_access_token(staff)}), 200
     return jsonify({"message": "Incorrect username or password"}), 401
 
 
@@ -215,8 +211,8 @@ def admin_login_action_postman():
     username= request.args.get('username')
     password= request.args.get('password')
     admin= authenticate(username, password)
-    if admin and get_admin(admin.id):
-        return jsonify({"message":"Logged in"}), 200
+    if admin and admin.access == "admin":
+        return jsonify({"message":"Logged in", "access_token": create_access_token(admin)}), 200
     return jsonify({"message": "Incorrect username or password"}), 401
 
 # Staff Sign up route for Postman 
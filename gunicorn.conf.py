@@ -0,0 +1,28 @@
+import os
+import tempfile
+from App.cache import FileSystemBackend, cache_dir
+
+# gunicorn reads this file from the working directory, e.g. for the Procfile's web process
+
+
+# Empties the metrics directory before the workers start, see App/metrics.py
+# Otherwise the counters of the previous run would be added to this one's
+def on_starting(server):
+    directory = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "app-metrics"))
+    if os.path.isdir(directory):
+        for entry in os.listdir(directory):
+            if entry.startswith("metrics-"):
+                os.unlink(os.path.join(directory, entry))
+
+
+# Empties the filesystem response cache before the workers start, see App/cache.py
+# The database may have been replaced since the last run, e.g. restored from a backup
+def when_ready(server):
+    if os.environ.get("RESPONSE_CACHE_BACKEND", "filesystem") == "filesystem":
+        FileSystemBackend(cache_dir(os.environ)).clear()
+
+
+# Keeps each worker's autocomplete index in sync with the changes made by the other workers
+def post_worker_init(worker):
+    from App.controllers.autocomplete import start_student_index_sync
+    start_student_index_sync(worker.wsgi)
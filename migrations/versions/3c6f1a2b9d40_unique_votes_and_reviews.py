@@ -0,0 +1,115 @@
+"""Stored vote counts and karma, unique votes and reviews
+
+Brings a database created before the stored counts and the unique indexes up to date: adds the
+columns it is missing, removes duplicate votes and reviews, recounts the stored vote counts and
+karma, then builds the indexes. A database created by flask init already has all of it and only
+gets the recount.
+
+A staff's duplicate votes on a review keep the latest one, and a staff's duplicate reviews of a
+student keep the first one, with the votes and vote commands of the others deleted.
+
+Revision ID: 3c6f1a2b9d40
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c6f1a2b9d40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+NEW_COLUMNS = [
+    ("review", sa.Column("num_upvotes", sa.Integer(), nullable=False, server_default="0")),
+    ("review", sa.Column("num_downvotes", sa.Integer(), nullable=False, server_default="0")),
+    ("student", sa.Column("karma", sa.Integer(), nullable=False, server_default="0")),
+    ("voteCommand", sa.Column("created", sa.DateTime(), nullable=True)),
+    ("user", sa.Column("token_version", sa.Integer(), nullable=False, server_default="0")),
+]
+
+# (table, index name, columns, unique)
+INDEXES = [
+    ("vote", "ix_vote_staff_id_review_id", ["staff_id", "review_id"], True),
+    ("review", "ix_review_staff_id_student_id", ["staff_id", "student_id"], True),
+    ("vote", "ix_vote_review_id", ["review_id"], False),
+    ("voteCommand", "ix_voteCommand_review_id", ["review_id"], False),
+    ("student", "ix_student_school_id", ["school_id"], False),
+    ("student", "ix_student_name", ["name"], False),
+]
+
+DUPLICATE_VOTES = """
+    DELETE FROM vote WHERE id NOT IN (SELECT max(id) FROM vote GROUP BY staff_id, review_id)
+"""
+
+DUPLICATE_REVIEWS = """
+    SELECT id FROM review WHERE id NOT IN (SELECT min(id) FROM review GROUP BY staff_id, student_id)
+"""
+
+#commands logged before the column existed get the time of the upgrade, so they are kept for
+#the whole retention window before they can be compacted
+BACKFILL_CREATED = """
+    UPDATE "voteCommand" SET created = CURRENT_TIMESTAMP WHERE created IS NULL
+"""
+
+RECOUNT_VOTES = """
+    UPDATE review SET
+        num_upvotes = (SELECT count(*) FROM vote WHERE vote.review_id = review.id AND vote.value = 'UPVOTE'),
+        num_downvotes = (SELECT count(*) FROM vote WHERE vote.review_id = review.id AND vote.value = 'DOWNVOTE')
+"""
+
+#the same karma as Review.get_karma, summed over each student's reviews
+RECOUNT_KARMA = """
+    UPDATE student SET karma = coalesce((
+        SELECT sum(CASE
+            WHEN rating > 5 THEN rating + (rating - 5) * num_upvotes - (rating - 5) * num_downvotes
+            WHEN rating < 5 THEN (rating - 10) - (5 - rating) * num_upvotes + (5 - rating) * num_downvotes
+            ELSE rating + num_upvotes - num_downvotes
+        END)
+        FROM review WHERE review.student_id = student.id
+    ), 0)
+"""
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    tables = set(inspector.get_table_names())
+
+    for table, column in NEW_COLUMNS:
+        if table in tables and column.name not in {c["name"] for c in inspector.get_columns(table)}:
+            op.add_column(table, column)
+    if "voteCommand" in tables:
+        connection.execute(sa.text(BACKFILL_CREATED))
+
+    connection.execute(sa.text(DUPLICATE_VOTES))
+    duplicates = [id for (id,) in connection.execute(sa.text(DUPLICATE_REVIEWS))]
+    for start in range(0, len(duplicates), 500):
+        chunk = {"ids": duplicates[start:start + 500]}
+        for table in ("vote", '"voteCommand"', "review"):
+            column = "id" if table == "review" else "review_id"
+            connection.execute(
+                sa.text(f"DELETE FROM {table} WHERE {column} IN :ids").bindparams(sa.bindparam("ids", expanding=True)),
+                chunk,
+            )
+
+    connection.execute(sa.text(RECOUNT_VOTES))
+    connection.execute(sa.text(RECOUNT_KARMA))
+
+    #an index that cannot be built fails the upgrade, nothing is skipped
+    for table, name, columns, unique in INDEXES:
+        if name not in {index["name"] for index in sa.inspect(connection).get_indexes(table)}:
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    for table, name, columns, unique in INDEXES:
+        if unique:
+            op.drop_index(name, table_name=table)
+    for table, column in reversed(NEW_COLUMNS):
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column(column.name)
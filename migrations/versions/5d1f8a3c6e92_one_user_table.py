@@ -0,0 +1,121 @@
+"""Staff and admins in one user table
+
+Moves the rows of the old staff and admin tables into the user table. Staff keep their ids, since
+reviews and votes point to them. Admins are matched by username: an admin keeps their id unless a
+staff has it, and is renamed with an "-admin" suffix when a staff has their username. An admin
+already in the user table under that username is not moved again.
+
+A remapped admin's old id can now belong to someone else, so the token version of the remapped
+admins and of whoever holds their old ids is bumped, and the tokens and sessions issued before the
+upgrade stop working for them. The old tables are left in place.
+
+Revision ID: 5d1f8a3c6e92
+Revises: 8e4b7d1c2a57
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1f8a3c6e92'
+down_revision = '8e4b7d1c2a57'
+branch_labels = None
+depends_on = None
+
+
+users = sa.table(
+    "user",
+    sa.column("id", sa.Integer),
+    sa.column("username", sa.String),
+    sa.column("password", sa.String),
+    sa.column("access", sa.String),
+    sa.column("token_version", sa.Integer),
+)
+
+# Tables whose staff_id pointed to the old staff table
+STAFF_REFERENCES = ["review", "vote", "voteCommand"]
+
+
+def upgrade():
+    connection = op.get_bind()
+    tables = set(sa.inspect(connection).get_table_names())
+    if "staff" not in tables and "admin" not in tables:
+        return
+    if "user" not in tables:
+        op.create_table(
+            "user",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("username", sa.String(), nullable=False),
+            sa.Column("password", sa.String(255), nullable=False),
+            sa.Column("access", sa.String(20), nullable=False),
+            sa.Column("token_version", sa.Integer(), nullable=False, server_default="0"),
+        )
+        op.create_index("ix_user_username", "user", ["username"], unique=True)
+
+    existing = connection.execute(sa.select(users.c.id, users.c.username, users.c.access)).fetchall()
+    by_id = {id: (username, access) for id, username, access in existing}
+    by_username = {username: (id, access) for id, username, access in existing}
+
+    if "staff" in tables:
+        for id, username, password in connection.execute(sa.text("SELECT id, username, password FROM staff ORDER BY id")).fetchall():
+            if by_id.get(id) == (username, "staff"):
+                continue
+            if id in by_id or username in by_username:
+                #moving them anyway would hand their reviews and votes to someone else
+                raise RuntimeError(f"Staff {id} ({username}) cannot be moved, their id or username is taken in the user table")
+            connection.execute(users.insert().values(id=id, username=username, password=password, access="staff", token_version=0))
+            by_id[id] = (username, "staff")
+            by_username[username] = (id, "staff")
+
+    if "admin" in tables:
+        admins = connection.execute(sa.text("SELECT id, username, password FROM admin ORDER BY id")).fetchall()
+        #remapped admins get ids past every old one, so no old admin id is handed to another admin
+        next_id = max([0, *by_id, *(id for id, username, password in admins)]) + 1
+        revoked = set()
+        for old_id, username, password in admins:
+            new_username = username
+            while new_username in by_username and by_username[new_username][1] != "admin":
+                new_username += "-admin"
+            if new_username in by_username:
+                id = by_username[new_username][0]
+            else:
+                if old_id in by_id:
+                    id, next_id = next_id, next_id + 1
+                else:
+                    id = old_id
+                connection.execute(users.insert().values(
+                    id=id, username=new_username, password=password, access="admin", token_version=0
+                ))
+                by_id[id] = (new_username, "admin")
+                by_username[new_username] = (id, "admin")
+                if new_username != username:
+                    print(f"Admin {old_id} renamed from {username} to {new_username}, the username is taken by a staff")
+            if id != old_id:
+                print(f"Admin {old_id} ({username}) moved to id {id}")
+                revoked.add(id)
+                if old_id in by_id:
+                    revoked.add(old_id)
+        if revoked:
+            connection.execute(
+                users.update().where(users.c.id.in_(sorted(revoked))).values(token_version=users.c.token_version + 1)
+            )
+
+    if connection.dialect.name == "postgresql":
+        #moves the id sequence past the ids copied over, so new users do not reuse them
+        connection.execute(sa.text(
+            "SELECT setval(pg_get_serial_sequence('\"user\"', 'id'), coalesce(max(id), 0) + 1, false) FROM \"user\""
+        ))
+        #SQLite cannot alter constraints and does not enforce them by default
+        inspector = sa.inspect(connection)
+        for table in STAFF_REFERENCES:
+            for key in inspector.get_foreign_keys(table):
+                if key["referred_table"] == "staff":
+                    op.drop_constraint(key["name"], table, type_="foreignkey")
+                    op.create_foreign_key(key["name"], table, "user", ["staff_id"], ["id"])
+
+
+def downgrade():
+    #the old staff and admin tables are left in place by the upgrade, nothing to move back
+    pass
@@ -0,0 +1,82 @@
+"""Vote snapshot votes as rows
+
+Moves the votes of every snapshot from the JSON votes column of voteSnapshot to the voteSnapshotVote
+table, one row per vote, and keeps their number in voteSnapshot.num_votes.
+
+Revision ID: 8e4b7d1c2a57
+Revises: 3c6f1a2b9d40
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4b7d1c2a57'
+down_revision = '3c6f1a2b9d40'
+branch_labels = None
+depends_on = None
+
+
+snapshots = sa.table("voteSnapshot", sa.column("id", sa.Integer), sa.column("votes", sa.JSON), sa.column("num_votes", sa.Integer))
+snapshot_votes = sa.table(
+    "voteSnapshotVote",
+    sa.column("snapshot_id", sa.Integer),
+    sa.column("staff_id", sa.Integer),
+    sa.column("review_id", sa.Integer),
+    sa.column("value", sa.String),
+    sa.column("vote_command_id", sa.Integer),
+)
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    tables = set(inspector.get_table_names())
+    if "voteSnapshot" not in tables:
+        #created by flask init with the rest of the new tables
+        return
+    if "voteSnapshotVote" not in tables:
+        op.create_table(
+            "voteSnapshotVote",
+            sa.Column("snapshot_id", sa.Integer(), sa.ForeignKey("voteSnapshot.id"), primary_key=True),
+            sa.Column("staff_id", sa.Integer(), primary_key=True, autoincrement=False),
+            sa.Column("review_id", sa.Integer(), primary_key=True, autoincrement=False),
+            sa.Column("value", sa.Enum("UPVOTE", "DOWNVOTE", name="value"), nullable=False),
+            sa.Column("vote_command_id", sa.Integer(), nullable=False),
+        )
+    columns = {column["name"] for column in inspector.get_columns("voteSnapshot")}
+    if "num_votes" not in columns:
+        op.add_column("voteSnapshot", sa.Column("num_votes", sa.Integer(), nullable=False, server_default="0"))
+    if "votes" not in columns:
+        return
+
+    for id, votes in connection.execute(sa.select(snapshots.c.id, snapshots.c.votes)).fetchall():
+        rows = [
+            {"snapshot_id": id, "staff_id": staff_id, "review_id": review_id, "value": value, "vote_command_id": command_id}
+            for staff_id, review_id, value, command_id in votes or []
+        ]
+        for start in range(0, len(rows), 1000):
+            connection.execute(snapshot_votes.insert(), rows[start:start + 1000])
+        connection.execute(snapshots.update().where(snapshots.c.id == id).values(num_votes=len(rows)))
+    with op.batch_alter_table("voteSnapshot") as batch:
+        batch.drop_column("votes")
+
+
+def downgrade():
+    with op.batch_alter_table("voteSnapshot") as batch:
+        batch.add_column(sa.Column("votes", sa.JSON(), nullable=True))
+    connection = op.get_bind()
+    votes = {}
+    rows = connection.execute(
+        sa.select(snapshot_votes.c.snapshot_id, snapshot_votes.c.staff_id, snapshot_votes.c.review_id,
+                  snapshot_votes.c.value, snapshot_votes.c.vote_command_id)
+    )
+    for snapshot_id, staff_id, review_id, value, command_id in rows:
+        votes.setdefault(snapshot_id, []).append([staff_id, review_id, value, command_id])
+    for (id,) in connection.execute(sa.select(snapshots.c.id)).fetchall():
+        connection.execute(snapshots.update().where(snapshots.c.id == id).values(votes=votes.get(id, [])))
+    op.drop_table("voteSnapshotVote")
+    with op.batch_alter_table("voteSnapshot") as batch:
+        batch.drop_column("num_votes")
@@ -1,9 +1,12 @@
-import click, pytest, sys
+import click, json, os, pytest, sys, time
 from flask import Flask
 from flask.cli import with_appcontext, AppGroup
 from App.models.vote import Value
 from App.database import create_db, get_migrate
 from App.main import create_app
+from App.hashing import benchmark_password_hashing
+from App.cache import RespStandIn, response_cache
+from App.loadtest import LOAD_PROFILES, LoadTestError, parse_mix, parse_stages, profile_duration, run_load_test
 from App.controllers import (
     create_staff,
     create_admin, 
@@ -21,6 +24,15 @@ from App.controllers import (
     get_review,
     delete_review,
     vote_on_review,
+    recount_review_votes,
+    recount_student_karma,
+    import_students,
+    take_vote_snapshot,
+    rebuild_votes,
+    verify_votes,
+    compact_vote_commands,
+    revoke_user_tokens,
+    seed_database,
 )
 
 # This commands file allow you to create convenient CLI commands for testing controllers
@@ -68,6 +80,15 @@ def list_user_command(format):
         print(get_all_users_json())
 
 
+@user_cli.command("revoke", help="Revokes every token of a user, they have to log in again")
+@click.argument("username")
+def revoke_user_tokens_command(username):
+    if not revoke_user_tokens(username):
+        print(f"{username} not found")
+        sys.exit(1)
+    print(f"Tokens of {username} revoked")
+
+
 app.cli.add_command(user_cli)  # add the group to the cli
 
 
@@ -82,6 +103,25 @@ def initialize():
     print("database intialized")
 
 
+@app.cli.command("seed", help="Adds a reproducible synthetic dataset of staff, students, reviews and votes")
+@click.option("--students", default=1000, help="Number of students added")
+@click.option("--staff", default=50, help="Number of staff added, the reviews are written by the existing staff if 0")
+@click.option("--reviews-per-student", default=5, help="Average number of reviews of a student")
+@click.option("--vote-density", default=0.3, help="Average number of votes on a review")
+@click.option("--seed", default=0, help="Seed of the generated data, the same seed gives the same data")
+@click.option("--batch-size", default=2000, help="Number of students written per transaction, with their reviews and votes")
+def seed_command(students, staff, reviews_per_student, vote_density, seed, batch_size):
+    start = time.perf_counter()
+    report = seed_database(students, staff, reviews_per_student, vote_density, seed, batch_size)
+    if report is None:
+        print("Database not seeded")
+        sys.exit(1)
+    rows = sum(report.values())
+    print(f'{report["staff"]} staff, {report["students"]} students, {report["reviews"]} reviews, '
+          f'{report["vote_commands"]} vote commands and {report["votes"]} votes added')
+    print(f"{rows} rows in {time.perf_counter() - start:.1f}s")
+
+
 """
 Test Commands
 """
@@ -185,6 +225,12 @@ def review_upvotes_command(review_id):
     num_upvotes = review.get_num_upvotes()
     print(num_upvotes)
 
+@review_cli.command("recount", help="Rebuilds the review vote counts from the vote table")
+@click.option("--chunk-size", default=500, help="Number of reviews recounted per transaction")
+def recount_review_votes_command(chunk_size):
+    fixed = recount_review_votes(chunk_size)
+    print(f"{fixed} review(s) recounted")
+
 @review_cli.command("delete", help="Delete a review")
 def delete_review_by_id_command():
     id=1
@@ -209,12 +255,34 @@ def create_review_command(admin_id, name, school_id, programme, faculty):
     print(f'Student created!')
 
 
+@student_cli.command("import", help="Imports students from a CSV roster")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("admin_id", default="1")
+@click.option("--batch-size", default=1000, help="Number of students written per transaction")
+def import_students_command(path, admin_id, batch_size):
+    with open(path, encoding="utf-8-sig", newline="") as roster:
+        report = import_students(admin_id, roster, batch_size)
+    if report is None:
+        print("Admin not found")
+        return
+    print(f'{report["created"]} student(s) created, {report["updated"]} updated, {report["skipped"]} row(s) skipped')
+    for error in report["errors"]:
+        print(f'Row {error["row"]}: {error["error"]}')
+
+
 @student_cli.command("list", help="Lists students in the database")
 def list_students_command():
     students = get_all_students()
     for student in students:
         print(student.name)
         #print(student.get_karma)
+
+
+@student_cli.command("recount", help="Rebuilds the student karma from their reviews")
+@click.option("--chunk-size", default=500, help="Number of students recounted per transaction")
+def recount_student_karma_command(chunk_size):
+    fixed = recount_student_karma(chunk_size)
+    print(f"{fixed} student(s) recounted")
     
 
 app.cli.add_command(student_cli)
@@ -238,11 +306,197 @@ def create_vote_command(review_id, staff_id):
     voteCommand = vote_on_review(review_id,staff_id,action)
     print(voteCommand)
 
-    
+
+@vote_cli.command("snapshot", help="Snapshots every vote as of the latest vote command, run periodically")
+@click.option("--chunk-size", default=1000, help="Number of vote commands read, and snapshot votes written, at a time")
+def vote_snapshot_command(chunk_size):
+    snapshot = take_vote_snapshot(chunk_size)
+    if snapshot is None:
+        print("Snapshot not taken")
+        sys.exit(1)
+    print(f"Snapshot {snapshot.id}: {snapshot.num_votes} vote(s) as of command {snapshot.command_id}")
+
+
+@vote_cli.command("rebuild", help="Rebuilds the votes, review vote counts and student karma from the vote command log")
+@click.option("--since", type=int, default=None, help="Start from the latest snapshot at or before this command id")
+@click.option("--chunk-size", default=1000, help="Number of rows read or written at a time")
+def vote_rebuild_command(since, chunk_size):
+    report = rebuild_votes(since, chunk_size)
+    if report is None:
+        print("Votes not rebuilt")
+        sys.exit(1)
+    print(f'Replayed {report["replayed"]} command(s) from snapshot {report["snapshot"]} (command {report["from_command"]}) to command {report["to_command"]}')
+    print(f'{report["missing"]} vote(s) restored, {report["changed"]} corrected, {report["extra"]} removed')
+    print(f'{report["reviews_recounted"]} review(s) and {report["students_recounted"]} student(s) recounted')
+    #votes cast during the rebuild can leave it wrong, see rebuild_votes
+    report = verify_votes(since, chunk_size)
+    if report["missing"] or report["changed"] or report["extra"]:
+        print(f'The votes still differ from the log: {report["missing"]} missing, {report["changed"]} different, {report["extra"]} not in the log')
+        sys.exit(1)
+
+
+@vote_cli.command("verify", help="Checks the votes against the vote command log")
+@click.option("--since", type=int, default=None, help="Start from the latest snapshot at or before this command id")
+@click.option("--chunk-size", default=1000, help="Number of rows read at a time")
+def vote_verify_command(since, chunk_size):
+    report = verify_votes(since, chunk_size)
+    print(f'{report["votes"]} vote(s) in the log, {report["missing"]} missing, {report["changed"]} different, {report["extra"]} not in the log')
+    if report["missing"] or report["changed"] or report["extra"]:
+        sys.exit(1)
+
+
+@vote_cli.command("compact", help="Archives superseded vote commands older than the retention window")
+@click.argument("archive", default="voteCommand-archive.jsonl.gz")
+@click.option("--older-than-days", default=30, help="Retention window in days, newer commands are kept")
+@click.option("--chunk-size", default=1000, help="Number of commands archived per transaction")
+def vote_compact_command(archive, older_than_days, chunk_size):
+    report = compact_vote_commands(archive, older_than_days, chunk_size)
+    print(f'{report["archived"]} command(s) from before {report["cutoff"]} archived to {archive}')
+
 
 app.cli.add_command(vote_cli)
 
 
+password_cli = AppGroup('password', help="Password hashing commands")
+
+# The settings benchmarked by default, as method:cost
+PASSWORD_BENCHMARK_SETTINGS = ["sha256", "pbkdf2:sha256:50000", "pbkdf2:sha256:150000", "pbkdf2:sha256:260000", "scrypt:16384", "scrypt:32768"]
+
+
+@password_cli.command("bench", help="Measures logins per second per worker for each hashing setting")
+@click.argument("settings", nargs=-1)
+@click.option("--workers", default=1, help="Number of password checks run at once")
+@click.option("--seconds", default=2.0, help="Time spent on each setting")
+@click.option("--pool", type=click.Choice(["thread", "process"]), default="thread")
+def password_bench_command(settings, workers, seconds, pool):
+    pairs = []
+    for setting in settings or PASSWORD_BENCHMARK_SETTINGS:
+        method, _, cost = setting.rpartition(":")
+        pairs.append((method, int(cost)) if method and cost.isdigit() else (setting, None))
+    print(f"{'settings':<24}{'logins/s':>12}{'per worker':>12}{'ms each':>10}")
+    for row in benchmark_password_hashing(pairs, workers, seconds, pool):
+        print(f'{row["settings"]:<24}{row["per_second"]:>12.1f}{row["per_worker_per_second"]:>12.1f}{row["milliseconds"]:>10.2f}')
+
+
+app.cli.add_command(password_cli)
+
+
+cache_cli = AppGroup('cache', help="Response cache commands")
+
+
+@cache_cli.command("serve", help="Runs an in-memory Redis protocol stand-in for RESPONSE_CACHE_BACKEND=resp")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=6379)
+def cache_serve_command(host, port):
+    server = RespStandIn((host, port))
+    print(f"Serving the response cache on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+@cache_cli.command("clear", help="Empties the response cache, for the filesystem and resp backends")
+def cache_clear_command():
+    if response_cache.backend is None:
+        print("The response cache is disabled")
+        return
+    response_cache.backend.clear()
+    print("Response cache cleared")
+
+
+app.cli.add_command(cache_cli)
+
+
+load_cli = AppGroup('load', help="Load testing commands")
+
+
+# e.g. flask seed --students 5000 --staff 200, then gunicorn -w 4 -b 127.0.0.1:8000 wsgi:app, then
+# flask load run --url http://127.0.0.1:8000 --users 50 --profile ramp
+@load_cli.command("run", help="Replays scripted staff traffic against a running server and reports per endpoint")
+@click.option("--url", default="http://127.0.0.1:8000", help="Server to load, e.g. gunicorn started as in the Procfile")
+@click.option("--users", default=20, help="Peak number of virtual staff")
+@click.option("--duration", default=60.0, help="Length of the profile in seconds")
+@click.option("--profile", type=click.Choice(list(LOAD_PROFILES)), default="ramp", help="How the virtual staff come and go")
+@click.option("--stages", default=None, help="seconds:users stages instead of a profile, e.g. 30:10,60:50,30:0")
+@click.option("--mix", default=None, help="Action weights, e.g. browse_students=50,toggle_vote=50")
+@click.option("--think-time", default=0.5, help="Mean pause between the actions of a virtual staff in seconds")
+@click.option("--username", default="seed0-staff{n}", help="Staff usernames, {n} is numbered from 1")
+@click.option("--staff-count", default=100, help="Number of staff accounts the virtual staff log in as")
+@click.option("--password", default="seedpass")
+@click.option("--seed", default=0, help="Seed of the random choices of the virtual staff")
+@click.option("--output", default=None, help="File the report is written to as JSON")
+def load_run_command(url, users, duration, profile, stages, mix, think_time, username, staff_count, password, seed, output):
+    try:
+        stages = parse_stages(stages) if stages else LOAD_PROFILES[profile](users, duration)
+        options = {"mix": parse_mix(mix) if mix else None, "think_time": think_time, "seed": seed}
+        usernames = [username.format(n=number) for number in range(1, staff_count + 1)]
+        print(f"Loading {url} for {profile_duration(stages):.0f}s")
+        report = run_load_test(url, stages, usernames, password, **options)
+    except LoadTestError as e:
+        print(e)
+        sys.exit(1)
+    print(f'{report["seconds"]:.1f}s, up to {report["peak_users"]} virtual staff')
+    print(f"{'endpoint':<34}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'errors':>8}{'4xx':>6}")
+    rows = list(report["endpoints"].items()) + [("total", report["total"])]
+    for name, row in rows:
+        print(f'{name:<34}{row["requests"]:>9}{row["per_second"]:>9.1f}{row["p50_ms"]:>9.1f}{row["p90_ms"]:>9.1f}{row["p99_ms"]:>9.1f}{row["error_rate"]:>8.1%}{row["rejected"]:>6}')
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {output}")
+
+
+app.cli.add_command(load_cli)
+
+
+# The benchmark suite is in App/tests/benchmarks/bench_app.py
+bench_cli = AppGroup('bench', help="Benchmark commands")
+
+
+@bench_cli.command("run", help="Times the hot controllers and endpoints at each dataset size and writes the results as JSON")
+@click.option("--sizes", default="100,1000,5000", help="Dataset sizes, in students")
+@click.option("--iterations", default=20, help="Timed runs of each benchmark at each size")
+@click.option("--output", default="bench.json", help="File the results are written to")
+@click.option("--only", multiple=True, help="Run only this benchmark, can be given more than once")
+def bench_run_command(sizes, iterations, output, only):
+    #imported here, App.tests imports this module for the app
+    from App.tests.benchmarks.bench_app import run_benchmarks, write_report
+    sizes = [int(size) for size in sizes.split(",")]
+    report = run_benchmarks(app, sizes, iterations, only)
+    print(f"{'benchmark':<34}{'size':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'SQL':>6}")
+    for result in report["results"]:
+        print(f'{result["name"]:<34}{result["size"]:>7}{result["p50_ms"]:>10.3f}{result["p90_ms"]:>10.3f}{result["p99_ms"]:>10.3f}{result["statements"]:>6}')
+    write_report(report, output)
+    print(f"Results written to {output}")
+
+
+@bench_cli.command("compare", help="Compares two benchmark results and fails if head regressed")
+@click.argument("base", type=click.Path(exists=True, dir_okay=False))
+@click.argument("head", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", default=0.2, help="Slowdown of the median counted as a regression, 0.2 is 20%")
+def bench_compare_command(base, head, threshold):
+    from App.tests.benchmarks.bench_app import compare_reports
+    with open(base) as file:
+        base = json.load(file)
+    with open(head) as file:
+        head = json.load(file)
+    rows = compare_reports(base, head, threshold)
+    print(f"{'benchmark':<34}{'size':>7}{'base ms':>10}{'head ms':>10}{'change':>9}{'SQL':>9}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        statements = f'{row["base_statements"]}->{row["head_statements"]}'
+        print(f'{row["name"]:<34}{row["size"]:>7}{row["base_p50_ms"]:>10.3f}{row["head_p50_ms"]:>10.3f}{row["change"]:>+9.1%}{statements:>9}{flag}')
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+        sys.exit(1)
+    print("No regressions")
+
+
+app.cli.add_command(bench_cli)
+
+
 test = AppGroup("test", help="Testing commands")
 
 
@@ -279,4 +533,19 @@ def user_tests_command(type):
         sys.exit(pytest.main(["-k", "App"]))
 
 
+@test.command("bench", help="Run the benchmark suite through pytest")
+@click.option("--sizes", default="100,1000,5000", help="Dataset sizes, in students")
+@click.option("--iterations", default=20, help="Timed runs of each benchmark at each size")
+@click.option("--output", default=None, help="File the results are written to")
+@click.option("--baseline", default=None, help="Results to compare with, a regression fails its benchmark")
+@click.option("--threshold", default=0.2, help="Slowdown of the median counted as a regression")
+def bench_tests_command(sizes, iterations, output, baseline, threshold):
+    os.environ.update({"BENCH_SIZES": sizes, "BENCH_ITERATIONS": str(iterations), "BENCH_THRESHOLD": str(threshold)})
+    if output:
+        os.environ["BENCH_OUTPUT"] = output
+    if baseline:
+        os.environ["BENCH_BASELINE"] = baseline
+    sys.exit(pytest.main(["-o", "python_files=bench_*.py", "App/tests/benchmarks"]))
+
+
 app.cli.add_command(test)